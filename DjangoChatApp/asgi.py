@@ -10,11 +10,12 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 import os
 
 from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 from django.core.asgi import get_asgi_application
 from channels.security.websocket import AllowedHostsOriginValidator
 
 import rooms.routing
+import rooms.workers
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'DjangoChatApp.settings')
 
@@ -22,6 +23,10 @@ application = ProtocolTypeRouter({
 		'http': get_asgi_application(),
 		'websocket': AllowedHostsOriginValidator(
 			AuthMiddlewareStack(URLRouter(rooms.routing.urlpatterns))
-		)
+		),
+		'channel': ChannelNameRouter({
+			'tracker-provisioning': rooms.workers.TrackerProvisioningConsumer.as_asgi(),
+			'upload-processing': rooms.workers.UploadProcessingConsumer.as_asgi(),
+		}),
 	}
 )
@@ -98,6 +98,47 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.0/ref/settings/#caches
+# "local" is the per process tier in front of "default", see rooms/caching.py.
+# Setting REDIS_CACHE_URL makes "default" shared by every process.
+# Besides the cached values, "default" holds the per-chat and per-backlog
+# versions (permissions, member lists, channel trees, message fragments) and
+# the invite previews, so it's sized well above Django's 300 entries that
+# would have them evict each other.
+# "presence" counts the open sockets of each user, see rooms/presence.py.
+# Without REDIS_CACHE_URL it's per process, so with more than one worker a
+# user is only seen online by the sockets of the worker they're connected to,
+# deployments with several workers have to set it.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'local',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'presence': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'presence',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+if os.environ.get('REDIS_CACHE_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_CACHE_URL'],
+    }
+    CACHES['presence'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_CACHE_URL'],
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
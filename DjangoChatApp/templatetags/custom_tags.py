@@ -7,6 +7,8 @@ from django.db.models import Q
 
 
 from rooms.models import PrivateChat, BacklogGroupTracker
+from rooms import presence, caching
+from rooms.channel_tree import build_notifications
 from users.models import Friendship
 
 
@@ -102,20 +104,43 @@ def to_json(value):
 
 @register.filter('get_group_channel_notifications')
 def get_group_channel_notifications(user, channel):
-    member = channel.chat.get_member(user)
-    tracker = BacklogGroupTracker.objects.get(user=user, backlog_group=channel.backlog_group)
-    notifications_by_id = {"initial": {'unread_backlogs': 0, 'mentions': 0}}
-
-    unread_backlogs = tracker.get_unread_backlogs()
-
-    unread_backlog_count = unread_backlogs.count()
-    mention_count = unread_backlogs.filter(Q(user_mentions=user) | Q(role_mentions__in=member.roles.all())).count()
-    
-    notifications_by_id[f"backlog-group-{tracker.backlog_group.pk}-unreads"] = unread_backlog_count
-    notifications_by_id[f"backlog-group-{tracker.backlog_group.pk}-mentions"] = mention_count
-    
-    notifications_by_id["initial"]['unread_backlogs'] += unread_backlog_count
-    notifications_by_id["initial"]['mentions'] += mention_count
-
-    print(notifications_by_id)
-    return notifications_by_id
\ No newline at end of file
+    if isinstance(channel, dict):
+        # the sidebar has them already, see rooms/channel_tree.py
+        return channel['notifications']
+
+    # the counters of all the user's channels are read at once and kept on the
+    # user for the rest of the request, instead of a lookup per channel
+    counters = getattr(user, '_channel_notification_counters', None)
+    if counters is None or channel.pk not in counters:
+        counters = user._channel_notification_counters = {
+            group_channel: (backlog_group, unread_count, mention_count)
+            for group_channel, backlog_group, unread_count, mention_count in user.backlog_trackers.filter(
+                backlog_group__kind='group_channel'
+            ).values_list('backlog_group__group_channel', 'backlog_group', 'unread_count', 'mention_count')
+        }
+
+    if channel.pk in counters:
+        backlog_group, unread_backlog_count, mention_count = counters[channel.pk]
+    else:
+        # the tracker hasn't been provisioned yet, so there's nothing unread
+        backlog_group, unread_backlog_count, mention_count = channel.backlog_group.pk, 0, 0
+
+    return build_notifications(backlog_group, unread_backlog_count, mention_count)
+
+
+@register.filter('presence_status')
+def presence_status(user):
+    # views can read the statuses of a list of users at once with presence.prefetch_statuses
+    status = getattr(user, '_presence_status', None)
+    if status is None:
+        status = user._presence_status = presence.get_status(user.pk)
+
+    return status
+
+
+@register.filter('group_chat_sidebar')
+def group_chat_sidebar(user):
+    # the memberships give the notifications, the names and images are cached
+    memberships = list(user.group_chat_memberships.all())
+    summaries = caching.get_chat_summaries([membership.chat_id for membership in memberships])
+    return [(membership, summaries[membership.chat_id]) for membership in memberships if membership.chat_id in summaries]
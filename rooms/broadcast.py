@@ -0,0 +1,19 @@
+import asyncio
+from collections import defaultdict
+
+
+async def group_send_many(channel_layer, sends):
+    """
+    Sends the (group, event) pairs concurrently, so that an action that
+    notifies several groups waits on about one round-trip to the channel 
+    layer instead of one per send. Events to the same group keep their order.
+    """
+    events_by_group = defaultdict(list)
+    for group, event in sends:
+        events_by_group[group].append(event)
+
+    async def send_in_order(group, events):
+        for event in events:
+            await channel_layer.group_send(group, event)
+
+    await asyncio.gather(*(send_in_order(group, events) for group, events in events_by_group.items()))
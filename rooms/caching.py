@@ -0,0 +1,197 @@
+"""
+Cached reads of what rarely changes: the name and image of group chats,
+their roles in order of importance, their channel tree and emotes, and the
+emojis.
+
+Values are looked up in the "local" cache of the process first and then in
+the "default" cache, when that one is shared by every process (Redis, see
+CACHES in the settings). The signals in rooms/signals.py delete them from
+both when they change. Other processes can't be reached, so when there is a
+shared tier the local copies only live for LOCAL_TIMEOUT seconds.
+
+That's too stale for what's built from them and cached again under a
+version, like the visible channel trees and the message fragments: a copy
+from before the change would be stored under the version that was bumped
+for it, for every process. Those pass local=False to only read the shared
+tier.
+
+Each kind of value counts its hits and misses in the process, see
+get_stats and CacheStatsView.
+"""
+from collections import defaultdict
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from .models import GroupChat, Emoji, Emote, Role, Category, GroupChannel
+
+
+TIMEOUT = 60 * 60
+LOCAL_TIMEOUT = 10
+
+CHAT = 'chat'
+ROLES = 'roles'
+CHANNELS = 'channels'
+EMOTES = 'emotes'
+EMOJI = 'emoji'
+
+# kind -> {'hits': int, 'misses': int}
+_stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+
+def get_tiers():
+    local = caches['local']
+    shared = caches['default']
+    if isinstance(shared, LocMemCache):
+        # a second copy in the same process wouldn't help
+        return local, None
+
+    return local, shared
+
+
+def make_key(kind, pk):
+    return f'cached:{kind}:{pk}'
+
+
+def get_many(kind, pks, load, local=True):
+    """
+    Returns {pk: value} for the pks that have one, calling load with the
+    pks that aren't cached in either tier. load returns {pk: value} too,
+    pks it leaves out (deleted objects) aren't cached.
+    """
+    local_tier, shared = get_tiers()
+    keys = {make_key(kind, pk): pk for pk in pks}
+
+    found = local_tier.get_many(keys) if local or not shared else {}
+    missing = [key for key in keys if key not in found]
+    if missing and shared:
+        shared_found = shared.get_many(missing)
+        local_tier.set_many(shared_found, timeout=LOCAL_TIMEOUT)
+        found.update(shared_found)
+        missing = [key for key in missing if key not in shared_found]
+
+    _stats[kind]['hits'] += len(keys) - len(missing)
+    _stats[kind]['misses'] += len(missing)
+
+    if missing:
+        loaded = {make_key(kind, pk): value for pk, value in load([keys[key] for key in missing]).items()}
+        local_tier.set_many(loaded, timeout=LOCAL_TIMEOUT if shared else TIMEOUT)
+        if shared:
+            shared.set_many(loaded, timeout=TIMEOUT)
+        found.update(loaded)
+
+    return {keys[key]: value for key, value in found.items()}
+
+
+def get_one(kind, pk, load, local=True):
+    return get_many(kind, [pk], load, local).get(pk)
+
+
+def invalidate(kind, pk):
+    for tier in get_tiers():
+        if tier:
+            tier.delete(make_key(kind, pk))
+
+
+def get_stats():
+    return {
+        kind: {**counts, 'hit_rate': counts['hits'] / ((counts['hits'] + counts['misses']) or 1)}
+        for kind, counts in _stats.items()
+    }
+
+
+def reset_stats():
+    _stats.clear()
+
+
+def load_chat_summaries(chat_pks):
+    return {
+        chat.pk: {
+            'pk': chat.pk,
+            'name': chat.name,
+            'image': {'url': chat.image.url} if chat.image else None,
+        }
+        for chat in GroupChat.objects.filter(pk__in=chat_pks).only('pk', 'name', 'image')
+    }
+
+
+def get_chat_summaries(chat_pks):
+    """
+    What the sidebar and the previews show of group chats, their name and
+    image, as {'pk', 'name', 'image': {'url'} or None} by chat pk.
+    """
+    return get_many(CHAT, chat_pks, load_chat_summaries)
+
+
+def get_chat_summary(chat_pk):
+    return get_chat_summaries([chat_pk]).get(chat_pk)
+
+
+def load_role_order(chat_pks):
+    chats = GroupChat.objects.filter(pk__in=chat_pks).only('pk', 'base_role', 'role_order').in_bulk()
+    roles = defaultdict(list)
+    for role in Role.objects.filter(chat__in=chat_pks).only('pk', 'name', 'color', 'admin', 'chat'):
+        roles[role.chat_id].append(role)
+
+    return {
+        chat_pk: [
+            {'pk': role.pk, 'name': role.name, 'color': role.color, 'admin': role.admin}
+            for role in sorted(roles[chat_pk], key=chat.get_role_order)
+        ]
+        for chat_pk, chat in chats.items()
+    }
+
+
+def get_role_order(chat_pk, local=True):
+    """
+    The roles of the group chat from the most important to the base role.
+    """
+    return get_one(ROLES, chat_pk, load_role_order, local) or []
+
+
+def load_channel_trees(chat_pks):
+    trees = {chat_pk: [] for chat_pk in GroupChat.objects.filter(pk__in=chat_pks).values_list('pk', flat=True)}
+    categories = {}
+    for category in Category.objects.filter(chat__in=trees).order_by('pk'):
+        categories[category.pk] = {'kind': 'category', 'pk': category.pk, 'name': category.name, 'channels': []}
+        trees[category.chat_id].append(categories[category.pk])
+
+    channels = GroupChannel.objects.filter(chat__in=trees).order_by('pk').values_list(
+        'pk', 'name', 'chat', 'category', 'backlog_group'
+    )
+    for pk, name, chat_pk, category_pk, backlog_group_pk in channels:
+        channel = {'kind': 'channel', 'pk': pk, 'name': name, 'backlog_group_pk': backlog_group_pk}
+        if category_pk:
+            categories[category_pk]['channels'].append(channel)
+        else:
+            trees[chat_pk].append(channel)
+
+    return trees
+
+
+def get_channel_tree(chat_pk, local=True):
+    """
+    The categories of the group chat with their channels, followed by the
+    channels that aren't in a category, like GroupChat.channels_and_categories.
+    """
+    return get_one(CHANNELS, chat_pk, load_channel_trees, local) or []
+
+
+def load_emotes(chat_pks):
+    emotes = {chat_pk: [] for chat_pk in chat_pks}
+    for emote in Emote.objects.filter(chat__in=chat_pks).order_by('pk').values('pk', 'name', 'image', 'chat'):
+        emotes[emote.pop('chat')].append(emote)
+
+    return emotes
+
+
+def get_emotes(chat_pk):
+    return get_one(EMOTES, chat_pk, load_emotes)
+
+
+def load_emojis(emoji_pks):
+    return {emoji['pk']: emoji for emoji in Emoji.objects.filter(pk__in=emoji_pks).values('pk', 'name', 'image', 'emoji_literal')}
+
+
+def get_emoji(emoji_pk):
+    return get_one(EMOJI, emoji_pk, load_emojis)
@@ -0,0 +1,107 @@
+"""
+The channels and categories a member of a group chat sees in the sidebar.
+
+What a member sees only depends on their roles, or on owning the chat or
+having an admin role, which shows everything. So rather than resolving it
+for every page, the visible tree is computed once per chat and set of roles
+from the channel tree in rooms/caching.py, and cached under a per-chat
+version that the signals in rooms/signals.py bump when a channel, a
+category, or what the roles can see changes.
+
+The unread counters are then put in for the member from one read of their
+trackers in the chat, see build_sidebar.
+"""
+from .models import BacklogGroupTracker, Role
+from . import caching, versions
+
+
+CHANNEL_TREE_VERSION = 'channel-tree'
+VISIBLE_CHANNELS = 'visible-channels'
+# the role set of owners and admins
+ALL = 'all'
+
+
+def invalidate_channel_tree(chat_pk):
+    versions.bump(CHANNEL_TREE_VERSION, chat_pk)
+
+
+def get_role_set(membership):
+    if membership.is_owner():
+        return ALL
+
+    role_pks = sorted(Role.members.through.objects.filter(groupchatmembership=membership).values_list('role', flat=True))
+    admin_role_pks = {role['pk'] for role in caching.get_role_order(membership.chat_id) if role['admin']}
+    if admin_role_pks.intersection(role_pks):
+        return ALL
+
+    return ','.join(map(str, role_pks))
+
+
+def can_see_channel(membership, channel_pk):
+    role_set = get_role_set(membership)
+    if role_set == ALL:
+        return True
+
+    role_pks = role_set.split(',') if role_set else []
+    return Role.can_see_channels.through.objects.filter(role__in=role_pks, groupchannel=channel_pk).exists()
+
+
+def build_visible_tree(chat_pk, role_set):
+    # cached under the version, see rooms/caching.py
+    tree = caching.get_channel_tree(chat_pk, local=False)
+    if role_set == ALL:
+        return tree
+
+    role_pks = role_set.split(',') if role_set else []
+    channel_pks = set(Role.can_see_channels.through.objects.filter(role__in=role_pks).values_list('groupchannel', flat=True))
+    category_pks = set(Role.can_see_categories.through.objects.filter(role__in=role_pks).values_list('category', flat=True))
+
+    visible_tree = []
+    for item in tree:
+        if item['kind'] == 'category' and item['pk'] in category_pks:
+            visible_tree.append({**item, 'channels': [channel for channel in item['channels'] if channel['pk'] in channel_pks]})
+        elif item['kind'] == 'channel' and item['pk'] in channel_pks:
+            visible_tree.append(item)
+
+    return visible_tree
+
+
+def get_visible_tree(chat_pk, role_set):
+    key = f'{chat_pk}:{versions.get_version(CHANNEL_TREE_VERSION, chat_pk)}:{role_set}'
+    return caching.get_one(VISIBLE_CHANNELS, key, lambda keys: {key: build_visible_tree(chat_pk, role_set)})
+
+
+def build_notifications(backlog_group_pk, unread_count, mention_count):
+    return {
+        "initial": {'unread_backlogs': unread_count, 'mentions': mention_count},
+        f"backlog-group-{backlog_group_pk}-unreads": unread_count,
+        f"backlog-group-{backlog_group_pk}-mentions": mention_count,
+    }
+
+
+def build_sidebar(membership):
+    """
+    Returns the visible tree of the member with the notifications of each
+    channel, as the items that group-chat.html renders the sidebar from.
+    """
+    tree = get_visible_tree(membership.chat_id, get_role_set(membership))
+    counters = {
+        backlog_group_pk: (unread_count, mention_count)
+        for backlog_group_pk, unread_count, mention_count in BacklogGroupTracker.objects.filter(
+            user=membership.user_id, backlog_group__group_channel__chat=membership.chat_id
+        ).values_list('backlog_group', 'unread_count', 'mention_count')
+    }
+
+    def with_notifications(channel):
+        # channels without a tracker yet have nothing unread
+        unread_count, mention_count = counters.get(channel['backlog_group_pk'], (0, 0))
+        return {**channel, 'notifications': build_notifications(channel['backlog_group_pk'], unread_count, mention_count)}
+
+    sidebar = []
+    for item in tree:
+        if item['kind'] == 'category':
+            sidebar.append({**item, 'channels': [with_notifications(channel) for channel in item['channels']]})
+        else:
+            sidebar.append(with_notifications(item))
+
+    return sidebar
@@ -1,14 +1,13 @@
 import json
-from datetime import datetime
 import asyncio
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from django.template.loader import render_to_string
-from django.core.paginator import Paginator
 from django.urls import reverse
-from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.db import transaction, IntegrityError
 
 from .models import (
     Backlog,
@@ -18,19 +17,26 @@ from .models import (
     PrivateChat,
     BacklogGroupTracker,
     PrivateChatMembership,
-    Emoji,
-    Emote,
     Reaction,
     Invite,
     GroupChatMembership,
     Log,
-    Category
+    Category,
+    Upload,
 )
-from users.models import Friend
-from utils import get_object_or_none, base64_file
-from DjangoChatApp.templatetags.custom_tags import get_member_or_none
+from users.models import Friend, UserArchive
+from utils import get_object_or_none
+from .rendering import render_backlogs, render_message, render_shared_message, render_message_overlay, render_invites
+from .notifications import notification_dispatcher
+from .reactions import reaction_dispatcher
+from .members import render_member_list, search_mentionables, WINDOW
+from .emoji_catalog import get_catalog_version
+from .caching import get_emotes, get_emoji
+from .broadcast import group_send_many
+from .channel_tree import can_see_channel
+from . import protocol, presence
+
 
-@sync_to_async
 def process_mention(mention):
     import re
 
@@ -46,41 +52,63 @@ def process_mention(mention):
     return alphanumeric, numeric
 
 
-@database_sync_to_async
-def get_foreign_keys(name, *objects):
-    return [getattr(object_, name) for object_ in objects]
-
-@database_sync_to_async
-def get_foreign_key(name, object_):
-    return getattr(object_, name)
-
-@database_sync_to_async
-def db_async(fn):
-    return fn()
-
-
 class AppConsumer(AsyncWebsocketConsumer):
     async def connect(self, chat=None):
         self.user = self.scope.get('user')
-        self.user_archive = await get_foreign_key('user_archive', self.user)
+        if not self.user or not self.user.is_authenticated or not await self.authorize():
+            return await self.close()
 
-        if not self.user or not self.user.is_authenticated:
-            return self.close()
+        self.user_archive = await UserArchive.objects.aget(user=self.user)
         
         self.csrf_token = self.scope['cookies']['csrftoken']
         self.loop = asyncio.get_event_loop()
         await self.channel_layer.group_add(f'user_{self.user.pk}', self.channel_name)
         await self.create_extra_path()
-        await self.connect_user_to_chats()
-        await self.accept()
+
+        # see rooms/protocol.py
+        self.binary = protocol.SUBPROTOCOL in self.scope.get('subprotocols', [])
+        if self.binary:
+            await self.accept(subprotocol=protocol.SUBPROTOCOL)
+            await self.send(bytes_data=protocol.encode_handshake())
+        else:
+            await self.accept()
+
+        self.presence_generation, first = await sync_to_async(presence.connect)(self.user.pk)
+        if first:
+            presence.presence_dispatcher.schedule(self.user.pk, presence.ONLINE)
+
+        self.heartbeat_task = self.loop.create_task(self.send_heartbeats())
+        return True
+
+    async def authorize(self):
+        """
+        Loads what the socket is about and returns whether the user may
+        connect to it, the socket is closed before being accepted otherwise.
+        """
+        return True
+
+    async def send_heartbeats(self):
+        while True:
+            await asyncio.sleep(presence.HEARTBEAT)
+            self.presence_generation, back_online = await sync_to_async(presence.heartbeat)(self.user.pk, self.presence_generation)
+            if back_online:
+                presence.presence_dispatcher.schedule(self.user.pk, presence.ONLINE)
 
     async def receive(self, text_data=None, bytes_data=None):
-        data = json.loads(text_data)
-        print('received: ', data)
+        try:
+            data = protocol.decode(bytes_data) if bytes_data else json.loads(text_data)
+        except ValueError:
+            return
         handler = getattr(self, data['action'])
         await handler(**data)
     
     async def disconnect(self, close_code):
+        heartbeat_task = getattr(self, 'heartbeat_task', None)
+        if heartbeat_task:
+            heartbeat_task.cancel()
+            if await sync_to_async(presence.disconnect)(self.user.pk, self.presence_generation):
+                presence.presence_dispatcher.schedule(self.user.pk, presence.OFFLINE)
+
         await self.close()
 
     async def create_extra_path(self):
@@ -92,126 +120,51 @@ class AppConsumer(AsyncWebsocketConsumer):
         if 'dashboard' in self.extra_path:
             await self.channel_layer.group_add(f'user_{self.user.pk}_dashboard', self.channel_name)
 
+    async def send_event(self, event):
+        if self.binary:
+            await self.send(bytes_data=protocol.encode(event))
+        else:
+            await self.send(text_data=json.dumps(event))
+
     async def send_to_client(self, event):
-        print('sending', 'data: ', event)
-        await self.send(text_data=json.dumps(event))
+        await self.send_event(event)
 
-    async def create_new_backlog_notification(self, event):
-        @database_sync_to_async
-        def allow_notification(sender: int, target_backlog_group: int, backlog_iso_date: str, **kwargs):
-            # backlog was sent by the same user
-            is_sender = (sender == self.user.pk)
-            if is_sender:
-                return False, 'is sender'
-            
-            # the user already saw the message
-            target_backlog_group_tracker = BacklogGroupTracker.objects.get(user=self.user, backlog_group=target_backlog_group)
-            last_updated = target_backlog_group_tracker.last_updated
-            backlog_date = datetime.fromisoformat(backlog_iso_date)
-            already_seen_backlog = (last_updated >= backlog_date)
-            if already_seen_backlog:
-                return False, 'already saw backlog'
-
-            return True, 'ok to send'
-        
-        async def delegate_notification_creation(notification_type: str, target_backlog_group: int, **kwargs):
-            await asyncio.sleep(2)
-            # print reason for debug purposes
-            send_notification, reason = await allow_notification(**event)
-            print(send_notification, reason)
-            if not send_notification:
-                return
-            
-            if notification_type == 'private_chat_notification':
-                channels_sends = await self.create_private_chat_notification(backlog_group=target_backlog_group, private_chat=kwargs['private_chat'])
-                for send in channels_sends:
-                    await send
-            elif notification_type == 'group_chat_notification':
-                channels_sends = await self.create_group_chat_notification(
-                    backlog_group=target_backlog_group, 
-                    group_chat=kwargs['group_chat'], 
-                    group_channel=kwargs['group_channel'],
-                    user_mentions=kwargs['user_mentions'],
-                    role_mentions=kwargs['role_mentions'],
-                )
-                for send in channels_sends:
-                    await send
-
-        self.loop.create_task(delegate_notification_creation(**event))
-        
-    @sync_to_async
-    def create_private_chat_notification(self, private_chat, backlog_group):
-        channels_sends = []
-        
-        if 'self' in self.extra_path:
-            channels_sends.append(self.send_to_client({
-                'action': 'create_notification',
-                'id': f'private-chat-{private_chat}',
-                'notification_id': f'backlog-group-{backlog_group}-unreads',
-                'kind': 'visible',
-            }))
+    async def group_send_many(self, *sends):
+        await group_send_many(self.channel_layer, sends)
 
-        channels_sends.append(self.send_to_client({
-            'action': 'create_notification',
-            'id': f'dashboard-button',
-            'notification_id': f'backlog-group-{backlog_group}-unreads',
-            'kind': 'visible',
-        }))
+    async def send_notifications(self, event):
+        """
+            Receives the notification counts resolved by the notification
+            dispatcher (see rooms/notifications.py) and updates the elements
+            the user has on the frontend in one go.
+        """
+        backlog_group = event['backlog_group']
+        notifications = []
 
-        return channels_sends
-    
-    @sync_to_async
-    def create_group_chat_notification(self, role_mentions, user_mentions, backlog_group, group_chat, group_channel):
-        channels_sends = []
-        membership = self.user.group_chat_memberships.get(chat__pk=group_chat)
-        role_mentioned = any([role.pk in role_mentions for role in membership.roles.all()])
-        user_mentioned = self.user.pk in user_mentions
-
-        mentioned = role_mentioned or user_mentioned
-
-        # if the user is inside a group chat on the frontend
-        if hasattr(self, 'group_chat'):
-            channels_sends.append(self.send_to_client({
-                'action': 'create_notification',
-                'id': f'group-channel-{group_channel}',
-                'notification_id': f'backlog-group-{backlog_group}-unreads',
-                'kind': 'hidden',
-            }))
+        def add_notification(id, notification_id, kind, count):
+            notifications.append({'id': id, 'notification_id': notification_id, 'kind': kind, 'count': count})
 
-            mentioned and channels_sends.append(self.send_to_client({
-                'action': 'create_notification',
-                'id': f'group-channel-{group_channel}',
-                'notification_id': f'backlog-group-{backlog_group}-mentions',
-                'kind': 'visible',
-            }))
+        if 'private_chat' in event:
+            if 'self' in self.extra_path:
+                add_notification(f'private-chat-{event["private_chat"]}', f'backlog-group-{backlog_group}-unreads', 'visible', event['unreads'])
+            
+            add_notification('dashboard-button', f'backlog-group-{backlog_group}-unreads', 'visible', event['unreads'])
+        else:
+            ids = [f'group-chat-{event["group_chat"]}']
+            # if the user is inside the group chat on the frontend
+            if getattr(self, 'group_chat', None) and self.group_chat.pk == event['group_chat']:
+                ids.insert(0, f'group-channel-{event["group_channel"]}')
+
+            for id in ids:
+                add_notification(id, f'backlog-group-{backlog_group}-unreads', 'hidden', event['unreads'])
+                if event['mentions']:
+                    add_notification(id, f'backlog-group-{backlog_group}-mentions', 'visible', event['mentions'])
+
+        await self.send_to_client({
+            'action': 'create_notifications',
+            'notifications': notifications,
+        })
 
-        channels_sends.append(self.send_to_client({
-            'action': 'create_notification',
-            'id': f'group-chat-{group_chat}',
-            'notification_id': f'backlog-group-{backlog_group}-unreads',
-            'kind': 'hidden',
-        }))
-
-        mentioned and channels_sends.append(self.send_to_client({
-            'action': 'create_notification',
-            'id': f'group-chat-{group_chat}',
-            'notification_id': f'backlog-group-{backlog_group}-mentions',
-            'kind': 'visible',
-        }))
-
-        return channels_sends
-
-    async def connect_user_to_chats(self):
-        """ 
-            This method makes the user listen to all backlogs groups they're in.
-        """
-        # using list(...) due to queryset not being iterable in async context
-        user_backlog_groups = await db_async(
-            lambda: list(self.user.backlog_trackers.values_list('backlog_group', flat=True))
-        )
-        for backlog_group in user_backlog_groups:
-            await self.channel_layer.group_add(f'backlog_group_{backlog_group}', self.channel_name)
-    
     async def accept_friendship(self, pk, **kwargs):
         @database_sync_to_async
         def accept_friendship():
@@ -223,35 +176,28 @@ class AppConsumer(AsyncWebsocketConsumer):
             sender_profile = friendship.sender_profile()
             receiver_profile = friendship.receiver_profile()
 
-            return sender_profile, receiver_profile
+            return sender_profile, receiver_profile, sender_profile.user, receiver_profile.user
         
-        sender_profile, receiver_profile = await accept_friendship()
-        sender_user, receiver_user = await get_foreign_keys('user', sender_profile, receiver_profile)
+        sender_profile, receiver_profile, sender_user, receiver_user = await accept_friendship()
         
-        await self.channel_layer.group_send(
-            f'user_{sender_user.pk}_dashboard', {
+        await self.group_send_many(
+            (f'user_{sender_user.pk}_dashboard', {
                 'type': 'send_to_client',
                 'pk': receiver_profile.pk,
                 'is_receiver': False,
                 **kwargs
-            }
-        )
-
-        await self.channel_layer.group_send(
-            f'user_{receiver_user.pk}_dashboard', {
+            }),
+            (f'user_{receiver_user.pk}_dashboard', {
                 'type': 'send_to_client',
                 'pk': sender_profile.pk,
                 'is_receiver': True,
                 **kwargs
-            }
-        )
-
-        await self.channel_layer.group_send(
-            f'user_{receiver_user.pk}', {
+            }),
+            (f'user_{receiver_user.pk}', {
                 'type': 'send_to_client',
                 'action': 'remove_notification',
                 'id': 'dashboard-button',
-            }
+            }),
         )
 
     async def delete_friendship(self, pk, **kwargs):
@@ -264,37 +210,36 @@ class AppConsumer(AsyncWebsocketConsumer):
             sender_profile = friendship.sender_profile()
             receiver_profile = friendship.receiver_profile()
 
+            sender_user = sender_profile.user
+            receiver_user = receiver_profile.user
+
             friendship.delete()
 
-            return cancelled, sender_profile, receiver_profile
+            return cancelled, sender_profile, receiver_profile, sender_user, receiver_user
         
-        cancelled, sender_profile, receiver_profile = await delete_friendship()
-        sender_user, receiver_user = await get_foreign_keys('user', sender_profile, receiver_profile)
+        cancelled, sender_profile, receiver_profile, sender_user, receiver_user = await delete_friendship()
 
-        await self.channel_layer.group_send(
-            f'user_{sender_user.pk}_dashboard', {
+        sends = [
+            (f'user_{sender_user.pk}_dashboard', {
                 'type': 'send_to_client',
                 'action': 'delete_friendship',
                 'pk': receiver_profile.pk,
-            }
-        )
-
-        await self.channel_layer.group_send(
-            f'user_{receiver_user.pk}_dashboard', {
+            }),
+            (f'user_{receiver_user.pk}_dashboard', {
                 'type': 'send_to_client',
                 'action': 'delete_friendship',
                 'pk': sender_profile.pk,
-            }
-        )
+            }),
+        ]
 
         if cancelled:
-            await self.channel_layer.group_send(
-                f'user_{receiver_user.pk}', {
-                    'type': 'send_to_client',
-                    'action': 'remove_notification',
-                    'id': 'dashboard-button',
-                }
-            )
+            sends.append((f'user_{receiver_user.pk}', {
+                'type': 'send_to_client',
+                'action': 'remove_notification',
+                'id': 'dashboard-button',
+            }))
+
+        await self.group_send_many(*sends)
 
 
     @sync_to_async
@@ -307,76 +252,88 @@ class AppConsumer(AsyncWebsocketConsumer):
         if invite.one_time:
             invite.delete()
 
-        return [
-            self.channel_layer.group_send(
-                f'group_chat_{group_chat.pk}', {
-                    'type': 'send_log_to_client',
-                    'action': 'create_log',
-                    'pk': backlog.pk,
-                }
-            ),
-            self.channel_layer.group_send(
-                f'user_{self.user.pk}', {
-                    'type': 'send_to_client',
-                    'action': 'join_group_chat',
-                    'html': render_to_string('core/elements/group-chat.html', context={'local_group_chat': group_chat, 'user': self.user}),
-                }
-            ),
-            self.send(text_data=json.dumps({
-                'action': 'redirect',
-                'url': reverse('group-channel', kwargs={'group_chat_pk': group_chat.pk, 'group_channel_pk': channel.pk})
-            })),
+        sends = [
+            (f'group_chat_{group_chat.pk}', {
+                'type': 'send_log_to_client',
+                'action': 'create_log',
+                'pk': backlog.pk,
+            }),
+            (f'user_{self.user.pk}', {
+                'type': 'send_to_client',
+                'action': 'join_group_chat',
+                'html': render_to_string('core/elements/group-chat.html', context={'local_group_chat': group_chat, 'user': self.user}),
+            }),
         ]
+        redirect_url = reverse('group-channel', kwargs={'group_chat_pk': group_chat.pk, 'group_channel_pk': channel.pk})
+
+        return sends, redirect_url
 
     async def accept_invite(self, directory, **kwargs):
-        invite = await db_async(lambda: Invite.objects.get(directory=directory))
+        invite = await Invite.objects.select_related('group_chat').aget(directory=directory)
         if invite.kind == 'group_chat':
-            group_sends = await self.join_group_chat(invite)
+            sends, redirect_url = await self.join_group_chat(invite)
 
-        for group_send in group_sends:
-            await group_send
+        await self.group_send_many(*sends)
+        await self.send_event({
+            'action': 'redirect',
+            'url': redirect_url,
+        })
 
 
 class BacklogGroupUtils():
-    @sync_to_async
-    def mark_as_read(self):
-        self.tracker.last_backlog_seen = self.backlog_group.backlogs.last()
-        self.tracker.save()
+    """
+    The lookups of the hot paths go through the async ORM, and the rest of the
+    work of an action is done in a single sync_to_async call, so that a
+    socket doesn't queue on the database thread once per query.
+    """
+    async def mark_as_read(self):
+        await self.tracker.amark_as_read()
     
-    @sync_to_async
-    def is_mentioned(self, pk):
-        backlog = Backlog.objects.get(pk=pk)
-        user_mentioned = self.user in backlog.user_mentions.all() 
-        if user_mentioned:
+    async def is_mentioned(self, pk):
+        if await self.user.mentioned_in.filter(pk=pk).aexists():
             return True
 
-        chat = self.get_chat()
-        member = chat.memberships.filter(user=self.user).first()
-        mentioned = member.roles.all().intersection(backlog.role_mentions.all()).exists()
-        
-        return mentioned
+        # private chat memberships have no roles to mention
+        if not hasattr(self.context_member, 'roles'):
+            return False
+
+        return await self.context_member.roles.filter(mentioned_in=pk).aexists()
     
     async def send_log_to_client(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'action': event['action'],
             'html': await self.render_backlog(event['pk']),
-        }))
+        })
     
     async def send_message_to_client(self, event):
-        await self.send(text_data=json.dumps({
+        # the message itself was rendered once by the sender, only
+        # the parts that depend on this viewer are rendered here
+        message = event['message']
+        # every socket of the channel does this for each message, so it's
+        # left to the thread pool instead of waiting its turn on the thread
+        # the writes go through
+        overlay = await database_sync_to_async(render_message_overlay, thread_sensitive=False)(message, self.user, self.context_member, self.binary)
+        # sockets on the compact protocol build the message from its fields
+        if self.binary:
+            shared = {'pk': message['pk'], 'message': message['fields']}
+        else:
+            shared = {'html': message['html']}
+
+        await self.send_event({
             'action': event['action'],
             'is_sender': (event['sender'] == self.user.pk),
-            'html': await self.render_backlog(event['pk']),
-        }))
+            **shared,
+            **overlay,
+        })
 
     async def update_message_to_client(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'action': event['action'],
             'pk': event['pk'],
             'content': event['content'],
             'is_mentioned': await self.is_mentioned(event['pk']),
-            'invites': await self.render_invites(*event['invites']),
-        }))
+            'invites': await self.render_invites(*event['invites']) if event['invites'] else '',
+        })
 
     @sync_to_async
     def delete_backlog(self, pk):
@@ -384,49 +341,73 @@ class BacklogGroupUtils():
         if not backlog or backlog.group != self.backlog_group:
             return False
         
-        member = get_member_or_none(self.user, self.get_chat())
+        member = self.context_member
         if backlog.kind == 'log':
-            can_delete = member.has_perm('can_manage_backlogs')   
+            can_delete = member.has_perm('can_manage_messages')   
         elif backlog.kind == 'message':
-            can_delete = (self.user == backlog.message.user) or member.has_perm('can_manage_backlogs')
+            can_delete = (self.user == backlog.message.user) or member.has_perm('can_manage_messages')
 
         if can_delete:
             backlog.delete()
             return True
 
     @sync_to_async
-    def create_message(self, content=None, file=None):
-        if file:
-            file = base64_file(file['data'], file['name'])
+    def create_message(self, content=None, attachment=None):
+        # the attachment is the token of a finished upload, see UploadCreateView
+        upload = None
+        if attachment:
+            try:
+                upload = Upload.objects.filter(token=attachment, user=self.user, message__isnull=True).first()
+            except ValidationError:
+                pass
+
+            if upload and not upload.is_complete():
+                upload = None
+
+        if not content and not upload:
+            return None
         
-        backlog = Backlog.objects.create(kind='message', group=self.backlog_group)
-        message = Message.objects.create(user=self.user, content=content, backlog=backlog, attachment=file)
-
-        return (backlog, {
-            'role_mentions': list(*backlog.role_mentions.values_list('pk')),
-            'user_mentions': list(*backlog.user_mentions.values_list('pk')),
-        })
+        # committed once rather than once per write, the upload is linked in
+        # the same transaction so that the upload-processing worker sees the
+        # message with it
+        try:
+            with transaction.atomic():
+                if upload:
+                    # locked so that two sends of the same token can't both take it
+                    upload = Upload.objects.select_for_update().filter(pk=upload.pk, message__isnull=True).first()
+                    if not upload:
+                        return None
+
+                backlog = Backlog.objects.create(kind='message', group=self.backlog_group)
+                message = Message.objects.create(user=self.user, content=content or '', backlog=backlog, attachment=upload and upload.name)
+                if upload:
+                    upload.message = message
+                    upload.save(update_fields=['message'])
+        except IntegrityError:
+            # taken by the other send anyway, where rows can't be locked
+            return None
+
+        if upload:
+            # the upload-processing worker copies what it reads to the message
+            # if it finishes after this, otherwise it's copied over here
+            upload.refresh_from_db(fields=['width', 'height', 'thumbnails'])
+            if upload.is_processed():
+                Message.objects.filter(pk=message.pk).update(**upload.attachment_fields())
+                message.__dict__.update(upload.attachment_fields())
+
+        return backlog, render_shared_message(backlog, self.get_chat())
     
     @sync_to_async
     def render_backlog(self, pk):
         backlog = Backlog.objects.get(pk=pk)
         if backlog.kind == 'message':
-            return render_to_string('rooms/elements/message.html', {'backlog': backlog, 'user': self.user, 'chat': self.get_chat()})
+            return render_message(backlog, self.user, self.context_member, self.get_chat())
         elif backlog.kind == 'log':
             return render_to_string('rooms/elements/log.html', {'backlog': backlog, 'user': self.user})
 
     @sync_to_async
     def render_invites(self, *invites):
-        rendered_invites = []
-        for invite in invites:
-            if not invite['valid']:
-                rendered_invites.append(render_to_string('rooms/elements/backlog-invites/invalid-backlog-invite.html'))
-            elif invite['is_expired']:
-                rendered_invites.append(render_to_string('rooms/elements/backlog-invites/expired-backlog-invite.html'))
-            else:
-                rendered_invites.append(render_to_string('rooms/elements/backlog-invites/valid-backlog-invite.html', {'invite': invite, 'user': self.user}))
-            
-        return ''.join(rendered_invites)
+        return render_invites(invites, self.user)
 
     @sync_to_async
     def edit_message(self, pk, content):
@@ -452,56 +433,46 @@ class BacklogGroupUtils():
 
         return send_data
     
-    @sync_to_async
-    def create_common_attributes(self, chat):
+    async def create_common_attributes(self, chat, context_member):
+        # chat comes with its backlog group selected
         self.backlog_group = chat.backlog_group
-        self.tracker = BacklogGroupTracker.objects.get(user=self.user, backlog_group=self.backlog_group)
-        backlogs = self.backlog_group.backlogs.select_related('message__user', 'log__user1', 'log__user2').order_by('-pk')
-        self.paginator = Paginator(backlogs, 20)
-        self.current_page = self.paginator.get_page(1)
+        # the tracker of a new channel in a large chat might still be on its way, see 
+        # BacklogGroupTracker.provision_backlog_group, the consumers only get here for members
+        self.tracker, _ = await BacklogGroupTracker.objects.aget_or_create(user=self.user, backlog_group=self.backlog_group)
+        self.context_member = context_member
 
-    async def generate_backlogs(self, **kwargs):
-        if self.current_page == None:
-            return
-        
-        backlogs = self.current_page.object_list
-        html = await sync_to_async(render_to_string)(
-            template_name='rooms/elements/backlogs.html',
-            context={
-                'backlogs': backlogs, 
-                'user': self.user, 
-                'chat': await sync_to_async(self.get_chat)()
-            },
-        )
-        await self.send(json.dumps({
+    @sync_to_async
+    def render_backlog_page(self, before):
+        backlogs, cursor = self.backlog_group.get_backlog_page(before=before)
+        return render_backlogs(backlogs, self.user, self.context_member, self.get_chat()), cursor
+
+    async def generate_backlogs(self, before=None, **kwargs):
+        """
+        Sends the page of backlogs older than the `before` backlog pk,
+        or the newest page if no cursor was given.
+        """
+        if before is not None:
+            try:
+                before = int(before)
+            except (TypeError, ValueError):
+                return
+
+        html, cursor = await self.render_backlog_page(before)
+        await self.send_event({
             'type': 'send_to_client',
             'action': 'generate_backlogs',
             'html': html,
-            'page': self.current_page.number,
-        }))
-
-        await self.prepare_next_page()
-
-    @sync_to_async
-    def prepare_next_page(self):
-        if self.current_page.has_next():
-            next_page_number = self.current_page.next_page_number()
-            self.current_page = self.paginator.get_page(next_page_number)
-        else:
-            self.current_page = None
+            'initial': before is None,
+            'cursor': cursor,
+        })
         
     @sync_to_async
     def get_mentionables(self, chat, alphanumeric, numeric, kind):
         context = {}
 
         if kind == 'group_chat':
-            context['members'] = chat.memberships.filter(
-                Q(nickname__icontains=alphanumeric)
-                | Q(user__username__icontains=alphanumeric)
-            )[:10] if alphanumeric else chat.memberships.all()[:10]
-            if numeric:
-                context['members'] = filter(lambda member: numeric in member.user.formatted_username_id(), context['members'])
-            context['roles'] = chat.roles.filter(name__icontains=alphanumeric) if alphanumeric else chat.roles.all()[:10]
+            # see rooms/members.py
+            context['members'], context['roles'] = search_mentionables(chat, alphanumeric, numeric)
         elif kind == 'private_chat':
             context['members'] = chat.memberships.filter(
                 user__username__icontains=alphanumeric
@@ -511,138 +482,103 @@ class BacklogGroupUtils():
 
         return html
     
-    @sync_to_async
-    def emote_reaction(self, backlog_pk, emote_pk):
-        emote = Emote.objects.get(pk=emote_pk)
-        backlog = Backlog.objects.get(pk=backlog_pk)
-        if not emote or not backlog:
-            return
-        
-        action = self.process_reaction(reaction_kwargs={'emote': emote, 'backlog': backlog, 'kind': 'emote'})
-        send_data = {
-            'action': action,
-            'emoticon_pk': emote_pk,
-            'backlog_pk': backlog_pk,
-        }
-        if action == 'create_reaction':
-            send_data['image'] = str(emote.image)
-
-        return send_data
-
-    @sync_to_async
     def validate_react_backlog_input(self, kind, emoticon_pk, backlog_pk):
         backlog = get_object_or_none(Backlog, pk=backlog_pk)
-        if not backlog or backlog not in self.backlog_group.backlogs.all():
+        if not backlog or backlog.group_id != self.backlog_group.pk:
             return False
     
         # TODO: check if user has permission to add reactions
         
+        try:
+            emoticon_pk = int(emoticon_pk)
+        except (TypeError, ValueError):
+            return False
+
+        # see rooms/caching.py
         if kind == 'emoji':
-            emoticon = get_object_or_none(Emoji, pk=emoticon_pk)
-            if not emoticon:
-                return False
+            return get_emoji(emoticon_pk) is not None
         elif kind == 'emote':
             if not hasattr(self, 'group_chat'):
                 return False
             
-            emoticon = self.group_chat.emotes.filter(pk=emoticon_pk).first()
-            if not emoticon:
-                return False
+            return any(emote['pk'] == emoticon_pk for emote in get_emotes(self.group_chat.pk))
         
-        return True
+        return False
 
     @sync_to_async
-    def process_reaction(self, kind, emoticon_pk, backlog_pk):
-        backlog = Backlog.objects.get(pk=backlog_pk)
-    
-        if kind == 'emoji':
-            emoticon = Emoji.objects.get(pk=emoticon_pk)
-            reaction, created = Reaction.objects.get_or_create(kind=kind, backlog=backlog, emoji=emoticon)
-        elif kind == 'emote':
-            emoticon = Emote.objects.get(pk=emoticon_pk)
-            reaction, created = Reaction.objects.get_or_create(kind=kind, backlog=backlog, emote=emoticon)
-
-        if created:
-            reaction.users.add(self.user)
-            action = 'create_reaction' if reaction.users.count() == 1 else 'add_reaction'
-        else:
-            if self.user in reaction.users.all():
-                reaction.users.remove(self.user)
-                action = 'delete_reaction' if reaction.users.count() == 0 else 'remove_reaction'
-            else:
-                reaction.users.add(self.user)
-                action = 'add_reaction'
-
-        send_data = {
-            'action': action,
-            'reaction_pk': reaction.pk,
-            'sender': self.user.pk,
-        }
+    def toggle_reaction(self, kind, emoticon_pk, backlog_pk):
+        """
+        Returns the pk of the reaction and whether the user has it selected
+        now, or None if the input isn't valid.
+        """
+        if not self.validate_react_backlog_input(kind, emoticon_pk, backlog_pk):
+            return None
 
-        if action == 'create_reaction':
-            send_data['html'] = render_to_string('rooms/elements/reaction.html', context={'reaction': reaction})
-            send_data['backlog_pk'] = backlog_pk
-        elif action == 'delete_reaction':
-            reaction.delete()
-        
-        return send_data
+        reaction, selected = Reaction.toggle(backlog_pk, kind, emoticon_pk, self.user_archive)
+        return reaction.pk, selected
     
     
     async def get_emote_menu(self, **kwargs):
         @sync_to_async
         def get_emote_menu():
-            categories = [
-                'Smileys & Emotion',
-                'People & Body',
-                'Symbols',
-                'Objects',
-                'Flags',
-                'Travel & Places',
-                'Food & Drink',
-                'Activities',
-                'Component',
-                'Animals & Nature',
-            ]
-
+            # see rooms/emoji_catalog.py
             chat = self.get_chat()
-            tooltip = render_to_string('rooms/tooltips/emotes-menu/emotes-menu.html', {'chat': chat})
-            emoji_categories = [
-                render_to_string('rooms/tooltips/emotes-menu/emoji-category.html', {'emoji_list': Emoji.objects.filter(category=category), 'category': category})
-                for category in categories
-            ]
-            return tooltip, emoji_categories
+            emotes = get_emotes(chat.pk) if isinstance(chat, GroupChat) else []
+            tooltip = render_to_string('rooms/tooltips/emotes-menu/emotes-menu.html', {'chat': chat, 'emotes': emotes})
+            return tooltip, reverse('emoji-catalog', kwargs={'version': get_catalog_version()})
         
-        tooltip, emoji_categories = await get_emote_menu()
-        await self.send(json.dumps({
+        tooltip, catalog = await get_emote_menu()
+        await self.send_event({
             'action': 'build_emote_menu',
             'tooltip': tooltip,
-            'emoji_categories': emoji_categories,
-        }))
+            'catalog': catalog,
+        })
 
-    async def send_reaction_to_client(self, event):
-        send_data = {**event}
-        sender = send_data.pop('sender')
-        await self.send(text_data=json.dumps({
-            'is_sender': (sender == self.user.pk),
-            **send_data,
-        }))
+    async def send_reactions_to_client(self, event):
+        # see rooms/reactions.py, selected is left as None for the sockets of
+        # users that didn't toggle the reaction
+        reactions = []
+        for reaction in event['reactions']:
+            selected = dict(reaction['selected']).get(self.user.pk)
+            reactions.append({**reaction, 'selected': selected})
+
+        await self.send_event({
+            'action': 'update_reactions',
+            'reactions': reactions,
+        })
 
 
 class GroupChatConsumer(AppConsumer, BacklogGroupUtils):    
-    async def connect(self):
-        await super().connect()
+    async def authorize(self):
         group_chat_pk = self.scope["url_route"]['kwargs'].get('group_chat_pk')
         group_channel_pk = self.scope["url_route"]['kwargs'].get('group_channel_pk')
-        self.group_chat = await db_async(lambda: GroupChat.objects.get(pk=group_chat_pk))
-        self.membership = await db_async(lambda: self.group_chat.get_member(self.user))
+        self.group_chat = await GroupChat.objects.filter(pk=group_chat_pk).afirst()
+        if not self.group_chat:
+            return False
+
+        self.membership = await self.group_chat.memberships.filter(user=self.user).afirst()
+        if not self.membership:
+            return False
+
+        self.group_channel = None
+        if not group_channel_pk:
+            return True
+
+        self.group_channel = await GroupChannel.objects.select_related('backlog_group').filter(pk=group_channel_pk, chat=self.group_chat).afirst()
+        # see rooms/channel_tree.py
+        return bool(self.group_channel) and await sync_to_async(can_see_channel)(self.membership, self.group_channel.pk)
+
+    async def connect(self):
+        if not await super().connect():
+            return
+
         await self.channel_layer.group_add(f'group_chat_{self.group_chat.pk}', self.channel_name)
         await self.channel_layer.group_add(f'group_chat_{self.group_chat.pk}_user_{self.user.pk}', self.channel_name)
 
-        if not group_channel_pk:
+        if not self.group_channel:
             return
         
-        self.group_channel = await db_async(lambda: GroupChannel.objects.get(pk=group_channel_pk))
-        await self.create_common_attributes(self.group_channel)
+        await self.create_common_attributes(self.group_channel, self.membership)
         await self.channel_layer.group_add(f'group_channel_{self.group_channel.pk}', self.channel_name)
         await self.channel_layer.group_add(f'group_channel_{self.group_channel.pk}_user_{self.user.pk}', self.channel_name)
         await self.generate_backlogs()
@@ -650,78 +586,77 @@ class GroupChatConsumer(AppConsumer, BacklogGroupUtils):
     def get_chat(self):
         return self.group_chat
 
+    async def get_member_list(self, start=0, **kwargs):
+        """
+        Sends the window of the member list starting at the `start` row,
+        see rooms/members.py.
+        """
+        start = int(start)
+        member_list = await sync_to_async(render_member_list)(self.group_chat, start, start + WINDOW)
+        await self.send_event({
+            'action': 'get_member_list',
+            **member_list,
+        })
+
     async def get_mentionables(self, mention, **kwargs):
-        alphanumeric, numeric = await process_mention(mention)
+        alphanumeric, numeric = process_mention(mention)
         html = await super().get_mentionables(self.group_chat, alphanumeric, numeric, kind='group_chat')
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'action': 'get_mentionables',
             'html': html,
-        }))
+        })
 
-    async def create_message(self, content=None, file=None, **kwargs):
-        if not content and not file:
+    async def create_message(self, content=None, attachment=None, **kwargs):
+        created = await super().create_message(content=content, attachment=attachment)
+        if not created:
             return
 
-        backlog, mentions = await super().create_message(content=content, file=file)
+        backlog, message = created
 
         await self.channel_layer.group_send(
             f'group_channel_{self.group_channel.pk}', {
                 'type': 'send_message_to_client',
                 'action': 'create_message',
-                'pk': backlog.pk,
+                'message': message,
                 'sender': self.user.pk,
             }
         )
 
-        await self.channel_layer.group_send(
-            f'backlog_group_{self.backlog_group.pk}', {
-                'type': 'create_new_backlog_notification',
-                'backlog_iso_date': backlog.date_created.isoformat(),
-                'target_backlog_group': self.backlog_group.pk,
-                'sender': self.user.pk,
-                'notification_type': 'group_chat_notification',
-                'group_channel': self.group_channel.pk,
-                'group_chat': self.group_chat.pk,
-                **mentions,
-            }
+        notification_dispatcher.schedule(
+            backlog,
+            sender=self.user.pk,
+            target={'group_chat': self.group_chat.pk, 'group_channel': self.group_channel.pk},
+            user_mentions=message['user_mentions'],
+            role_mentions=message['role_mentions'],
         )
 
     async def mark_as_read(self, **kwargs):
         await super().mark_as_read()
 
-        await self.channel_layer.group_send(
-            f'user_{self.user.pk}', {
+        await self.group_send_many(
+            (f'user_{self.user.pk}', {
                 'type': 'send_to_client',
                 'action': 'remove_notification',
                 'id': f'group-chat-{self.group_chat.pk}',
                 'notification_id': f'backlog-group-{self.backlog_group.pk}-unreads',
                 'kind': 'hidden',
-            }
-        )
-
-        await self.channel_layer.group_send(
-            f'user_{self.user.pk}', {
+            }),
+            (f'user_{self.user.pk}', {
                 'type': 'send_to_client',
                 'action': 'remove_notification',
                 'id': f'group-chat-{self.group_chat.pk}',
                 'notification_id': f'backlog-group-{self.backlog_group.pk}-mentions',
                 'kind': 'visible',
-            }
-        )
-
-        await self.channel_layer.group_send(
-            f'group_chat_{self.group_chat.pk}_user_{self.user.pk}', {
+            }),
+            (f'group_chat_{self.group_chat.pk}_user_{self.user.pk}', {
                 'type': 'send_to_client',
                 'action': 'remove_all_notifications',
                 'id': f'group-channel-{self.group_channel.pk}'
-            }
-        )
-
-        await self.channel_layer.group_send(
-            f'group_channel_{self.group_channel.pk}_user_{self.user.pk}', {
+            }),
+            (f'group_channel_{self.group_channel.pk}_user_{self.user.pk}', {
                 'type': 'send_to_client',
                 'action': 'mark_as_read',
-            }
+            }),
         )
 
     async def delete_backlog(self, pk, action, **kwargs):
@@ -748,17 +683,12 @@ class GroupChatConsumer(AppConsumer, BacklogGroupUtils):
         await self.channel_layer.group_send(f'group_channel_{self.group_channel.pk}', send_data)
 
     async def react_backlog(self, kind, emoticon_pk, backlog_pk, **kwargs):
-        input_is_valid = await super().validate_react_backlog_input(kind, emoticon_pk, backlog_pk)
-        if not input_is_valid:
+        toggled = await super().toggle_reaction(kind, emoticon_pk, backlog_pk)
+        if not toggled:
             return
-        
-        send_data = await super().process_reaction(kind, emoticon_pk, backlog_pk)
-        await self.channel_layer.group_send(
-            f'group_channel_{self.group_channel.pk}', {
-                'type': 'send_reaction_to_client',
-                **send_data
-            }
-        )
+
+        reaction_pk, selected = toggled
+        reaction_dispatcher.schedule(f'group_channel_{self.group_channel.pk}', reaction_pk, self.user.pk, selected)
 
     async def leave_group_chat(self, **kwargs):
         @sync_to_async
@@ -769,47 +699,52 @@ class GroupChatConsumer(AppConsumer, BacklogGroupUtils):
             log = Log.objects.create(backlog=backlog, action='leave', user1=self.user)
             membership.delete()
 
-            return [
-                self.channel_layer.group_send(
-                    f'group_chat_{self.group_chat.pk}', {
-                        'type': 'send_log_to_client',
-                        'action': 'create_log',
-                        'pk': backlog.pk,
-                    }
-                ),
-                self.channel_layer.group_send(
-                    f'user_{self.user.pk}', {
-                        'type': 'send_to_client',
-                        'action': 'leave_group_chat',
-                        'pk': self.group_chat.pk,
-                    }
-                ),
-                self.send(text_data=json.dumps({
-                    'action': 'redirect',
-                    'url': reverse('dashboard')
-                })),
-            ]
-        
-        for send in await leave_group_chat():
-            await send
+            return backlog
+
+        backlog = await leave_group_chat()
+        await self.group_send_many(
+            (f'group_chat_{self.group_chat.pk}', {
+                'type': 'send_log_to_client',
+                'action': 'create_log',
+                'pk': backlog.pk,
+            }),
+            (f'user_{self.user.pk}', {
+                'type': 'send_to_client',
+                'action': 'leave_group_chat',
+                'pk': self.group_chat.pk,
+            }),
+        )
+        await self.send_event({
+            'action': 'redirect',
+            'url': reverse('dashboard')
+        })
 
     async def send_category_to_client(self, event):
-        await self.send(json.dumps({
+        await self.send_event({
             'action': 'create_group_category',
             'html': await sync_to_async(render_to_string)(template_name='rooms/elements/category.html', context={
                 'category': event['category'], 
-                'created': True,
+                'group_chat': self.group_chat,
                 'context_member': self.membership
             }),
-        }))
+        })
 
 
 class PrivateChatConsumer(AppConsumer, BacklogGroupUtils):
-    async def connect(self):
-        await super().connect()
+    async def authorize(self):
         private_chat_pk = self.scope["url_route"]['kwargs'].get('private_chat_pk')
-        self.private_chat = await db_async(lambda: PrivateChat.objects.get(pk=private_chat_pk))
-        await self.create_common_attributes(self.private_chat)
+        self.private_chat = await PrivateChat.objects.select_related('backlog_group').filter(pk=private_chat_pk).afirst()
+        if not self.private_chat:
+            return False
+
+        self.membership = await self.private_chat.memberships.filter(user=self.user).afirst()
+        return bool(self.membership)
+
+    async def connect(self):
+        if not await super().connect():
+            return
+
+        await self.create_common_attributes(self.private_chat, self.membership)
         await self.channel_layer.group_add(f'private_chat_{self.private_chat.pk}', self.channel_name)
         await self.channel_layer.group_add(f'private_chat_{self.private_chat.pk}_user_{self.user.pk}', self.channel_name)
         await self.generate_backlogs()
@@ -820,93 +755,80 @@ class PrivateChatConsumer(AppConsumer, BacklogGroupUtils):
     async def mark_as_read(self, **kwargs):
         await super().mark_as_read()
 
-        await self.channel_layer.group_send(
-            f'user_{self.user.pk}_self', {
+        await self.group_send_many(
+            (f'user_{self.user.pk}_self', {
                 'type': 'send_to_client',
                 'action': 'remove_notification',
                 'id': f'private-chat-{self.private_chat.pk}',
                 'notification_id': f'backlog-group-{self.backlog_group}',
                 'kind': 'hidden',
-            }
-        )
-
-        await self.channel_layer.group_send(
-            f'private_chat_{self.private_chat.pk}_user_{self.user.pk}', {
+            }),
+            (f'private_chat_{self.private_chat.pk}_user_{self.user.pk}', {
                 'type': 'send_to_client',
                 'action': 'mark_as_read',
-            }
-        )
-
-        await self.channel_layer.group_send(
-            f'user_{self.user.pk}', {
+            }),
+            (f'user_{self.user.pk}', {
                 'type': 'send_to_client',
                 'action': 'remove_notification',
                 'id': f'dashboard-button',
                 'notification_id': f'backlog-group-{self.backlog_group.pk}-unreads',
                 'kind': 'visible',
-            }
+            }),
         )
 
-    async def create_message(self, content, file=None, **kwargs):
+    async def create_message(self, content=None, attachment=None, **kwargs):
         @sync_to_async
-        def users_to_activate():
-            return [(membership.user, membership) for membership in self.private_chat.memberships.all() if membership.activate()]
+        def activate_private_chat():
+            users = [membership.user for membership in self.private_chat.memberships.select_related('user') if membership.activate()]
+            if not users:
+                return []
 
-        if not content:
+            html = render_to_string('rooms/elements/sidebar-users/private-chat.html', {'local_private_chat': self.private_chat, 'other_party': {'user': self.user}})
+            return [(f'user_{user.pk}_self', {
+                'type': 'send_to_client',
+                'action': 'activate_private_chat',
+                'html': html,
+            }) for user in users]
+
+        created = await super().create_message(content=content, attachment=attachment)
+        if not created:
             return
+
+        backlog, message = created
         
-        backlog = await super().create_message(content)
-        
-        await self.channel_layer.group_send(
-            f'private_chat_{self.private_chat.pk}', {
+        sends = [
+            (f'private_chat_{self.private_chat.pk}', {
                 'type': 'send_message_to_client',
                 'action': 'create_message',
-                'pk': backlog.pk,
+                'message': message,
                 'sender': self.user.pk,
-            }
-        )
+            }),
+        ]
         
-        for user, membership in await users_to_activate():
-            await self.channel_layer.group_send(
-                f'user_{user.pk}_self', {
-                    'type': 'send_to_client',
-                    'action': 'activate_private_chat',
-                    'html': await sync_to_async(render_to_string)('rooms/elements/sidebar-users/private-chat.html', {'local_private_chat': self.private_chat, 'other_party': {'user': self.user}})
-                }
-            )
-
-        for user in await database_sync_to_async(self.private_chat.user_list)():
-            await self.channel_layer.group_send(
-                f'user_{user.pk}', {
-                    'type': 'create_new_backlog_notification',
-                    'backlog_iso_date': backlog.date_created.isoformat(),
-                    'target_backlog_group': self.backlog_group.pk,
-                    'sender': self.user.pk,
-                    'notification_type': 'private_chat_notification',
-                    'private_chat': self.private_chat.pk
-                }
-            )
+        sends.extend(await activate_private_chat())
+        await self.group_send_many(*sends)
+
+        notification_dispatcher.schedule(
+            backlog,
+            sender=self.user.pk,
+            target={'private_chat': self.private_chat.pk},
+        )
 
     async def get_mentionables(self, mention, **kwargs):
-        username, username_id = await process_mention(mention)
+        username, username_id = process_mention(mention)
         html = await super().get_mentionables(self.private_chat, username, username_id, kind='private_chat')
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'action': 'get_mentionables',
             'html': html,
-        }))
+        })
 
     async def react_backlog(self, kind, emoticon_pk, backlog_pk, **kwargs):
-        input_is_valid = await super().validate_react_backlog_input(kind, emoticon_pk, backlog_pk)
-        if not input_is_valid:
+        toggled = await super().toggle_reaction(kind, emoticon_pk, backlog_pk)
+        if not toggled:
             return
-        
-        send_data = await super().process_reaction(kind, emoticon_pk, backlog_pk)
-        await self.channel_layer.group_send(
-            f'private_chat_{self.private_chat.pk}', {
-                'type': 'send_reaction_to_client',
-                **send_data
-            }
-        )
+
+        reaction_pk, selected = toggled
+        reaction_dispatcher.schedule(f'private_chat_{self.private_chat.pk}', reaction_pk, self.user.pk, selected)
 
     async def edit_message(self, pk, content, action, **kwargs):
         if not content:
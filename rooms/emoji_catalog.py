@@ -0,0 +1,103 @@
+"""
+The emoji picker's data.
+
+The global emojis are compiled into a JSON bundle named after the hash of
+its content, served by EmojiCatalogView with headers that let the browser
+keep it forever, since a change gives it a new name. The picker is sent the
+name of the current bundle, and the emotes of the chat as a small overlay
+from rooms/caching.py, so that opening it doesn't touch the database.
+
+The bundle is compiled by create_emojis, and again on the next picker
+opened after an emoji is changed, see rooms/signals.py.
+"""
+import json
+import hashlib
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .models import Emoji
+
+
+CATEGORIES = [
+    'Smileys & Emotion',
+    'People & Body',
+    'Symbols',
+    'Objects',
+    'Flags',
+    'Travel & Places',
+    'Food & Drink',
+    'Activities',
+    'Component',
+    'Animals & Nature',
+]
+
+DIRECTORY = 'emoji-catalog'
+MANIFEST = f'{DIRECTORY}/manifest.json'
+VERSION_KEY = 'emoji-catalog:version'
+# set as the version when an emoji changes
+STALE = 'stale'
+
+# version -> content, the bundles this process has read
+_bundles = {}
+
+
+def bundle_name(version):
+    return f'{DIRECTORY}/{version}.json'
+
+
+def build_catalog():
+    emojis = {category: [] for category in CATEGORIES}
+    rows = Emoji.objects.filter(category__in=CATEGORIES).order_by('pk').values_list('category', 'pk', 'name', 'image')
+    for category, pk, name, image in rows:
+        emojis[category].append([pk, name, default_storage.url(image)])
+
+    return {'categories': [{'name': category, 'emojis': emojis[category]} for category in CATEGORIES]}
+
+
+def compile_catalog():
+    content = json.dumps(build_catalog(), separators=(',', ':')).encode()
+    version = hashlib.sha256(content).hexdigest()[:16]
+    if not default_storage.exists(bundle_name(version)):
+        default_storage.save(bundle_name(version), ContentFile(content))
+
+    # the manifest tells other processes which bundle is current
+    default_storage.delete(MANIFEST)
+    default_storage.save(MANIFEST, ContentFile(json.dumps({'version': version}).encode()))
+    cache.set(VERSION_KEY, version, timeout=None)
+    _bundles[version] = content
+    return version
+
+
+def invalidate_catalog():
+    cache.set(VERSION_KEY, STALE, timeout=None)
+
+
+def get_catalog_version():
+    version = cache.get(VERSION_KEY)
+    if version == STALE:
+        version = compile_catalog()
+    elif version is None:
+        if default_storage.exists(MANIFEST):
+            with default_storage.open(MANIFEST) as file:
+                version = json.load(file)['version']
+            cache.set(VERSION_KEY, version, timeout=None)
+        else:
+            version = compile_catalog()
+
+    return version
+
+
+def read_catalog(version):
+    """
+    Returns the content of the bundle, or None if there is no such bundle.
+    """
+    if version not in _bundles:
+        if not version.isalnum() or not default_storage.exists(bundle_name(version)):
+            return None
+
+        with default_storage.open(bundle_name(version)) as file:
+            _bundles[version] = file.read()
+
+    return _bundles[version]
@@ -0,0 +1,60 @@
+"""
+Versions of the rendered messages.
+
+The parts of a message that look the same to every viewer (the author with
+their color, the content, the attachment and the reactions) are rendered
+once and cached under the backlog pk, the backlog's version and the
+versions of what its author looks like, see rendering.get_fragments. The
+backlog's version is bumped when the message is edited, its attachment
+processed or its reactions toggled.
+
+In group chats the author's look is split between the chat's appearance
+version, bumped when the roles or their order change the colors, and the
+version of the author in the chat, bumped when their nickname, roles, name
+or image change. So people joining, leaving or renaming themselves only
+affect their own messages. Private chats only have the chat's version, their
+authors rarely change.
+
+The versions are kept by rooms/versions.py.
+"""
+from . import versions
+
+
+BACKLOG_VERSION = 'backlog'
+PRIVATE_CHAT_VERSION = 'private-chat'
+APPEARANCE_VERSION = 'chat-appearance'
+AUTHOR_VERSION = 'chat-author'
+
+
+def get_backlog_versions(backlog_pks):
+    return versions.get_versions(BACKLOG_VERSION, backlog_pks)
+
+
+def get_private_chat_version(chat_pk):
+    return versions.get_version(PRIVATE_CHAT_VERSION, chat_pk)
+
+
+def get_appearance_version(chat_pk):
+    return versions.get_version(APPEARANCE_VERSION, chat_pk)
+
+
+def get_author_versions(chat_pk, user_pks):
+    author_pks = {f'{chat_pk}-{user_pk}': user_pk for user_pk in user_pks}
+    return {author_pks[author_pk]: version for author_pk, version in versions.get_versions(AUTHOR_VERSION, author_pks).items()}
+
+
+def invalidate_backlog(backlog_pk):
+    versions.bump(BACKLOG_VERSION, backlog_pk)
+
+
+def invalidate_private_chat(chat_pk):
+    versions.bump(PRIVATE_CHAT_VERSION, chat_pk)
+
+
+def invalidate_appearance(chat_pk):
+    versions.bump(APPEARANCE_VERSION, chat_pk)
+
+
+def invalidate_authors(chat_pk, user_pks):
+    for user_pk in user_pks:
+        versions.bump(AUTHOR_VERSION, f'{chat_pk}-{user_pk}')
@@ -0,0 +1,91 @@
+"""
+Shared helpers for the benchmark_* management commands.
+
+Every benchmark builds its own throwaway data inside a transaction
+that is rolled back once it's done, so they can be run against
+any database without leaving anything behind.
+"""
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from rooms.models import GroupChat, GroupChatMembership, Role
+from users.models import CustomUser
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextmanager
+def throwaway_data():
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback
+    except Rollback:
+        pass
+
+
+def create_user(name):
+    return CustomUser.objects.create(
+        username=name,
+        username_id=0,
+        email=f'{name}@benchmark.local',
+        birthday=datetime.now(timezone.utc),
+    )
+
+
+def create_group_chat(member_count, name='benchmark'):
+    owner = create_user(f'{name}owner')
+    group_chat = GroupChat(name=name, owner=owner)
+    group_chat.save()
+
+    members = [group_chat.get_member(owner)]
+    for i in range(member_count - 1):
+        user = create_user(f'{name}{i}')
+        members.append(GroupChatMembership.objects.create(user=user, chat=group_chat))
+
+    return group_chat, members
+
+
+def bulk_create_members(group_chat, member_count, name='benchmark', batch_size=5000):
+    """
+    Adds member_count members to the chat without going through their
+    save(), for benchmarks that need chats too large to create one by one.
+    The users don't get archives and the members don't get trackers.
+    """
+    users = CustomUser.objects.bulk_create([
+        CustomUser(
+            username=f'{name}{i}',
+            username_id=i % 100,
+            email=f'{name}{i}@benchmark.local',
+            birthday=datetime.now(timezone.utc),
+        )
+        for i in range(member_count)
+    ], batch_size=batch_size)
+    memberships = GroupChatMembership.objects.bulk_create([
+        GroupChatMembership(user=user, chat=group_chat) for user in users
+    ], batch_size=batch_size)
+    Role.members.through.objects.bulk_create([
+        Role.members.through(role_id=group_chat.base_role_id, groupchatmembership_id=membership.pk)
+        for membership in memberships
+    ], batch_size=batch_size)
+
+    return memberships
+
+
+def measure(fn, repeat=1):
+    """
+    Return the average seconds and database queries per call of fn.
+    """
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        elapsed = time.perf_counter() - start
+
+    return elapsed / repeat, len(queries) / repeat
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from rooms.consumers import GroupChatConsumer
+from users.models import CustomUser
+from ._benchmarks import create_group_chat
+
+
+NAME = 'consumerbenchmark'
+
+
+def with_scope(application, **scope):
+    """
+    Stands in for the auth and cookie middleware.
+    """
+    async def app(base_scope, receive, send):
+        return await application({**base_scope, **scope}, receive, send)
+
+    return app
+
+
+class Command(BaseCommand):
+    """
+    Unlike the other benchmarks, the consumers do their database work on
+    other threads with their own connections, so the data is committed and
+    deleted again at the end rather than rolled back.
+    """
+    help = 'Measures how many messages per second one worker relays between the sockets of a group channel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=20)
+        parser.add_argument('--messages', type=int, default=10, help='sent by each socket')
+        parser.add_argument('--latency', type=float, default=0.0, help='simulated database round-trip in milliseconds')
+
+    def handle(self, *args, **options):
+        latency = options['latency'] / 1000
+
+        def add_latency(execute, sql, params, many, context):
+            time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        def on_connection_created(connection, **kwargs):
+            # connections of the threads are reopened on every hop
+            if add_latency not in connection.execute_wrappers:
+                connection.execute_wrappers.append(add_latency)
+
+        group_chat, members = create_group_chat(options['sockets'], name=NAME)
+        users = [member.user for member in members]
+        group_channel = group_chat.channels.first()
+        if latency:
+            connection_created.connect(on_connection_created)
+
+        layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 100000}}}
+        try:
+            with override_settings(CHANNEL_LAYERS=layers):
+                asyncio.run(self.run(group_chat, group_channel, users, options['messages']))
+        finally:
+            connection_created.disconnect(on_connection_created)
+            group_chat.delete()
+            CustomUser.objects.filter(username__startswith=NAME).delete()
+
+    async def run(self, group_chat, group_channel, users, message_count):
+        path = f'/ws/app/group-chat/{group_chat.pk}/{group_channel.pk}/'
+        kwargs = {'group_chat_pk': group_chat.pk, 'group_channel_pk': group_channel.pk}
+
+        start = time.perf_counter()
+        communicators = []
+        for user in users:
+            application = with_scope(GroupChatConsumer.as_asgi(), user=user, cookies={'csrftoken': NAME}, url_route={'kwargs': kwargs})
+            communicators.append(WebsocketCommunicator(application, path))
+
+        async def connect(communicator):
+            await communicator.connect(timeout=60)
+            # the first page of backlogs
+            await communicator.receive_json_from(timeout=60)
+
+        await asyncio.gather(*(connect(communicator) for communicator in communicators))
+        connect_seconds = time.perf_counter() - start
+
+        total = len(users) * message_count
+
+        async def send(communicator):
+            for i in range(message_count):
+                await communicator.send_json_to({'action': 'create_message', 'content': f'benchmark {i}'})
+
+        async def receive(communicator):
+            received = 0
+            while received < total:
+                event = await communicator.receive_json_from(timeout=60)
+                if event['action'] == 'create_message':
+                    received += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(send(communicator) for communicator in communicators),
+            *(receive(communicator) for communicator in communicators),
+        )
+        message_seconds = time.perf_counter() - start
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        self.stdout.write(f'{len(users)} sockets connected in {connect_seconds * 1000:.0f}ms, {len(users) / connect_seconds:.1f} connects/s')
+        self.stdout.write(
+            f'{total} messages to {len(users)} sockets in {message_seconds * 1000:.0f}ms, '
+            f'{total / message_seconds:.1f} messages/s, {total * len(users) / message_seconds:.0f} deliveries/s'
+        )
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from rooms.models import Backlog, Message
+from rooms.rendering import render_message, render_shared_message, render_message_overlay
+from ._benchmarks import throwaway_data, create_group_chat, measure
+
+
+class Command(BaseCommand):
+    help = 'Compares the per message cost of rendering a new message for every subscriber against rendering it once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', nargs='+', type=int, default=[1, 10, 100, 500])
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"subscribers":>12} {"per-viewer ms":>14} {"queries":>8} {"render-once ms":>15} {"queries":>8}')
+
+        for subscriber_count in options['subscribers']:
+            with throwaway_data():
+                group_chat, members = create_group_chat(subscriber_count)
+                channel = group_chat.channels.first()
+                backlog = Backlog.objects.create(kind='message', group=channel.backlog_group)
+                Message.objects.create(user=members[0].user, content='benchmark message', backlog=backlog)
+
+                def per_viewer():
+                    for member in members:
+                        fetched_backlog = Backlog.objects.get(pk=backlog.pk)
+                        render_message(fetched_backlog, member.user, member, group_chat)
+
+                def render_once():
+                    payload = render_shared_message(backlog, group_chat)
+                    for member in members:
+                        render_message_overlay(payload, member.user, member)
+
+                per_viewer_seconds, per_viewer_queries = measure(per_viewer)
+                render_once_seconds, render_once_queries = measure(render_once)
+
+            self.stdout.write(
+                f'{subscriber_count:>12} {per_viewer_seconds * 1000:>14.1f} {per_viewer_queries:>8.0f} '
+                f'{render_once_seconds * 1000:>15.1f} {render_once_queries:>8.0f}'
+            )
@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.management.base import BaseCommand
+
+from rooms.broadcast import group_send_many
+
+
+class LatencyChannelLayer(InMemoryChannelLayer):
+    """
+    Stands in for Redis by adding a round-trip delay to every group_send.
+    """
+    def __init__(self, latency, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    async def group_send(self, group, message):
+        await asyncio.sleep(self.latency)
+        await super().group_send(group, message)
+
+
+class Command(BaseCommand):
+    help = 'Compares sending the events of an action one after the other against group_send_many.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sends', nargs='+', type=int, default=[1, 3, 4, 10])
+        parser.add_argument('--latency', type=float, default=1.0, help='simulated round-trip in milliseconds')
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--configured', action='store_true', help='use the configured channel layer instead of the stand-in')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        if options['configured']:
+            channel_layer = get_channel_layer()
+        else:
+            channel_layer = LatencyChannelLayer(options['latency'] / 1000)
+
+        self.stdout.write(f'{"sends":>6} {"sequential ms":>14} {"group_send_many ms":>19}')
+
+        for send_count in options['sends']:
+            sends = [(f'benchmark_{i}', {'type': 'send_to_client', 'action': 'benchmark'}) for i in range(send_count)]
+
+            async def sequential():
+                for group, event in sends:
+                    await channel_layer.group_send(group, event)
+
+            async def batched():
+                await group_send_many(channel_layer, sends)
+
+            sequential_seconds = await self.measure(sequential, options['repeat'])
+            batched_seconds = await self.measure(batched, options['repeat'])
+            self.stdout.write(f'{send_count:>6} {sequential_seconds * 1000:>14.2f} {batched_seconds * 1000:>19.2f}')
+
+    async def measure(self, fn, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await fn()
+        return (time.perf_counter() - start) / repeat
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from rooms.models import GroupChat
+from rooms.members import build_index, get_index, search_mentionables
+from ._benchmarks import throwaway_data, create_user, bulk_create_members, measure
+
+
+def search_with_queries(chat, alphanumeric, numeric):
+    # how get_mentionables searched before the index
+    members = list(chat.memberships.filter(
+        Q(nickname__icontains=alphanumeric)
+        | Q(user__username__icontains=alphanumeric)
+    ).select_related('user')[:10])
+    if numeric:
+        members = [member for member in members if numeric in member.user.formatted_username_id()]
+    roles = list(chat.roles.filter(name__icontains=alphanumeric))
+    return members, roles
+
+
+class Command(BaseCommand):
+    help = 'Compares completing mentions with queries against the per-chat prefix index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        mentions = [('b', None), ('benchmark4', None), ('benchmark4242', '42'), ('nobody', None)]
+
+        with throwaway_data():
+            owner = create_user('benchmarkowner')
+            group_chat = GroupChat(name='benchmark', owner=owner)
+            group_chat.save()
+            bulk_create_members(group_chat, options['members'] - 1)
+
+            build_seconds, build_queries = measure(lambda: build_index(group_chat))
+            # warm the index
+            search_mentionables(group_chat)
+            self.stdout.write(f'index of {options["members"]} members built in {build_seconds * 1000:.0f}ms, {build_queries:.0f} queries')
+
+            membership = group_chat.memberships.last()
+
+            def rename():
+                membership.nickname = 'renamed' if membership.nickname != 'renamed' else ''
+                membership.save()
+                get_index(group_chat)
+
+            rename_seconds, rename_queries = measure(rename, repeat=options['repeat'])
+            self.stdout.write(f'renaming a member updates it in {rename_seconds * 1000:.2f}ms, {rename_queries:.0f} queries including the save')
+            self.stdout.write(f'{"mention":>16} {"queries µs":>11} {"queries":>8} {"index µs":>9} {"queries":>8}')
+
+            for alphanumeric, numeric in mentions:
+                query_seconds, query_queries = measure(lambda: search_with_queries(group_chat, alphanumeric, numeric), repeat=max(options['repeat'] // 20, 1))
+                index_seconds, index_queries = measure(lambda: search_mentionables(group_chat, alphanumeric, numeric), repeat=options['repeat'])
+                mention = f'>>{alphanumeric}' + (f'#{numeric}' if numeric else '')
+                self.stdout.write(
+                    f'{mention:>16} {query_seconds * 1e6:>11.0f} {query_queries:>8.0f} '
+                    f'{index_seconds * 1e6:>9.1f} {index_queries:>8.0f}'
+                )
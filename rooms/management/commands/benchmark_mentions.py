@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from rooms.models import Backlog, Message
+from ._benchmarks import throwaway_data, create_group_chat, measure
+
+
+class Command(BaseCommand):
+    help = 'Measures the cost of saving a message with a growing number of mentions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mentions', nargs='+', type=int, default=[0, 5, 50])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"mentions":>9} {"ms/message":>11} {"queries":>8}')
+
+        for mention_count in options['mentions']:
+            with throwaway_data():
+                group_chat, members = create_group_chat(max(mention_count, 1))
+                channel = group_chat.channels.first()
+                mentions = ' '.join(f'>>{member.user.full_name()}' for member in members[:mention_count])
+                content = f'benchmark message {mentions}'
+
+                def save_message():
+                    backlog = Backlog.objects.create(kind='message', group=channel.backlog_group)
+                    Message.objects.create(user=members[0].user, content=content, backlog=backlog)
+
+                seconds, queries = measure(save_message, repeat=options['repeat'])
+
+            self.stdout.write(f'{mention_count:>9} {seconds * 1000:>11.2f} {queries:>8.0f}')
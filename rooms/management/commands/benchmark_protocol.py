@@ -0,0 +1,88 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from rooms import protocol
+from rooms.models import Backlog, Message
+from rooms.rendering import render_shared_message, render_message_overlay, render_backlogs
+from ._benchmarks import throwaway_data, create_group_chat
+
+
+class Command(BaseCommand):
+    help = 'Compares the size and encoding time of websocket events in JSON and in the compact protocol.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        with throwaway_data():
+            events = self.build_events()
+
+        self.stdout.write(f'{"event":>22} {"json bytes":>11} {"msgpack bytes":>14} {"json us":>8} {"msgpack us":>11}')
+        for name, event, compact_event in events:
+            json_bytes = len(json.dumps(event).encode())
+            msgpack_bytes = len(protocol.encode(compact_event))
+            json_seconds = self.measure(lambda: json.dumps(event).encode(), options['repeat'])
+            msgpack_seconds = self.measure(lambda: protocol.encode(compact_event), options['repeat'])
+            self.stdout.write(
+                f'{name:>22} {json_bytes:>11} {msgpack_bytes:>14} '
+                f'{json_seconds * 1e6:>8.2f} {msgpack_seconds * 1e6:>11.2f}'
+            )
+
+    def build_events(self):
+        """
+        Returns (name, event as sent in JSON, event as sent on the compact
+        protocol), which only differ for the messages that the compact
+        protocol sends as fields, see GroupChatConsumer.send_message_to_client.
+        """
+        group_chat, members = create_group_chat(2)
+        member = members[1]
+        channel = group_chat.channels.first()
+        for i in range(20):
+            backlog = Backlog.objects.create(kind='message', group=channel.backlog_group)
+            Message.objects.create(user=members[0].user, content=f'benchmark message {i}', backlog=backlog)
+
+        payload = render_shared_message(backlog, group_chat)
+        backlogs, cursor = channel.backlog_group.get_backlog_page()
+        backlog_group = channel.backlog_group.pk
+
+        events = [
+            ('create_message', {
+                'action': 'create_message',
+                'is_sender': False,
+                'html': payload['html'],
+                **render_message_overlay(payload, member.user, member),
+            }, {
+                'action': 'create_message',
+                'is_sender': False,
+                'pk': payload['pk'],
+                'message': payload['fields'],
+                **render_message_overlay(payload, member.user, member, structured=True),
+            }),
+            ('generate_backlogs', {
+                'action': 'generate_backlogs',
+                'html': render_backlogs(backlogs, member.user, member, group_chat),
+                'initial': True,
+                'cursor': cursor,
+            }),
+            ('create_notifications', {
+                'action': 'create_notifications',
+                'notifications': [
+                    {'id': f'group-chat-{group_chat.pk}', 'notification_id': f'backlog-group-{backlog_group}-unreads', 'kind': 'hidden', 'count': 3},
+                    {'id': f'group-chat-{group_chat.pk}', 'notification_id': f'backlog-group-{backlog_group}-mentions', 'kind': 'visible', 'count': 1},
+                ],
+            }),
+            ('mark_as_read', {
+                'type': 'send_to_client',
+                'action': 'mark_as_read',
+            }),
+        ]
+
+        return [event if len(event) == 3 else (*event, event[1]) for event in events]
+
+    def measure(self, fn, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        return (time.perf_counter() - start) / repeat
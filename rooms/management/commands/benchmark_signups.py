@@ -0,0 +1,76 @@
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection, IntegrityError
+from django.test.utils import override_settings
+
+from core.models import Archive
+from users.models import CustomUser, UserArchive
+
+
+def save_with_scan(user):
+    # how SignupView and create_user picked the id before the allocator
+    existing_username_ids = CustomUser.objects.filter(
+        username=user.username
+    ).values_list('username_id', flat=True)
+    free_ids = [value for value in range(0, 100) if value not in existing_username_ids]
+    if not free_ids:
+        raise ValueError
+    user.username_id = free_ids.pop(0)
+    user.save()
+
+
+class Command(BaseCommand):
+    help = (
+        'Signs up bursts of users with the same username from several threads at once, '
+        'comparing the old id scan against the allocator. Cleans up the users afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--signups', type=int, default=60)
+        parser.add_argument('--threads', type=int, default=8)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"allocator":>10} {"signups":>8} {"ms total":>9} {"ms/signup":>10} {"failed":>7}')
+        allocators = {
+            'scan': save_with_scan,
+            'allocator': CustomUser.objects.save_with_username_id,
+        }
+
+        for name, save in allocators.items():
+            username = f'burst{name}'
+
+            def signup(i):
+                user = CustomUser(
+                    username=username,
+                    email=f'{username}{i}@benchmark.local',
+                    birthday=datetime.now(timezone.utc),
+                )
+                user.set_password('benchmark')
+                try:
+                    save(user)
+                    return True
+                except (IntegrityError, ValueError):
+                    return False
+                finally:
+                    connection.close()
+
+            # hashing isn't what's being measured
+            with override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']):
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                    results = list(executor.map(signup, range(options['signups'])))
+                elapsed = time.perf_counter() - start
+
+            user_archives = UserArchive.objects.filter(user__username=username)
+            archive_pks = list(user_archives.values_list('archive', flat=True))
+            user_archives.delete()
+            Archive.objects.filter(pk__in=archive_pks).delete()
+            CustomUser.objects.filter(username=username).delete()
+
+            self.stdout.write(
+                f'{name:>10} {options["signups"]:>8} {elapsed * 1000:>9.0f} '
+                f'{elapsed * 1000 / options["signups"]:>10.2f} {results.count(False):>7}'
+            )
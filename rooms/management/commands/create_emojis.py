@@ -1,29 +1,146 @@
 import os
 import json
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.core.management.base import BaseCommand, CommandError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils.text import get_valid_filename
 from rooms.models import Emoji
+from rooms.emoji_catalog import compile_catalog
 
 from DjangoChatApp.settings import STATICFILES_DIRS
-from utils import base64_file
+
+
+SUPPORTS = ["apple", "google", "facebook", "windows", "twitter", "joypixels", "samsung", "gmail", "softbank", "docomo", "kddi"]
+
+
+def iter_json_array(file, key, chunk_size=64 * 1024):
+    """
+    Yields the items of the array under key in the JSON file one at a time,
+    reading the file in chunks instead of loading all of it. Expects the
+    key to appear once, before the array, like in emoji.json.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+
+    def read():
+        nonlocal buffer, eof
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+
+    # find the start of the array
+    marker = f'"{key}"'
+    while True:
+        start = buffer.find(marker)
+        if start != -1:
+            bracket = buffer.find('[', start + len(marker))
+            if bracket != -1:
+                buffer = buffer[bracket + 1:]
+                break
+        if eof:
+            raise CommandError(f'No "{key}" array in the file.')
+        read()
+
+    position = 0
+    while True:
+        # skip to the next item
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise CommandError('The file ended in the middle of the array.')
+            buffer, position = '', 0
+            read()
+            continue
+        if buffer[position] == ']':
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # the item isn't all there yet
+            if eof:
+                raise CommandError('The file ended in the middle of an item.')
+            buffer, position = buffer[position:], 0
+            read()
+            continue
+
+        yield item
+        position = end
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
 
 class Command(BaseCommand):
+    help = (
+        'Imports the emojis in static/emoji.json that the chosen platform supports. '
+        'Existing emojis are updated in place, unless --replace is given.'
+    )
+    batch_size = 500
+
     def add_arguments(self, parser):
-        parser.add_argument('support', choices=["apple", "google", "facebook", "windows", "twitter", "joypixels", "samsung", "gmail", "softbank", "docomo", "kddi"], type=str)
+        parser.add_argument('support', choices=SUPPORTS, type=str)
+        parser.add_argument('--file', default=os.path.join(STATICFILES_DIRS[0], 'emoji.json'))
+        parser.add_argument('--replace', action='store_true', help='Deletes every emoji first, along with their reactions.')
+        parser.add_argument('--workers', type=int, default=8, help='Threads decoding and writing the images.')
+
+    def write_image(self, emoji):
+        """
+        Decodes the emoji's image and writes it under a name of its own, so
+        that importing again overwrites it rather than adding a copy. Files
+        that haven't changed aren't written again.
+        """
+        header, data = emoji["images"][self.support].split(';base64,')
+        extension = header.split('/')[-1]
+        content = base64.b64decode(data)
+        name = f'emojis/{self.support}/{get_valid_filename(emoji["name"])}.{extension}'
+
+        if default_storage.exists(name):
+            with default_storage.open(name, 'rb') as file:
+                if file.read() == content:
+                    return self.build_emoji(emoji, name)
+            default_storage.delete(name)
+
+        default_storage.save(name, ContentFile(content))
+        return self.build_emoji(emoji, name)
+
+    def build_emoji(self, emoji, name):
+        return Emoji(
+            name=emoji["name"],
+            category=emoji["category"],
+            image=name,
+            emoji_literal=emoji["emoji"],
+        )
 
     def handle(self, *args, **options):
-        # will delete all previous emojis rather than override
-        Emoji.objects.all().delete()
-
-        emoji_support = options['support']
-        emoji_list_file = os.path.join(STATICFILES_DIRS[0], 'emoji.json')
-        with open(emoji_list_file, 'r', encoding='utf-8') as file:
-            emojis = filter(lambda emoji: emoji['support'].get(emoji_support), json.loads(file.read())['emojis'])
-
-        for emoji in emojis:
-            Emoji.objects.create(
-                name=emoji["name"], 
-                category=emoji["category"],
-                image=base64_file(emoji["images"][emoji_support]),   
-                emoji_literal=emoji["emoji"],
-            )
\ No newline at end of file
+        self.support = options['support']
+        if not os.path.exists(options['file']):
+            raise CommandError(f'{options["file"]} does not exist.')
+
+        imported = 0
+        with open(options['file'], 'r', encoding='utf-8') as file, ThreadPoolExecutor(max_workers=options['workers']) as executor, transaction.atomic():
+            if options['replace']:
+                Emoji.objects.all().delete()
+
+            emojis = (emoji for emoji in iter_json_array(file, 'emojis') if emoji['support'].get(self.support))
+            for batch in batched(emojis, self.batch_size):
+                Emoji.objects.bulk_create(
+                    executor.map(self.write_image, batch),
+                    update_conflicts=True,
+                    unique_fields=['name'],
+                    update_fields=['category', 'image', 'emoji_literal'],
+                )
+                imported += len(batch)
+
+        version = compile_catalog()
+        self.stdout.write(f'Imported {imported} emojis, the emoji catalog is now {version}.')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from rooms.models import Message
+from rooms.thumbnails import process_image
+
+
+class Command(BaseCommand):
+    help = 'Stores the dimensions and thumbnails of the attachments of messages sent before they were processed.'
+
+    def handle(self, *args, **options):
+        messages = Message.objects.exclude(attachment='').filter(attachment_width=None).only('pk', 'attachment')
+        processed = 0
+        for message in messages.iterator():
+            try:
+                width, height, thumbnails = process_image(message.attachment.name)
+            except OSError as error:
+                self.stderr.write(f'Skipping message {message.pk}: {error}')
+                continue
+
+            Message.objects.filter(pk=message.pk).update(
+                attachment_width=width,
+                attachment_height=height,
+                attachment_thumbnails=thumbnails
+            )
+            processed += 1
+
+        self.stdout.write(f'Processed {processed} attachments.')
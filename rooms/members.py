@@ -0,0 +1,328 @@
+"""
+The member list of group chats.
+
+Members are listed under their most important role and sorted by display
+name within it. Rather than loading and rendering every membership of the
+chat on each page, the list is kept as an index of rows per chat:
+
+    ('role', role pk)
+    ('member', membership pk)
+
+and windows of it are rendered on demand, see render_member_list and
+GroupChatConsumer.get_member_list.
+
+The same index keeps the sorted names of the members and roles, to
+complete mentions with a binary search rather than a LIKE '%...%' scan on
+every keystroke, see search_mentionables.
+
+Like the permission masks, the index is kept per process under a per-chat
+version in the cache that the signals in rooms/signals.py bump. Next to
+each version they leave the memberships that changed, so that joins,
+leaves, renames and role assignments are applied to the index of every
+process in place, see apply_changes. It's only built again from scratch
+when the roles themselves or their order change, or when the changes a
+process missed are no longer in the cache.
+"""
+from bisect import bisect_left, insort
+from collections import defaultdict
+from itertools import islice
+
+from django.core.cache import cache
+from django.template.loader import render_to_string
+
+from .models import GroupChatMembership, Role
+from . import presence, versions
+
+
+MEMBERS_VERSION = 'members'
+WINDOW = 100
+MENTIONABLES_LIMIT = 10
+
+# what the signals leave for a change that needs the index built again
+REBUILD = 'rebuild'
+CHANGE_TIMEOUT = 60 * 60
+# past that many versions behind, building the index is as quick
+MAX_CHANGES = 100
+
+# chat pk -> {'version': int, 'rows': [...], 'roles': {role pk: {...}}, ...}, see build_index
+_indexes = {}
+
+
+def change_key(chat_pk, version):
+    return f'members:{chat_pk}:change:{version}'
+
+
+def invalidate_member_list(chat_pk, membership_pks=None):
+    """
+    Bumps the version of the chat's member list. Without membership_pks the
+    index is built again, otherwise only those memberships are read again.
+    """
+    if membership_pks is None:
+        _indexes.pop(chat_pk, None)
+
+    version = versions.bump(MEMBERS_VERSION, chat_pk)
+    if version is None:
+        # nothing was cached for the chat yet
+        _indexes.pop(chat_pk, None)
+        return
+
+    change = REBUILD if membership_pks is None else list(membership_pks)
+    cache.set(change_key(chat_pk, version), change, timeout=CHANGE_TIMEOUT)
+
+
+def build_member(nickname, username, username_id, image):
+    """
+    Returns what the index keeps of a member: the name it's sorted by in the
+    member list, the names it's completed from, and what the mentionables
+    list shows of it, so that completing a mention doesn't have to touch the
+    database.
+    """
+    display_name = nickname or username
+    full_name = f'{username}#{str(username_id).zfill(2)}'
+    names = [display_name.casefold(), full_name.casefold()]
+    if nickname:
+        names.append(username.casefold())
+
+    member = {
+        'nickname': nickname,
+        'user': {'username': username, 'full_name': full_name, 'image': image},
+    }
+    return display_name.casefold(), names, member
+
+
+def get_top_roles(index, role_memberships):
+    top_roles = {}
+    role_rank = index['role_rank']
+    for membership_pk, role_pk in role_memberships:
+        if membership_pk not in top_roles or role_rank[role_pk] < role_rank[top_roles[membership_pk]]:
+            top_roles[membership_pk] = role_pk
+
+    return top_roles
+
+
+def build_index(chat):
+    roles = sorted(chat.roles.only('pk', 'name', 'color', 'chat'), key=chat.get_role_order)
+    index = {
+        'role_pks': [role.pk for role in roles],
+        'role_rank': {role.pk: rank for rank, role in enumerate(roles)},
+        'role_details': {role.pk: {'pk': role.pk, 'name': role.name, 'color': role.color} for role in roles},
+        # role pk -> [(sort name, membership pk)], sorted
+        'groups': defaultdict(list),
+        # membership pk -> (role pk, sort name, names)
+        'placements': {},
+        'members': {},
+        'member_names': [],
+        'mentionable_roles': {role.pk: {'pk': role.pk, 'name': role.name} for role in roles},
+        # by name, then by importance
+        'role_names': sorted((role.name.casefold(), rank, role.pk) for rank, role in enumerate(roles)),
+    }
+
+    top_roles = get_top_roles(index, Role.members.through.objects.filter(role__chat=chat).values_list('groupchatmembership', 'role'))
+    memberships = GroupChatMembership.objects.filter(chat=chat).values_list(
+        'pk', 'nickname', 'user__username', 'user__username_id', 'user__image'
+    )
+    for membership_pk, *fields in memberships:
+        # memberships are given the base role when they're created
+        role_pk = top_roles.get(membership_pk, chat.base_role_id)
+        sort_name, names, member = build_member(*fields)
+        index['groups'][role_pk].append((sort_name, membership_pk))
+        index['placements'][membership_pk] = (role_pk, sort_name, names)
+        index['members'][membership_pk] = member
+        index['member_names'].extend((name, membership_pk) for name in names)
+
+    index['rows'] = []
+    index['roles'] = {}
+    for role_pk in index['role_pks']:
+        role_members = index['groups'][role_pk]
+        if not role_members:
+            continue
+
+        role_members.sort()
+        index['roles'][role_pk] = {**index['role_details'][role_pk], 'count': len(role_members)}
+        index['rows'].append(('role', role_pk))
+        index['rows'].extend(('member', membership_pk) for _, membership_pk in role_members)
+
+    index['member_names'].sort()
+    return index
+
+
+def get_role_offset(index, role_pk):
+    """
+    Returns the row of the role in the member list, or where it goes.
+    """
+    offset = 0
+    for pk in index['role_pks']:
+        if pk == role_pk:
+            break
+        if index['groups'][pk]:
+            offset += 1 + len(index['groups'][pk])
+
+    return offset
+
+
+def add_member(index, membership_pk, role_pk, sort_name, names, member):
+    group = index['groups'][role_pk]
+    offset = get_role_offset(index, role_pk)
+    if not group:
+        index['rows'].insert(offset, ('role', role_pk))
+        index['roles'][role_pk] = {**index['role_details'][role_pk], 'count': 0}
+
+    position = bisect_left(group, (sort_name, membership_pk))
+    group.insert(position, (sort_name, membership_pk))
+    index['rows'].insert(offset + 1 + position, ('member', membership_pk))
+    index['roles'][role_pk]['count'] += 1
+
+    index['placements'][membership_pk] = (role_pk, sort_name, names)
+    index['members'][membership_pk] = member
+    for name in names:
+        insort(index['member_names'], (name, membership_pk))
+
+
+def remove_member(index, membership_pk):
+    if membership_pk not in index['placements']:
+        return
+
+    role_pk, sort_name, names = index['placements'].pop(membership_pk)
+    del index['members'][membership_pk]
+    for name in names:
+        del index['member_names'][bisect_left(index['member_names'], (name, membership_pk))]
+
+    group = index['groups'][role_pk]
+    offset = get_role_offset(index, role_pk)
+    position = bisect_left(group, (sort_name, membership_pk))
+    del group[position]
+    del index['rows'][offset + 1 + position]
+    index['roles'][role_pk]['count'] -= 1
+    if not group:
+        del index['rows'][offset]
+        del index['roles'][role_pk]
+
+
+def apply_changes(chat, index, version):
+    """
+    Brings the index up to version by reading again the memberships that
+    changed in between. Returns False if it has to be built again instead.
+    """
+    if not 0 < version - index['version'] <= MAX_CHANGES:
+        return False
+
+    keys = [change_key(chat.pk, change_version) for change_version in range(index['version'] + 1, version + 1)]
+    changes = cache.get_many(keys)
+    membership_pks = set()
+    for key in keys:
+        # expired, or left by a change to the roles
+        if key not in changes or changes[key] == REBUILD:
+            return False
+        membership_pks.update(changes[key])
+
+    role_memberships = list(Role.members.through.objects.filter(groupchatmembership__in=membership_pks).values_list('groupchatmembership', 'role'))
+    if any(role_pk not in index['role_rank'] for _, role_pk in role_memberships):
+        return False
+
+    top_roles = get_top_roles(index, role_memberships)
+    memberships = GroupChatMembership.objects.filter(chat=chat, pk__in=membership_pks).values_list(
+        'pk', 'nickname', 'user__username', 'user__username_id', 'user__image'
+    )
+    for membership_pk in membership_pks:
+        remove_member(index, membership_pk)
+    for membership_pk, *fields in memberships:
+        add_member(index, membership_pk, top_roles.get(membership_pk, chat.base_role_id), *build_member(*fields))
+
+    index['version'] = version
+    return True
+
+
+def get_index(chat):
+    version = versions.get_version(MEMBERS_VERSION, chat.pk)
+    # taken out while it's changed, so that a failed change can't leave it half done
+    index = _indexes.pop(chat.pk, None)
+    if index is None or (index['version'] != version and not apply_changes(chat, index, version)):
+        index = {'version': version, **build_index(chat)}
+
+    _indexes[chat.pk] = index
+    return index
+
+
+def render_member_list(chat, start=0, stop=WINDOW):
+    """
+    Renders the rows from start to stop, at most WINDOW of them, in a
+    single query once the index is built, however large the chat is.
+    """
+    index = get_index(chat)
+    start = max(start, 0)
+    stop = min(stop, start + WINDOW)
+    window = index['rows'][start:stop]
+
+    membership_pks = [pk for kind, pk in window if kind == 'member']
+    memberships = GroupChatMembership.objects.filter(pk__in=membership_pks).select_related('user').in_bulk()
+    presence.prefetch_statuses(membership.user for membership in memberships.values())
+
+    rows = []
+    for kind, pk in window:
+        if kind == 'role':
+            rows.append({'role': index['roles'][pk]})
+        elif pk in memberships:
+            rows.append({'member': memberships[pk]})
+
+    html = render_to_string('rooms/elements/member-list.html', {'rows': rows, 'group_chat': chat})
+    return {
+        'html': html,
+        'start': start,
+        'stop': start + len(window),
+        'total': len(index['rows']),
+        'version': index['version'],
+    }
+
+
+def search_prefix(names, prefix, limit, found):
+    """
+    Adds the pks of the names starting with prefix to found, a dict used as
+    an ordered set, until it holds limit of them. The names are tuples that
+    start with the name and end with the pk. An exact match sorts before
+    anything longer, so it always comes first.
+    """
+    position = bisect_left(names, (prefix,))
+    while position < len(names) and len(found) < limit:
+        name = names[position]
+        if not name[0].startswith(prefix):
+            break
+
+        found[name[-1]] = None
+        position += 1
+
+
+def search_mentionables(chat, alphanumeric=None, numeric=None, limit=MENTIONABLES_LIMIT):
+    """
+    Returns the members and roles to complete a mention with, as the dicts
+    the mentionables list is rendered from.
+    """
+    index = get_index(chat)
+    if not alphanumeric:
+        # the top of the member list
+        member_rows = (pk for kind, pk in index['rows'] if kind == 'member')
+        member_pks = list(islice(member_rows, limit))
+        role_pks = list(index['mentionable_roles'])[:limit]
+    else:
+        prefix = alphanumeric.casefold()
+        if numeric:
+            # >>name#1 completes name#01 as well as name#1x
+            prefixes = [f'{prefix}#{numeric}']
+            if len(numeric) == 1:
+                prefixes.insert(0, f'{prefix}#0{numeric}')
+        else:
+            prefixes = [prefix]
+
+        found_members = {}
+        for member_prefix in prefixes:
+            search_prefix(index['member_names'], member_prefix, limit, found_members)
+
+        found_roles = {}
+        if not numeric:
+            search_prefix(index['role_names'], prefix, limit, found_roles)
+
+        member_pks, role_pks = list(found_members), list(found_roles)
+
+    return (
+        [index['members'][pk] for pk in member_pks],
+        [index['mentionable_roles'][pk] for pk in role_pks],
+    )
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-18 17:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0142_role_can_see_categories_role_can_use_categories'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='backlog',
+            index=models.Index(fields=['group', '-id'], name='backlog_group_history'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.6 on 2026-10-18 17:55
+
+from django.db import migrations, models
+
+
+def count_unread_backlogs(apps, schema_editor):
+    BacklogGroupTracker = apps.get_model('rooms', 'BacklogGroupTracker')
+    Backlog = apps.get_model('rooms', 'Backlog')
+
+    for tracker in BacklogGroupTracker.objects.all():
+        unread_backlogs = Backlog.objects.filter(group=tracker.backlog_group_id, date_created__gt=tracker.last_updated)
+        tracker.unread_count = unread_backlogs.count()
+        tracker.mention_count = unread_backlogs.filter(
+            models.Q(user_mentions=tracker.user_id) | models.Q(role_mentions__members__user=tracker.user_id)
+        ).distinct().count()
+        # update() so that last_updated doesn't move
+        BacklogGroupTracker.objects.filter(pk=tracker.pk).update(
+            unread_count=tracker.unread_count, 
+            mention_count=tracker.mention_count
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0143_backlog_group_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backloggrouptracker',
+            name='mention_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='backloggrouptracker',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread_backlogs, migrations.RunPython.noop),
+    ]
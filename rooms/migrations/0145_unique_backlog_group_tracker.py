@@ -0,0 +1,31 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+def remove_duplicate_trackers(apps, schema_editor):
+    BacklogGroupTracker = apps.get_model('rooms', 'BacklogGroupTracker')
+
+    duplicates = BacklogGroupTracker.objects.values('user', 'backlog_group').annotate(
+        count=models.Count('pk')
+    ).filter(count__gt=1)
+    for duplicate in duplicates:
+        trackers = BacklogGroupTracker.objects.filter(user=duplicate['user'], backlog_group=duplicate['backlog_group'])
+        # keep the one read last, its counters are the ones the user saw
+        kept = trackers.order_by('-last_updated', '-pk').values_list('pk', flat=True).first()
+        trackers.exclude(pk=kept).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0144_backlog_tracker_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_trackers, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='backloggrouptracker',
+            constraint=models.UniqueConstraint(fields=('user', 'backlog_group'), name='unique_backlog_group_tracker'),
+        ),
+    ]
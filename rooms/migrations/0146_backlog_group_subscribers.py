@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0145_unique_backlog_group_tracker'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='backloggrouptracker',
+            index=models.Index(fields=['backlog_group', 'last_updated'], name='backlog_group_subscribers'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0147_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='attachment_height',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='attachment_thumbnails',
+            field=models.JSONField(default=list),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='attachment_width',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='thumbnails',
+            field=models.JSONField(default=list),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:24
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_reactions(apps, schema_editor):
+    Reaction = apps.get_model('rooms', 'Reaction')
+    user_counts = Reaction.user_archives.through.objects.filter(
+        reaction=models.OuterRef('pk')
+    ).values('reaction').annotate(count=models.Count('pk')).values('count')
+    # the subquery is empty for reactions without users
+    Reaction.objects.update(count=Coalesce(models.Subquery(user_counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0148_attachment_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reaction',
+            name='count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_reactions, migrations.RunPython.noop),
+    ]
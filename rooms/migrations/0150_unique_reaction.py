@@ -0,0 +1,43 @@
+# Generated by Django 4.2.6 on 2026-10-18 19:12
+
+from django.db import migrations, models
+
+
+def merge_duplicate_reactions(apps, schema_editor):
+    Reaction = apps.get_model('rooms', 'Reaction')
+    through = Reaction.user_archives.through
+
+    for kind in ('emoji', 'emote'):
+        duplicates = Reaction.objects.filter(kind=kind).values('backlog', kind).annotate(
+            count=models.Count('pk')
+        ).filter(count__gt=1)
+        for duplicate in duplicates:
+            reactions = Reaction.objects.filter(kind=kind, backlog=duplicate['backlog'], **{kind: duplicate[kind]})
+            kept = reactions.order_by('pk').values_list('pk', flat=True).first()
+            others = reactions.exclude(pk=kept)
+
+            # the users of the others move to the one that's kept
+            user_archives = set(through.objects.filter(reaction__in=others).values_list('userarchive', flat=True))
+            user_archives -= set(through.objects.filter(reaction=kept).values_list('userarchive', flat=True))
+            through.objects.bulk_create([through(reaction_id=kept, userarchive_id=user_archive) for user_archive in user_archives])
+            others.delete()
+            Reaction.objects.filter(pk=kept).update(count=through.objects.filter(reaction=kept).count())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0149_reaction_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_reactions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='reaction',
+            constraint=models.UniqueConstraint(condition=models.Q(('kind', 'emoji')), fields=('backlog', 'emoji'), name='unique_emoji_reaction'),
+        ),
+        migrations.AddConstraint(
+            model_name='reaction',
+            constraint=models.UniqueConstraint(condition=models.Q(('kind', 'emote')), fields=('backlog', 'emote'), name='unique_emote_reaction'),
+        ),
+    ]
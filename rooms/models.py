@@ -1,19 +1,25 @@
+import os
 import re
 import html
 import json
-from itertools import chain
+from itertools import chain, islice
 from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 from sorl.thumbnail import ImageField, get_thumbnail
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.core.validators import RegexValidator
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
 from django.template.loader import render_to_string
-from django.db.models import Q
+from django.db.models import Q, F
 
 from users.models import CustomUser, UserArchive
-from utils import get_object_or_none
+from . import permissions, fragments
+from .tokenizer import tokenize
+from .thumbnails import process_image, build_srcset
 
 channel_layer = get_channel_layer()
 
@@ -57,6 +63,15 @@ class GroupChat(Chat):
     def get_roles(self):
         return self.roles.all()
 
+    def get_role_order(self, role):
+        if role.pk == self.base_role_id:
+            return float('inf')
+        
+        if role.pk in self.role_order:
+            return self.role_order.index(role.pk)
+        
+        return role.pk + 10000
+
 
 class BacklogGroupWrapper(models.Model):
     def get_chat(self):
@@ -100,16 +115,14 @@ class GroupChatMembership(Membership):
 
     def generate_notifications(self):
         notifications_by_id = {"initial": {'unread_backlogs': 0, 'mentions': 0}}
-        trackers = BacklogGroupTracker.objects.filter(user=self.user, backlog_group__group_channel__in=self.chat.channels.all())
-
-        for tracker in trackers:
-            unread_backlogs = tracker.get_unread_backlogs()
-
-            unread_backlog_count = unread_backlogs.count()
-            mention_count = unread_backlogs.filter(Q(user_mentions=self.user) | Q(role_mentions__in=self.roles.all())).count()
-            
-            notifications_by_id[f"backlog-group-{tracker.backlog_group.pk}-unreads"] = unread_backlog_count
-            notifications_by_id[f"backlog-group-{tracker.backlog_group.pk}-mentions"] = mention_count
+        trackers = BacklogGroupTracker.objects.filter(
+            user=self.user, 
+            backlog_group__group_channel__chat=self.chat_id
+        ).values_list('backlog_group', 'unread_count', 'mention_count')
+
+        for backlog_group, unread_backlog_count, mention_count in trackers:
+            notifications_by_id[f"backlog-group-{backlog_group}-unreads"] = unread_backlog_count
+            notifications_by_id[f"backlog-group-{backlog_group}-mentions"] = mention_count
             
             notifications_by_id["initial"]['unread_backlogs'] += unread_backlog_count
             notifications_by_id["initial"]['mentions'] += mention_count
@@ -119,7 +132,7 @@ class GroupChatMembership(Membership):
     def roles_by_importance(self):
         return sorted(
             self.roles.all(), 
-            key=lambda role: role.get_order()
+            key=self.chat.get_role_order
         )
 
     def display_color(self):
@@ -127,37 +140,14 @@ class GroupChatMembership(Membership):
         return roles_by_importance[0].color
     
     def is_owner(self):
-        return self.user == self.chat.owner
+        return self.user_id == self.chat.owner_id
     
     def is_admin(self):
         return any(self.roles.values_list('admin', flat=True))
 
-    def get_visible_channel_pks(self):
-        if self.is_owner() or self.is_admin():
-            return self.chat.channels.values_list('pk', flat=True)
-
-        return self.roles.values_list('can_see_channels', flat=True)
-
-    def get_visible_category_pks(self):
-        if self.is_owner() or self.is_admin():
-            return self.chat.categories.values_list('pk', flat=True)
-
-        return self.roles.values_list('can_see_categories', flat=True)
-
     def has_perm(self, perm_name):
-        roles_by_importance = self.roles_by_importance()
-
-        if self.is_owner():
-            return True
-        
-        for role in roles_by_importance:
-            if role.admin:
-                return True
-
-        for role in roles_by_importance:
-            perm_value = role.get_perm_value(perm_name)
-            if perm_value is not None:
-                return perm_value
+        # resolved once per membership, see rooms/permissions.py
+        return permissions.has_perm(self, perm_name)
 
     def display_name(self):
         return self.nickname or self.user.username
@@ -170,8 +160,10 @@ class GroupChatMembership(Membership):
 
         if creating:
             super().save(*args, **kwargs)
-            for channel in self.chat.channels.all():
-                BacklogGroupTracker.objects.create(user=self.user, backlog_group=channel.backlog_group)
+            BacklogGroupTracker.provision(
+                [self.user_id], 
+                BacklogGroup.objects.filter(group_channel__chat=self.chat_id).values_list('pk', flat=True)
+            )
             
             self.chat.base_role.members.add(self)
         else:
@@ -199,8 +191,8 @@ class PrivateChatMembership(Membership):
         notifications_by_id = {"initial": {'unread_backlogs': 0}}
         tracker = BacklogGroupTracker.objects.get(user=self.user, backlog_group__private_chat=self.chat)
 
-        unread_backlog_count = tracker.get_unread_backlogs().count()
-        notifications_by_id[f"backlog-group-{tracker.backlog_group.pk}-unreads"] = unread_backlog_count
+        unread_backlog_count = tracker.unread_count
+        notifications_by_id[f"backlog-group-{tracker.backlog_group_id}-unreads"] = unread_backlog_count
         notifications_by_id["initial"]['unread_backlogs'] += unread_backlog_count
 
         return notifications_by_id
@@ -260,8 +252,7 @@ class GroupChannel(BacklogGroupWrapper):
         if creating:
             super().save(*args, **kwargs)
             BacklogGroup.objects.create(kind='group_channel', group_channel=self)
-            for membership in self.chat.memberships.all():
-                BacklogGroupTracker.objects.create(user=membership.user, backlog_group=self.backlog_group)
+            BacklogGroupTracker.provision_backlog_group(self.backlog_group)
             
             self.chat.base_role.can_see_channels.add(self)
             self.chat.base_role.can_use_channels.add(self)
@@ -288,6 +279,32 @@ class BacklogGroup(models.Model):
     def get_chat(self):
         return self.belongs_to().get_chat()
 
+    def get_backlog_page(self, before=None, size=20):
+        """
+        Keyset pagination over the backlogs, newest first.
+
+        Returns the page and the cursor to send back as `before` to get the
+        next one, or None when there's nothing older left. The backlog pk grows 
+        together with date_created, so it's enough to filter on the pk and let 
+        the (group, -id) index do the rest, no matter how far back the page is.
+        """
+        backlogs = self.backlogs.select_related(
+            'message__user', 
+            'message__user_archive__archive', 
+            'log__user1', 
+            'log__user2'
+        ).order_by('-pk')
+        if before is not None:
+            backlogs = backlogs.filter(pk__lt=before)
+
+        # fetch one more than needed to know whether there's another page
+        page = list(backlogs[:size + 1])
+        if len(page) > size:
+            page = page[:size]
+            return page, page[-1].pk
+        
+        return page, None
+
 
 class Backlog(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
@@ -311,6 +328,62 @@ class Backlog(models.Model):
     
     def __str__(self):
         return f'({self.pk}) | {self.kind}'
+
+    def save(self, *args, **kwargs):
+        creating = self._state.adding
+        super().save(*args, **kwargs)
+
+        if creating and self.group_id:
+            BacklogGroupTracker.objects.filter(backlog_group=self.group_id).update(unread_count=F('unread_count') + 1)
+
+    def get_unread_trackers(self):
+        """
+        The trackers of the users that haven't seen the backlog yet.
+        """
+        return BacklogGroupTracker.objects.filter(backlog_group=self.group_id, last_updated__lt=self.date_created)
+
+    def get_mentions(self):
+        """
+        The pks of the users and of the roles the backlog mentions.
+        """
+        return (
+            set(self.user_mentions.values_list('pk', flat=True)),
+            set(self.role_mentions.values_list('pk', flat=True)),
+        )
+
+    @staticmethod
+    def filter_mentioned(trackers, mentions):
+        # the members of the roles are left to a subquery rather than loaded,
+        # a role like the base role has every member of the chat
+        user_pks, role_pks = mentions
+        role_members = Role.members.through.objects.filter(role__in=role_pks).values('groupchatmembership__user')
+        return trackers.filter(Q(user__in=user_pks) | Q(user__in=role_members))
+
+    def update_mention_counts(self, previous_mentions):
+        """
+        Moves the mention counters of the unread trackers after the
+        mentions of the backlog changed, see rooms/signals.py.
+        """
+        mentions = self.get_mentions()
+        if mentions == previous_mentions:
+            return
+
+        unread_trackers = self.get_unread_trackers()
+        mentioned = self.filter_mentioned(unread_trackers, mentions).values('pk')
+        previously_mentioned = self.filter_mentioned(unread_trackers, previous_mentions).values('pk')
+
+        unread_trackers.filter(pk__in=mentioned).exclude(pk__in=previously_mentioned).update(mention_count=F('mention_count') + 1)
+        unread_trackers.filter(pk__in=previously_mentioned, mention_count__gt=0).exclude(pk__in=mentioned).update(mention_count=F('mention_count') - 1)
+
+    def discount_from_trackers(self):
+        unread_trackers = self.get_unread_trackers()
+        unread_trackers.filter(unread_count__gt=0).update(unread_count=F('unread_count') - 1)
+        self.filter_mentioned(unread_trackers, self.get_mentions()).filter(mention_count__gt=0).update(mention_count=F('mention_count') - 1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', '-id'], name='backlog_group_history'),
+        ]
     
 
 class Message(models.Model):
@@ -322,6 +395,22 @@ class Message(models.Model):
     rendered_content = models.CharField(max_length=5000)
     invites = models.JSONField(default=list)
     attachment = models.ImageField(blank=True)
+    # copied from the upload once it's processed, see Upload.process
+    attachment_width = models.PositiveIntegerField(null=True)
+    attachment_height = models.PositiveIntegerField(null=True)
+    attachment_thumbnails = models.JSONField(default=list)
+
+    def attachment_webp_srcset(self):
+        return build_srcset(self.attachment_thumbnails, 'webp')
+
+    def attachment_jpeg_srcset(self):
+        return build_srcset(self.attachment_thumbnails, 'jpeg')
+
+    def attachment_src(self):
+        if self.attachment_thumbnails:
+            return self.attachment_thumbnails[-1]['jpeg']
+
+        return self.attachment.url
 
     def get_member(self):
         if not self.user:
@@ -331,80 +420,92 @@ class Message(models.Model):
         return chat.get_member(self.user)
 
     def get_user_attributes(self):
+        member = self.get_member()
+        return self.build_user_attributes(member, member and member.display_color())
+
+    def build_user_attributes(self, member, display_color):
         if not self.user:
             return {
                 'display_name': str(self.user_archive),
                 'display_color': '',
                 'image': '',
-                'profile_kwargs': json.dumps({'user_pk': self.user_archive.data.pk})
+                'profile_kwargs': json.dumps({'user_pk': self.user_archive.archive.data['pk']})
             }
         
-        member = self.get_member()
         if member:
             return {
                 'display_name': member.display_name(),
-                'display_color': member.display_color(),
-                'image': member.user.image,
-                'profile_kwargs': json.dumps({'user_pk': self.user.pk, 'backlog_group_pk': self.backlog.group.pk})
+                'display_color': display_color or '',
+                'image': self.user.image,
+                'profile_kwargs': json.dumps({'user_pk': self.user.pk, 'backlog_group_pk': self.backlog.group_id})
             }
 
+        # the author is no longer part of the chat
         return {
-            'display_name': member.display_name(),
-            'display_color': member.display_color(),
-            'image': member.user.image,
+            'display_name': self.user.username,
+            'display_color': '',
+            'image': self.user.image,
             'profile_kwargs': json.dumps({'user_pk': self.user.pk})
         }
         
-    def get_user_mentions(self):
-        return re.findall(r'(?<!\w)>>(\w+#\d{2})(?!\w)', self.content)
-    
-    def get_role_mentions(self):
-        return re.findall(r'(?<!\w)>>(\w+)(?!\w)', self.content)
-
-    def get_invites(self):
-        return re.findall(r'(?<!\w)DjangoChatApp/[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}(?!\w)', self.content)
+    def resolve_mentions(self, tokens):
+        """
+        Looks up the users and roles mentioned in the tokens, one query each.
+        Returns them keyed the way the tokens refer to them.
+        """
+        user_keys = {value for kind, value, text in tokens if kind == 'user_mention'}
+        users = {}
+        if user_keys:
+            usernames = {username for username, username_id in user_keys}
+            for user in CustomUser.objects.filter(username__in=usernames):
+                if (user.username, user.username_id) in user_keys:
+                    users[(user.username, user.username_id)] = user
+
+        role_names = {value for kind, value, text in tokens if kind == 'role_mention'}
+        roles = {}
+        if role_names and self.backlog.group.kind == 'group_channel':
+            chat = self.backlog.group.group_channel.chat
+            roles = {role.name: role for role in chat.roles.filter(name__in=role_names)}
+
+        return users, roles
+
+    def render_tokens(self, tokens, users, roles):
+        # every user or role is rendered once, no matter how often they're mentioned
+        rendered_mentions = {}
+        rendered_content = []
+
+        for kind, value, text in tokens:
+            if kind == 'user_mention' and value in users:
+                if (kind, value) not in rendered_mentions:
+                    rendered_mentions[(kind, value)] = render_to_string(
+                        'rooms/elements/mentions/user-mention.html', 
+                        {'backlog': self.backlog, 'user': users[value]}
+                    )
+                rendered_content.append(rendered_mentions[(kind, value)])
+            elif kind == 'role_mention' and value in roles:
+                if (kind, value) not in rendered_mentions:
+                    rendered_mentions[(kind, value)] = render_to_string(
+                        'rooms/elements/mentions/role-mention.html', 
+                        {'role': roles[value]}
+                    )
+                rendered_content.append(rendered_mentions[(kind, value)])
+            else:
+                rendered_content.append(html.escape(text))
 
-    def process_content(self, users, roles):
-        processed_content = html.escape(self.content)
+        return ''.join(rendered_content)
 
-        for user in users:
-            processed_content = re.sub(
-                rf'(?<!\w){html.escape(">>" + user.full_name())}(?!\w)', 
-                lambda match: render_to_string('rooms/elements/mentions/user-mention.html', {'backlog': self.backlog, 'user': user}), 
-                processed_content
-            )
+    def process_invites(self, previews=None):
+        """
+        previews can be passed in when the invites of several messages
+        were already resolved together through Invite.get_previews.
+        """
+        if previews is None:
+            previews = Invite.get_previews(self.invites)
 
-        for role in roles:
-            processed_content = re.sub(
-                rf'(?<!\w){html.escape(">>" + role.name)}(?!\w)', 
-                lambda match: render_to_string('rooms/elements/mentions/role-mention.html', {'role': role}), 
-                self.content
-            )
-        
-        return processed_content
-
-    def process_invites(self):
-        invites = []
-
-        for invite_directory in self.invites:
-            invite = get_object_or_none(Invite, directory=invite_directory)
-            if not invite:
-                invites.append({
-                    'directory': invite_directory,
-                    'valid': False
-                })
-            else:
-                invites.append({
-                    'directory': invite_directory,
-                    'valid': True,
-                    'is_expired': invite.is_expired(),
-                    'chat': {
-                        'pk': invite.get_chat().pk,
-                        'name': invite.get_chat().name,
-                        'image': {'url': invite.get_chat().image.url},
-                        'memberships': list(invite.get_chat().memberships.values_list('user', flat=True))
-                    }
-                })
+        invites = [
+            previews.get(invite_directory, {'directory': invite_directory, 'valid': False}) 
+            for invite_directory in self.invites
+        ]
 
         return sorted(invites, key=lambda invite: self.content.find(invite['directory']))[-10:]
 
@@ -413,29 +514,89 @@ class Message(models.Model):
         if creating:
             self.user_archive = self.user.user_archive
 
-        users = set()
-        for full_name in self.get_user_mentions():
-            username, username_id = full_name.split('#')
-            user = get_object_or_none(CustomUser, username=username, username_id=username_id)
-            if user:
-                users.add(user)
-        
-        roles = set()
-        if self.backlog.group.kind == 'group_channel':
-            chat = self.backlog.group.group_channel.chat
-            for role_name in self.get_role_mentions():
-                role = chat.roles.filter(name=role_name).first()
-                if role:
-                    roles.add(role)
-        
-        
-        self.backlog.user_mentions.set(users)
-        self.backlog.role_mentions.set(roles)
-        self.rendered_content = self.process_content(users, roles)
-        self.invites = [invite.split('/')[-1] for invite in set(self.get_invites())]
+        tokens = tokenize(self.content)
+        users, roles = self.resolve_mentions(tokens)
+
+        # a new message has no mentions to clear
+        if users or not creating:
+            self.backlog.user_mentions.set(users.values())
+        if roles or not creating:
+            self.backlog.role_mentions.set(roles.values())
+        self.rendered_content = self.render_tokens(tokens, users, roles)
+        self.invites = list(dict.fromkeys(value for kind, value, text in tokens if kind == 'invite'))
         super().save(*args, **kwargs)
 
 
+class Upload(models.Model):
+    """
+    A file streamed to MEDIA_ROOT in chunks ahead of the message it gets 
+    attached to, see UploadCreateView and UploadChunkView.
+    """
+    # the largest file that can be uploaded, and the largest chunk at once
+    max_size = 25 * 1024 * 1024
+    max_chunk_size = 1024 * 1024
+
+    token = models.UUIDField(default=uuid4, unique=True, editable=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='uploads')
+    # the path of the file relative to MEDIA_ROOT
+    name = models.CharField(max_length=255)
+    size = models.PositiveIntegerField()
+    received = models.PositiveIntegerField(default=0)
+    # filled in by the upload-processing worker once the upload is complete
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    thumbnails = models.JSONField(default=list)
+    message = models.OneToOneField('Message', on_delete=models.SET_NULL, related_name='upload', null=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def is_complete(self):
+        return self.received == self.size
+
+    def path(self):
+        return default_storage.path(self.name)
+
+    def is_processed(self):
+        return self.width is not None
+
+    def attachment_fields(self):
+        return {
+            'attachment_width': self.width,
+            'attachment_height': self.height,
+            'attachment_thumbnails': self.thumbnails,
+        }
+
+    def process(self):
+        self.width, self.height, self.thumbnails = process_image(self.name)
+        self.save(update_fields=['width', 'height', 'thumbnails'])
+        # the message might have been sent before the upload was processed,
+        # see BacklogGroupUtils.create_message for the other half
+        messages = Message.objects.filter(upload=self)
+        messages.update(**self.attachment_fields())
+        for backlog_pk in messages.values_list('backlog', flat=True):
+            fragments.invalidate_backlog(backlog_pk)
+
+    def write_chunk(self, chunks):
+        """
+        Writes the chunks after the bytes received so far and returns how 
+        many bytes were written. Whatever a failed chunk left behind gets 
+        overwritten when it's sent again.
+        """
+        written = 0
+        path = self.path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+            file.seek(self.received)
+            file.truncate()
+            for chunk in chunks:
+                written += len(chunk)
+                if self.received + written > self.size:
+                    raise ValueError('The upload is larger than announced.')
+                
+                file.write(chunk)
+
+        return written
+
+
 class Log(models.Model):
     ACTIONS = (
         ('join', 'Join Chat'),
@@ -533,13 +694,7 @@ class Role(models.Model):
             return True
         
     def get_order(self):
-        if self == self.chat.base_role:
-            return float('inf')
-        
-        if self.pk in self.chat.role_order:
-            return self.chat.role_order.index(self.pk)
-        
-        return self.pk + 10000
+        return self.chat.get_role_order(self)
 
     class Meta:
         constraints = [
@@ -547,6 +702,9 @@ class Role(models.Model):
         ]
 
 
+INVITE_PREVIEW_TIMEOUT = 60 * 60
+
+
 def invite_default_expiry_date():
     return datetime.now(timezone.utc) + timedelta(days=1)
 
@@ -592,20 +750,144 @@ class Invite(models.Model):
     def get_chat(self):
         return getattr(self, self.kind)
 
+    @staticmethod
+    def preview_key(directory):
+        return f'invite-preview:{directory}'
+
+    @staticmethod
+    def chat_preview_key(chat_pk):
+        return f'invite-preview:chat:{chat_pk}'
+
+    @classmethod
+    def get_previews(cls, directories):
+        """
+        Resolves the invite directories into the data needed to display them.
+
+        The invites and their chats are cached apart, so that a change to the
+        chat or its members only drops the chat's entry (see rooms/signals.py),
+        whatever isn't cached is loaded in a single query. Unknown directories 
+        are left out.
+        """
+        if not directories:
+            return {}
+        
+        invite_keys = {cls.preview_key(directory): str(directory) for directory in directories}
+        invites = {invite_keys[key]: value for key, value in cache.get_many(invite_keys).items()}
+        chat_keys = {cls.chat_preview_key(invite['chat_pk']): invite['chat_pk'] for invite in invites.values()}
+        chats = {chat_keys[key]: value for key, value in cache.get_many(chat_keys).items()}
+
+        missing_directories = [
+            directory for directory in invite_keys.values() 
+            if directory not in invites or invites[directory]['chat_pk'] not in chats
+        ]
+        if missing_directories:
+            to_cache = {}
+            for invite in cls.objects.filter(directory__in=missing_directories).select_related('group_chat').annotate(
+                member_count=models.Count('group_chat__memberships')
+            ):
+                chat = invite.get_chat()
+                invites[str(invite.directory)] = to_cache[cls.preview_key(invite.directory)] = {
+                    'chat_pk': chat.pk,
+                    'expiry_date': invite.expiry_date,
+                }
+                chats[chat.pk] = to_cache[cls.chat_preview_key(chat.pk)] = {
+                    'pk': chat.pk,
+                    'name': chat.name,
+                    'image': {'url': chat.image.url},
+                    'member_count': invite.member_count,
+                }
+
+            cache.set_many(to_cache, timeout=INVITE_PREVIEW_TIMEOUT)
+
+        now = datetime.now(timezone.utc)
+        return {
+            directory: {
+                'directory': directory,
+                'valid': True,
+                'is_expired': invite['expiry_date'] < now,
+                'chat': chats[invite['chat_pk']],
+            }
+            for directory, invite in invites.items()
+        }
+
 
 class BacklogGroupTracker(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='backlog_trackers')
     backlog_group = models.ForeignKey(BacklogGroup, on_delete=models.CASCADE, related_name='+')
     last_backlog_seen = models.ForeignKey(Backlog, on_delete=models.SET_NULL, related_name='+', null=True)
     last_updated = models.DateTimeField(auto_now=True)
+    # kept up to date by Backlog and rooms/signals.py instead of counting the
+    # unread backlogs every time the notifications are rendered
+    unread_count = models.PositiveIntegerField(default=0)
+    mention_count = models.PositiveIntegerField(default=0)
+
+    # trackers are inserted this many at a time
+    batch_size = 1000
+    # backlog groups of chats with more members are provisioned by the 
+    # tracker-provisioning worker, see rooms/workers.py
+    inline_limit = 1000
+
+    @classmethod
+    def provision(cls, user_pks, backlog_group_pks):
+        """
+        Creates the trackers of every user for every backlog group, skipping
+        the ones that already exist.
+        """
+        trackers = (
+            cls(user_id=user_pk, backlog_group_id=backlog_group_pk) 
+            for user_pk in user_pks 
+            for backlog_group_pk in backlog_group_pks
+        )
+        while batch := list(islice(trackers, cls.batch_size)):
+            cls.objects.bulk_create(batch, ignore_conflicts=True)
+
+    @classmethod
+    def provision_backlog_group(cls, backlog_group):
+        """
+        Creates the trackers of a new group channel's members. Large chats are 
+        handed to the worker so the request doesn't wait on them, members that 
+        open the channel before then get their tracker through get_or_create.
+        """
+        chat_pk = backlog_group.group_channel.chat_id
+        user_pks = list(GroupChatMembership.objects.filter(chat=chat_pk).values_list('user', flat=True)[:cls.inline_limit + 1])
+        if len(user_pks) <= cls.inline_limit:
+            cls.provision(user_pks, [backlog_group.pk])
+            return
+        
+        async_to_sync(channel_layer.send)('tracker-provisioning', {
+            'type': 'provision_backlog_group',
+            'backlog_group': backlog_group.pk,
+        })
 
     def get_unread_backlogs(self):
         new_backlogs = self.backlog_group.backlogs.filter(date_created__gt=self.last_updated)
         return new_backlogs
 
+    def mark_as_read(self):
+        self.last_backlog_seen = self.backlog_group.backlogs.last()
+        self.unread_count = 0
+        self.mention_count = 0
+        self.save()
+
+    async def amark_as_read(self):
+        # mark_as_read for the consumers, without loading the backlog group
+        self.last_backlog_seen = await Backlog.objects.filter(group=self.backlog_group_id).order_by('pk').alast()
+        self.unread_count = 0
+        self.mention_count = 0
+        await self.asave(update_fields=['last_backlog_seen', 'unread_count', 'mention_count', 'last_updated'])
+
     def __str__(self):
         return f'{self.backlog_group.kind} ({self.backlog_group.belongs_to().pk}) {self.user.full_name()} ({self.user.pk})'
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'backlog_group'], name='unique_backlog_group_tracker')
+        ]
+        indexes = [
+            # who to notify of a new backlog, see rooms/notifications.py
+            models.Index(fields=['backlog_group', 'last_updated'], name='backlog_group_subscribers'),
+        ]
+
 
 class Emote(models.Model):
     chat = models.ForeignKey(GroupChat, on_delete=models.CASCADE, related_name='emotes')
@@ -658,6 +940,50 @@ class Reaction(models.Model):
     user_archives = models.ManyToManyField(UserArchive)
     emote = models.ForeignKey(Emote, on_delete=models.CASCADE, related_name='+', null=True)
     emoji = models.ForeignKey(Emoji, on_delete=models.CASCADE, related_name='+', null=True)
+    # the number of user_archives, kept up to date by toggle
+    count = models.PositiveIntegerField(default=0)
 
     def get_emoticon(self):
-        return getattr(self, self.kind)
\ No newline at end of file
+        return getattr(self, self.kind)
+
+    @classmethod
+    def toggle(cls, backlog_pk, kind, emoticon_pk, user_archive):
+        """
+        Adds the user's reaction to the backlog, or removes it if it's there,
+        returning the reaction and whether the user has it selected now.
+        Takes the same few queries however many users reacted: the check
+        goes through the unique (reaction, userarchive) index of the through
+        table and the count is updated in place.
+
+        Reactions that drop to 0 are kept, with their count, and left out
+        when rendering, so that a toggle racing the last removal doesn't
+        get its row deleted from under it.
+
+        Concurrent first reactions are kept to one row by the unique
+        constraints, which get_or_create falls back on. A concurrent toggle
+        by the same user that added the reaction first leaves it selected.
+        """
+        through = cls.user_archives.through
+        with transaction.atomic():
+            reaction, created = cls.objects.get_or_create(kind=kind, backlog_id=backlog_pk, **{f'{kind}_id': emoticon_pk})
+            removed, _ = through.objects.filter(reaction=reaction, userarchive=user_archive).delete()
+            if removed:
+                cls.objects.filter(pk=reaction.pk).update(count=F('count') - 1)
+            else:
+                try:
+                    with transaction.atomic():
+                        through.objects.create(reaction=reaction, userarchive=user_archive)
+                except IntegrityError:
+                    # added by the other toggle
+                    pass
+                else:
+                    cls.objects.filter(pk=reaction.pk).update(count=F('count') + 1)
+
+        fragments.invalidate_backlog(backlog_pk)
+        return reaction, not removed
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['backlog', 'emoji'], condition=Q(kind='emoji'), name='unique_emoji_reaction'),
+            models.UniqueConstraint(fields=['backlog', 'emote'], condition=Q(kind='emote'), name='unique_emote_reaction'),
+        ]
@@ -0,0 +1,105 @@
+import asyncio
+from collections import defaultdict
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from .broadcast import group_send_many
+from .models import BacklogGroupTracker, Role
+
+
+def resolve_notifications(backlog_group, backlogs):
+    """
+    Works out how many of the backlogs are unread, and how many of those
+    mention the user, for every user tracking the backlog group.
+
+    Returns {user pk: {'unreads': int, 'mentions': int}}, users with
+    nothing new are left out.
+    """
+    newest_date = max(backlog['date'] for backlog in backlogs)
+    trackers = BacklogGroupTracker.objects.filter(
+        backlog_group=backlog_group,
+        last_updated__lt=newest_date
+    ).values_list('user', 'last_updated')
+
+    role_pks = {role_pk for backlog in backlogs for role_pk in backlog['role_mentions']}
+    role_members = defaultdict(set)
+    if role_pks:
+        for role_pk, user_pk in Role.members.through.objects.filter(role__in=role_pks).values_list('role', 'groupchatmembership__user'):
+            role_members[role_pk].add(user_pk)
+
+    notifications = {}
+    for user_pk, last_updated in trackers:
+        unreads = mentions = 0
+        for backlog in backlogs:
+            # backlogs the user sent or already saw don't count
+            if backlog['sender'] == user_pk or backlog['date'] <= last_updated:
+                continue
+
+            unreads += 1
+            if (
+                user_pk in backlog['user_mentions']
+                or any(user_pk in role_members[role_pk] for role_pk in backlog['role_mentions'])
+            ):
+                mentions += 1
+
+        if unreads:
+            notifications[user_pk] = {'unreads': unreads, 'mentions': mentions}
+
+    return notifications
+
+
+class NotificationDispatcher:
+    """
+    Collects the new backlogs of each backlog group for a short window, then
+    resolves the notifications of everyone involved at once and sends one
+    delta per user, instead of every socket waiting and querying on its own.
+
+    The recipients come from the backlog group's trackers, which double as 
+    the index of who's subscribed to what, so sockets only ever have to join 
+    their user_<pk> group rather than one group per backlog group.
+
+    The window also gives users who have the backlog group open the time to
+    mark it as read, so they don't get notified of what they just saw.
+    """
+    window = 2
+
+    def __init__(self):
+        # backlog group pk -> {'target': {...}, 'backlogs': [...]}
+        self.pending = {}
+
+    def schedule(self, backlog, sender, target, user_mentions=(), role_mentions=()):
+        """
+        target describes where the notification shows up on the client,
+        either {'private_chat': pk} or {'group_chat': pk, 'group_channel': pk}.
+        """
+        backlog_group = backlog.group_id
+        pending = self.pending.get(backlog_group)
+        if pending is None:
+            pending = self.pending[backlog_group] = {'target': target, 'backlogs': []}
+            asyncio.get_running_loop().create_task(self.flush(backlog_group))
+
+        pending['backlogs'].append({
+            'date': backlog.date_created,
+            'sender': sender,
+            'user_mentions': set(user_mentions),
+            'role_mentions': set(role_mentions),
+        })
+
+    async def flush(self, backlog_group):
+        await asyncio.sleep(self.window)
+        pending = self.pending.pop(backlog_group)
+        notifications = await database_sync_to_async(resolve_notifications)(backlog_group, pending['backlogs'])
+
+        await group_send_many(get_channel_layer(), [
+            (f'user_{user_pk}', {
+                'type': 'send_notifications',
+                'backlog_group': backlog_group,
+                **pending['target'],
+                **counts,
+            })
+            for user_pk, counts in notifications.items()
+        ])
+
+
+notification_dispatcher = NotificationDispatcher()
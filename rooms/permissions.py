@@ -0,0 +1,103 @@
+"""
+Compiled group chat permissions.
+
+A membership's permissions only change when the chat's roles, the role order
+or the membership's roles change, so instead of walking the roles on every
+has_perm call, they are resolved once into a bitmask. The masks are kept in a
+per-process table and in the shared cache, both keyed on a per-chat version
+that gets bumped by the signals in rooms/signals.py whenever one of those
+things change.
+
+The process only reads the version from the shared cache again once its
+table is VERSION_TTL seconds old, so that checking a permission is an
+in-memory lookup rather than a cache round trip. A change made by another
+process can take that long to apply, changes in the process apply at once.
+"""
+import time
+
+from django.core.cache import cache
+
+from . import versions
+
+
+PERMISSIONS = (
+    'can_create_messages',
+    'can_manage_messages',
+    'can_react',
+    'can_manage_channels',
+    'can_manage_chat',
+    'can_mention_all',
+    'can_kick_members',
+    'can_ban_members',
+    'can_create_invites',
+    'can_get_invites',
+    'can_manage_invites',
+    'can_manage_emotes',
+    'can_manage_roles',
+)
+
+PERMISSION_BITS = {perm_name: 1 << index for index, perm_name in enumerate(PERMISSIONS)}
+ALL_PERMISSIONS = (1 << len(PERMISSIONS)) - 1
+
+PERMISSIONS_VERSION = 'permissions'
+CACHE_TIMEOUT = 60 * 60
+VERSION_TTL = 1
+
+# chat pk -> {'version': int, 'checked': monotonic time, 'masks': {membership pk: mask}}
+_tables = {}
+
+
+def compile_permissions(membership):
+    if membership.is_owner():
+        return ALL_PERMISSIONS
+
+    roles_by_importance = membership.roles_by_importance()
+    if any(role.admin for role in roles_by_importance):
+        return ALL_PERMISSIONS
+
+    mask = 0
+    for perm_name, bit in PERMISSION_BITS.items():
+        # the most important role with an opinion on the permission decides
+        for role in roles_by_importance:
+            perm_value = role.get_perm_value(perm_name)
+            if perm_value is not None:
+                if perm_value:
+                    mask |= bit
+                break
+
+    return mask
+
+
+def get_permissions(membership):
+    chat_pk = membership.chat_id
+    now = time.monotonic()
+
+    table = _tables.get(chat_pk)
+    if table is None or now - table['checked'] > VERSION_TTL:
+        version = versions.get_version(PERMISSIONS_VERSION, chat_pk)
+        if table is None or table['version'] != version:
+            table = _tables[chat_pk] = {'version': version, 'masks': {}}
+        table['checked'] = now
+
+    version = table['version']
+
+    mask = table['masks'].get(membership.pk)
+    if mask is None:
+        key = f'permissions:{chat_pk}:{version}:{membership.pk}'
+        mask = cache.get(key)
+        if mask is None:
+            mask = compile_permissions(membership)
+            cache.set(key, mask, timeout=CACHE_TIMEOUT)
+
+        table['masks'][membership.pk] = mask
+
+    return mask
+
+
+def has_perm(membership, perm_name):
+    return bool(get_permissions(membership) & PERMISSION_BITS[perm_name])
+
+
+def invalidate_chat_permissions(chat_pk):
+    _tables.pop(chat_pk, None)
+    versions.bump(PERMISSIONS_VERSION, chat_pk)
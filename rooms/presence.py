@@ -0,0 +1,207 @@
+"""
+Who's online, kept in the cache rather than in a column on the users table.
+
+Every socket counts as a connection of its user, AppConsumer adds it on
+connect, removes it on disconnect and touches it every HEARTBEAT seconds in
+between. The count expires TIMEOUT seconds after the last heartbeat, so a
+process that dies without disconnecting its sockets can't keep its users
+online for longer than that.
+
+The count belongs to a generation of the user's presence, and each socket
+remembers the generation it's counted in. When the count expires while
+some sockets are still open (their process stalled, say), the next heartbeat
+of each of them counts it again in a new generation, so that the count
+comes back to the number of open sockets rather than starting over at 1,
+and disconnecting the sockets of the old generation doesn't take from it.
+
+The counts live in their own cache, see "presence" in settings.CACHES,
+which has to be shared by the workers for them to agree on who's online.
+
+The changes are sent to the group chats, the friends and the private chat
+partners of the users by the dispatcher, a window at a time, see
+PresenceDispatcher.
+"""
+import asyncio
+from uuid import uuid4
+from collections import defaultdict
+
+from django.core.cache import caches
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from .broadcast import group_send_many
+from users.models import Friend
+from .models import GroupChatMembership, PrivateChatMembership
+
+
+ONLINE = 'online'
+OFFLINE = 'offline'
+
+TIMEOUT = 60
+HEARTBEAT = 20
+
+
+cache = caches['presence']
+
+
+def presence_key(user_pk):
+    # the generation, while the user is online
+    return f'presence:{user_pk}'
+
+
+def count_key(user_pk, generation):
+    return f'presence:{user_pk}:{generation}:count'
+
+
+def connect(user_pk):
+    """
+    Counts a socket of the user, returning the generation it's counted in
+    and whether it's the user's first connection.
+    """
+    key = presence_key(user_pk)
+    # unique, so that a new generation never finds the count of an old one
+    cache.add(key, uuid4().hex, timeout=TIMEOUT)
+    generation = cache.get(key)
+    if generation is None:
+        # expired in between
+        generation = uuid4().hex
+        cache.set(key, generation, timeout=TIMEOUT)
+
+    connections_key = count_key(user_pk, generation)
+    cache.add(connections_key, 0, timeout=TIMEOUT)
+    try:
+        connections = cache.incr(connections_key)
+    except ValueError:
+        cache.set(connections_key, 1, timeout=TIMEOUT)
+        connections = 1
+
+    cache.touch(key, TIMEOUT)
+    cache.touch(connections_key, TIMEOUT)
+    return generation, connections == 1
+
+
+def heartbeat(user_pk, generation):
+    """
+    Keeps the socket counted, returning the generation it's counted in now
+    and whether the user had expired and is back online.
+    """
+    if cache.get(presence_key(user_pk)) == generation:
+        cache.touch(presence_key(user_pk), TIMEOUT)
+        cache.touch(count_key(user_pk, generation), TIMEOUT)
+        return generation, False
+
+    return connect(user_pk)
+
+
+def disconnect(user_pk, generation):
+    """
+    Returns True if it was the user's last connection.
+    """
+    current_generation = cache.get(presence_key(user_pk))
+    if current_generation is None:
+        return True
+    if current_generation != generation:
+        # counted in the generation that expired, not in this one
+        return False
+
+    try:
+        connections = cache.decr(count_key(user_pk, generation))
+    except ValueError:
+        connections = 0
+
+    if connections <= 0:
+        cache.delete_many([presence_key(user_pk), count_key(user_pk, generation)])
+        return True
+
+    return False
+
+
+def get_statuses(user_pks):
+    online = cache.get_many([presence_key(user_pk) for user_pk in user_pks])
+    return {user_pk: ONLINE if online.get(presence_key(user_pk)) else OFFLINE for user_pk in user_pks}
+
+
+def get_status(user_pk):
+    return get_statuses([user_pk])[user_pk]
+
+
+def prefetch_statuses(users):
+    """
+    Reads the statuses of the users in one go for the presence_status
+    template filter, instead of one cache read per user.
+    """
+    users = list(users)
+    statuses = get_statuses({user.pk for user in users})
+    for user in users:
+        user._presence_status = statuses[user.pk]
+
+
+def resolve_presence_sends(statuses):
+    """
+    Groups the changed statuses by the group chats the users are in, and by
+    the users who have them in their friends or private chats, returning one
+    send per chat and per user.
+    """
+    group_statuses = defaultdict(list)
+    memberships = GroupChatMembership.objects.filter(user__in=statuses).values_list('chat', 'user')
+    for chat_pk, user_pk in memberships:
+        group_statuses[f'group_chat_{chat_pk}'].append([user_pk, statuses[user_pk]])
+
+    # (user whose status changed, user who sees it)
+    friends = Friend.objects.filter(friendship__members__user__in=statuses).values_list('friendship__members__user', 'user')
+    partners = PrivateChatMembership.objects.filter(chat__memberships__user__in=statuses).values_list('chat__memberships__user', 'user')
+    recipients = defaultdict(set)
+    for user_pk, recipient_pk in (*friends, *partners):
+        if recipient_pk is not None and recipient_pk != user_pk:
+            recipients[recipient_pk].add(user_pk)
+
+    for recipient_pk, user_pks in recipients.items():
+        group_statuses[f'user_{recipient_pk}'] = [[user_pk, statuses[user_pk]] for user_pk in sorted(user_pks)]
+
+    return [
+        (group, {
+            'type': 'send_to_client',
+            'action': 'update_presence',
+            'statuses': group_statuses[group],
+        })
+        for group in group_statuses
+    ]
+
+
+class PresenceDispatcher:
+    """
+    Collects the presence changes for a short window and sends them to each
+    chat and user at once, so that a page of people reconnecting is one
+    message per chat rather than one per person, and a quick reconnect doesn't get sent
+    at all.
+    """
+    window = 1
+
+    def __init__(self):
+        # user pk -> (status before the window, latest status)
+        self.pending = {}
+        self.flushing = False
+
+    def schedule(self, user_pk, status):
+        previous = OFFLINE if status == ONLINE else ONLINE
+        initial, _ = self.pending.get(user_pk, (previous, None))
+        self.pending[user_pk] = (initial, status)
+
+        if not self.flushing:
+            self.flushing = True
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        await asyncio.sleep(self.window)
+        pending, self.pending = self.pending, {}
+        self.flushing = False
+
+        statuses = {user_pk: status for user_pk, (initial, status) in pending.items() if initial != status}
+        if not statuses:
+            return
+
+        sends = await database_sync_to_async(resolve_presence_sends)(statuses)
+        await group_send_many(get_channel_layer(), sends)
+
+
+presence_dispatcher = PresenceDispatcher()
@@ -0,0 +1,85 @@
+"""
+The compact websocket protocol.
+
+Sockets that offer the "msgpack" subprotocol get their events as msgpack
+encoded [action code, data] arrays in bytes frames instead of JSON text
+frames, and can send theirs the same way. The action codes are the
+positions in ACTIONS (starting from 1), the client receives the table in
+a handshake frame with code 0 when it connects. Actions that aren't in the
+table are sent by name. New messages are sent to these sockets as their
+fields rather than as html, and built by static/js/globalJavascriptUtilities.js.
+Sockets that don't offer it keep using JSON and html.
+"""
+import msgpack
+
+
+SUBPROTOCOL = 'msgpack'
+HANDSHAKE = 0
+
+ACTIONS = (
+    # server to client
+    'create_message',
+    'create_log',
+    'create_notification',
+    'create_notifications',
+    'remove_notification',
+    'remove_all_notifications',
+    'mark_as_read',
+    'delete_backlog',
+    'edit_message',
+    'generate_backlogs',
+    'get_mentionables',
+    'get_member_list',
+    'update_reactions',
+    'create_friendship',
+    'accept_friendship',
+    'delete_friendship',
+    'create_group_chat',
+    'create_group_channel',
+    'create_group_category',
+    'create_private_chat',
+    'activate_private_chat',
+    'join_group_chat',
+    'leave_group_chat',
+    'build_emote_menu',
+    'redirect',
+    'scroll_to_bottom',
+    'update_presence',
+    # client to server
+    'accept_invite',
+    'get_emote_menu',
+    'react_backlog',
+)
+
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS, start=1)}
+
+
+def encode(event):
+    data = {key: value for key, value in event.items() if key not in ('type', 'action')}
+    return msgpack.packb([ACTION_CODES.get(event['action'], event['action']), data])
+
+
+def decode(bytes_data):
+    """
+    Raises ValueError for frames that aren't an [action code or name, data]
+    array, or whose code isn't in ACTIONS.
+    """
+    try:
+        code, data = msgpack.unpackb(bytes_data)
+    except (msgpack.UnpackException, ValueError, TypeError) as error:
+        raise ValueError('malformed frame') from error
+
+    if not isinstance(data, dict):
+        raise ValueError('malformed frame')
+
+    if isinstance(code, str):
+        return {**data, 'action': code}
+
+    if type(code) is not int or not 1 <= code <= len(ACTIONS):
+        raise ValueError(f'unknown action code {code!r}')
+
+    return {**data, 'action': ACTIONS[code - 1]}
+
+
+def encode_handshake():
+    return msgpack.packb([HANDSHAKE, {'actions': ACTIONS}])
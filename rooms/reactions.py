@@ -0,0 +1,83 @@
+"""
+Sending reactions to the chats.
+
+A popular message gets toggled by many people at once, and sending every
+toggle on its own makes each socket of the chat handle as many events. The
+dispatcher instead collects the toggles for a short window and sends each
+chat one update_reactions event with the reactions that changed, with their
+count at the end of the window and who toggled them, see
+ReactionDispatcher.
+"""
+import asyncio
+from collections import defaultdict
+
+from django.template.loader import render_to_string
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from .broadcast import group_send_many
+from .models import Reaction
+
+
+def resolve_reaction_sends(pending):
+    """
+    Reads the counts of the reactions toggled in the window in one query,
+    returning one send per group. Reactions that are still there are sent
+    with their html, for the sockets that haven't got them yet.
+    """
+    reaction_pks = {reaction_pk for reactions in pending.values() for reaction_pk in reactions}
+    reactions = Reaction.objects.filter(pk__in=reaction_pks).select_related('emoji', 'emote').in_bulk()
+
+    sends = []
+    for group, toggles in pending.items():
+        updates = []
+        for reaction_pk, selected in toggles.items():
+            reaction = reactions.get(reaction_pk)
+            if not reaction:
+                continue
+
+            updates.append({
+                'reaction_pk': reaction.pk,
+                'backlog_pk': reaction.backlog_id,
+                'count': reaction.count,
+                'html': render_to_string('rooms/elements/reaction.html', {'reaction': reaction, 'count': reaction.count}) if reaction.count else None,
+                # [user pk, whether they have it selected now], as a list
+                # since the channel layer may not take int keys
+                'selected': list(selected.items()),
+            })
+
+        if updates:
+            sends.append((group, {'type': 'send_reactions_to_client', 'reactions': updates}))
+
+    return sends
+
+
+class ReactionDispatcher:
+    """
+    Collects the toggles for a short window and sends each group what
+    changed at once, see resolve_reaction_sends.
+    """
+    window = 0.25
+
+    def __init__(self):
+        # group -> reaction pk -> user pk -> whether they have it selected
+        self.pending = defaultdict(lambda: defaultdict(dict))
+        self.flushing = False
+
+    def schedule(self, group, reaction_pk, user_pk, selected):
+        self.pending[group][reaction_pk][user_pk] = selected
+
+        if not self.flushing:
+            self.flushing = True
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        await asyncio.sleep(self.window)
+        pending, self.pending = self.pending, defaultdict(lambda: defaultdict(dict))
+        self.flushing = False
+
+        sends = await database_sync_to_async(resolve_reaction_sends)(pending)
+        await group_send_many(get_channel_layer(), sends)
+
+
+reaction_dispatcher = ReactionDispatcher()
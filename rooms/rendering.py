@@ -0,0 +1,308 @@
+from collections import defaultdict
+
+from django.template.loader import render_to_string
+
+from .models import Backlog, GroupChat, Invite, Reaction, Role
+from .caching import get_role_order
+from . import caching, fragments
+
+
+MESSAGES = 'message'
+
+
+def get_backlog_permissions(member):
+    return {
+        'can_react': bool(member and member.has_perm('can_react')),
+        'can_manage_messages': bool(member and member.has_perm('can_manage_messages')),
+    }
+
+
+def get_display_colors(chat, members):
+    """
+    Maps the membership pks to the color of their most important role.
+    """
+    if not isinstance(chat, GroupChat) or not members:
+        return {}
+
+    # from the most important, see rooms/caching.py, the fragments are
+    # cached under the version so the local copy could be stale
+    roles = {role['pk']: (rank, role['color']) for rank, role in enumerate(get_role_order(chat.pk, local=False))}
+    role_pks_by_member = defaultdict(list)
+    for member_pk, role_pk in Role.members.through.objects.filter(
+        groupchatmembership__in=members
+    ).values_list('groupchatmembership', 'role'):
+        role_pks_by_member[member_pk].append(role_pk)
+
+    display_colors = {}
+    for member_pk, role_pks in role_pks_by_member.items():
+        # roles created since the order was cached rank last
+        _, color = min(roles.get(role_pk, (len(roles), '')) for role_pk in role_pks)
+        display_colors[member_pk] = color
+
+    return display_colors
+
+
+def get_member_chat_pks(user, invites):
+    chat_pks = [invite['chat']['pk'] for invite in invites if invite['valid']]
+    if not user or not chat_pks:
+        return set()
+
+    return set(user.group_chat_memberships.filter(chat__in=chat_pks).values_list('chat', flat=True))
+
+
+def mark_invite_memberships(invites, member_chat_pks):
+    return [
+        {**invite, 'is_member': invite['chat']['pk'] in member_chat_pks} if invite['valid'] else invite
+        for invite in invites
+    ]
+
+
+def get_author_versions(chat, backlogs):
+    """
+    Returns the version of the chat and {user pk: version} of the authors of
+    the backlogs, see rooms/fragments.py.
+    """
+    if not isinstance(chat, GroupChat):
+        return fragments.get_private_chat_version(chat.pk), {}
+
+    user_pks = {backlog.message.user_id for backlog in backlogs if backlog.message.user_id}
+    return fragments.get_appearance_version(chat.pk), fragments.get_author_versions(chat.pk, user_pks)
+
+
+def build_reaction(reaction):
+    # looks up like a Reaction in reaction.html
+    emoticon = reaction.get_emoticon()
+    return {
+        'pk': reaction.pk,
+        'kind': reaction.kind,
+        'count': reaction.count,
+        'get_emoticon': {'pk': emoticon.pk, 'image': str(emoticon.image)},
+    }
+
+
+def build_message_fields(backlog, message, user_attributes):
+    """
+    What message-main.html and message-attachment.html show, for the
+    sockets that build messages themselves, see rooms/protocol.py.
+    """
+    attachment = None
+    if message.attachment:
+        attachment = {
+            'src': message.attachment_src(),
+            'width': message.attachment_width,
+            'height': message.attachment_height,
+            'jpeg_srcset': message.attachment_jpeg_srcset() if message.attachment_thumbnails else '',
+            'webp_srcset': message.attachment_webp_srcset() if message.attachment_thumbnails else '',
+        }
+
+    image = user_attributes['image']
+    return {
+        'timestamp': backlog.timestamp(),
+        'display_name': user_attributes['display_name'],
+        'display_color': user_attributes['display_color'],
+        'image': image.url if image else '',
+        'profile_kwargs': user_attributes['profile_kwargs'],
+        'content': message.rendered_content,
+        'attachment': attachment,
+    }
+
+
+def build_fragments(backlogs, chat):
+    """
+    Renders the parts of the messages that look the same to every viewer,
+    loading the authors' memberships and role colors and the reactions in 
+    bulk.
+    """
+    messages = [backlog.message for backlog in backlogs]
+    author_pks = {message.user_id for message in messages if message.user_id}
+    members_by_user = {
+        member.user_id: member
+        for member in chat.memberships.filter(user__in=author_pks).select_related('user')
+    }
+    display_colors = get_display_colors(chat, list(members_by_user.values()))
+
+    # reactions that dropped to 0 are kept, see Reaction.toggle
+    reactions = Reaction.objects.filter(
+        backlog__in=[backlog.pk for backlog in backlogs], count__gt=0
+    ).select_related('emoji', 'emote').order_by('pk')
+    reactions_by_backlog = defaultdict(list)
+    for reaction in reactions:
+        reactions_by_backlog[reaction.backlog_id].append(build_reaction(reaction))
+
+    built_fragments = {}
+    for backlog, message in zip(backlogs, messages):
+        member = members_by_user.get(message.user_id)
+        user_attributes = message.build_user_attributes(member, member and display_colors.get(member.pk))
+        built_fragments[backlog.pk] = {
+            'main': render_to_string('rooms/elements/message-main.html', {'backlog': backlog, 'user_attributes': user_attributes}),
+            'attachment': render_to_string('rooms/elements/message-attachment.html', {'message': message}),
+            'reactions': reactions_by_backlog[backlog.pk],
+            'fields': build_message_fields(backlog, message, user_attributes),
+        }
+
+    return built_fragments
+
+
+def get_fragments(backlogs, chat):
+    """
+    Returns the fragments of the backlogs by pk, from the cache where their
+    version hasn't changed, see rooms/fragments.py.
+    """
+    backlog_versions = fragments.get_backlog_versions([backlog.pk for backlog in backlogs])
+    chat_version, author_versions = get_author_versions(chat, backlogs)
+    keys = {
+        f'{backlog.pk}:{backlog_versions[backlog.pk]}:{chat_version}:{author_versions.get(backlog.message.user_id)}': backlog
+        for backlog in backlogs
+    }
+
+    def load(missing_keys):
+        built_fragments = build_fragments([keys[key] for key in missing_keys], chat)
+        return {key: built_fragments[keys[key].pk] for key in missing_keys}
+
+    return {keys[key].pk: fragment for key, fragment in caching.get_many(MESSAGES, list(keys), load).items()}
+
+
+def load_backlog_entries(backlogs, user, chat):
+    """
+    Builds the view model of a page of backlogs for the given viewer.
+
+    The parts that every viewer sees the same come from get_fragments, what
+    depends on the viewer (the mentions, the invites they joined and the
+    reactions they selected) is loaded in bulk, so the number of queries 
+    doesn't grow with the size of the page. The backlogs are expected to 
+    come from BacklogGroup.get_backlog_page, with their message and its 
+    user selected. Passing no user leaves out whatever depends on the viewer.
+    """
+    backlogs = [backlog for backlog in backlogs if backlog.kind == 'message']
+    if not backlogs:
+        return []
+
+    backlog_pks = [backlog.pk for backlog in backlogs]
+    messages = [backlog.message for backlog in backlogs]
+    backlog_fragments = get_fragments(backlogs, chat)
+
+    selected_pks = set()
+    mentioned_pks = set()
+    if user:
+        selected_pks.update(Reaction.user_archives.through.objects.filter(
+            reaction__backlog__in=backlog_pks, userarchive__user=user
+        ).values_list('reaction', flat=True))
+        mentioned_pks.update(Backlog.user_mentions.through.objects.filter(
+            backlog__in=backlog_pks, customuser=user
+        ).values_list('backlog', flat=True))
+        mentioned_pks.update(Backlog.role_mentions.through.objects.filter(
+            backlog__in=backlog_pks, role__members__user=user
+        ).values_list('backlog', flat=True))
+
+    invite_previews = Invite.get_previews({directory for message in messages for directory in message.invites})
+    member_chat_pks = get_member_chat_pks(user, invite_previews.values())
+
+    entries = []
+    for backlog, message in zip(backlogs, messages):
+        fragment = backlog_fragments[backlog.pk]
+        invites = message.process_invites(previews=invite_previews)
+        entries.append({
+            'backlog': backlog,
+            'fragment': fragment,
+            'invites': mark_invite_memberships(invites, member_chat_pks),
+            'reactions': [(reaction, reaction['count'], reaction['pk'] in selected_pks) for reaction in fragment['reactions']],
+            'is_mentioned': backlog.pk in mentioned_pks,
+        })
+
+    return entries
+
+
+def render_backlogs(backlogs, user, member, chat):
+    return render_to_string('rooms/elements/backlogs.html', {
+        'entries': load_backlog_entries(backlogs, user, chat),
+        'user': user,
+        'permissions': get_backlog_permissions(member),
+    })
+
+
+def render_message(backlog, user, member, chat):
+    entry, = load_backlog_entries([backlog], user, chat)
+    return render_to_string('rooms/elements/message.html', {
+        'entry': entry,
+        'backlog': backlog,
+        'user': user,
+        'permissions': get_backlog_permissions(member),
+    })
+
+
+def render_shared_message(backlog, chat):
+    """
+    Render the parts of a message that look the same to every viewer.
+
+    The payload is built once by the sender's consumer and carried through the
+    channel layer, every subscriber then only applies its own overlay
+    (see render_message_overlay) instead of re-fetching and re-rendering the
+    whole backlog.
+    """
+    entry, = load_backlog_entries([backlog], None, chat)
+
+    return {
+        'pk': backlog.pk,
+        'author': backlog.message.user_id,
+        'html': render_to_string('rooms/elements/message.html', {'entry': entry, 'backlog': backlog, 'shared': True}),
+        'fields': entry['fragment']['fields'],
+        'invites': entry['invites'],
+        'user_mentions': list(backlog.user_mentions.values_list('pk', flat=True)),
+        'role_mentions': list(backlog.role_mentions.values_list('pk', flat=True)),
+    }
+
+
+def render_invites(invites, user):
+    invites = mark_invite_memberships(invites, get_member_chat_pks(user, invites))
+
+    rendered_invites = []
+    for invite in invites:
+        if not invite['valid']:
+            rendered_invites.append(render_to_string('rooms/elements/backlog-invites/invalid-backlog-invite.html'))
+        elif invite['is_expired']:
+            rendered_invites.append(render_to_string('rooms/elements/backlog-invites/expired-backlog-invite.html'))
+        else:
+            rendered_invites.append(render_to_string('rooms/elements/backlog-invites/valid-backlog-invite.html', {'invite': invite, 'user': user}))
+
+    return ''.join(rendered_invites)
+
+
+def is_mentioned(payload, user, member):
+    if user.pk in payload['user_mentions']:
+        return True
+
+    # private chat memberships have no roles to mention
+    if not payload['role_mentions'] or not hasattr(member, 'roles'):
+        return False
+
+    return member.roles.filter(pk__in=payload['role_mentions']).exists()
+
+
+def render_message_overlay(payload, user, member, structured=False):
+    """
+    Render the viewer dependent parts of a shared message payload:
+    the mention highlight, the invites and the action buttons. With
+    structured, the buttons are left to the client as flags instead.
+    """
+    permissions = get_backlog_permissions(member)
+    overlay = {
+        'is_mentioned': is_mentioned(payload, user, member),
+        'invites': render_invites(payload['invites'], user),
+    }
+
+    if structured:
+        is_author = user.pk == payload['author']
+        overlay['actions'] = {
+            'can_react': permissions['can_react'],
+            'can_edit': is_author,
+            'can_delete': is_author or permissions['can_manage_messages'],
+        }
+    else:
+        backlog = {'pk': payload['pk'], 'message': {'user_id': payload['author']}}
+        overlay['actions'] = render_to_string('rooms/elements/backlog-actions/message-actions.html', {
+            'backlog': backlog,
+            'user': user,
+            'permissions': permissions,
+        })
+
+    return overlay
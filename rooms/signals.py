@@ -1,13 +1,240 @@
 from django.dispatch import receiver
-from django.db.models.signals import post_save, post_delete, pre_delete
-from django.db import models
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.db import models, transaction
+from django.core.cache import cache
 from DjangoChatApp.settings import MEDIA_URL
 
-from .models import GroupChannel, Category
+from .models import GroupChannel, Category, GroupChat, GroupChatMembership, Role, Backlog, BacklogGroup, Invite, Emoji, Emote, Message, Reaction
+from .permissions import invalidate_chat_permissions
+from .members import invalidate_member_list
+from .channel_tree import invalidate_channel_tree
+from . import fragments
+from .emoji_catalog import invalidate_catalog
+from . import caching
+from users.models import CustomUser
 
 
 # def decrease_relative_order(sender, instance, **kwargs):
 #     print('\n*' * 5)
 # 
 # post_delete.connect(decrease_relative_order, GroupChannel)
-# post_delete.connect(decrease_relative_order, Category)
\ No newline at end of file
+# post_delete.connect(decrease_relative_order, Category)
+
+
+@receiver(post_save, sender=GroupChat)
+@receiver(post_delete, sender=GroupChat)
+def invalidate_group_chat_permissions(sender, instance, **kwargs):
+    # the owner or the role order might have changed
+    invalidate_chat_permissions(instance.pk)
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+@receiver(post_delete, sender=GroupChatMembership)
+def invalidate_role_permissions(sender, instance, **kwargs):
+    invalidate_chat_permissions(instance.chat_id)
+
+
+@receiver(m2m_changed, sender=Role.members.through)
+def invalidate_role_members_permissions(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        # instance is either the role or the membership, both belong to the chat
+        invalidate_chat_permissions(instance.chat_id)
+
+
+@receiver(m2m_changed, sender=Backlog.user_mentions.through)
+@receiver(m2m_changed, sender=Backlog.role_mentions.through)
+def update_backlog_mention_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    # mentions are only ever set from the backlog's side
+    if reverse or (pk_set is not None and not pk_set):
+        return
+    
+    if action.startswith('pre_'):
+        instance._previous_mentions = instance.get_mentions()
+    else:
+        instance.update_mention_counts(instance.__dict__.pop('_previous_mentions', (set(), set())))
+
+
+@receiver(pre_delete, sender=Backlog)
+def discount_deleted_backlog(sender, instance, **kwargs):
+    instance.discount_from_trackers()
+
+
+@receiver(post_save, sender=Invite)
+@receiver(post_delete, sender=Invite)
+def invalidate_invite_preview(sender, instance, **kwargs):
+    cache.delete(Invite.preview_key(instance.directory))
+
+
+@receiver(post_save, sender=GroupChat)
+@receiver(post_delete, sender=GroupChat)
+def invalidate_group_chat_invite_preview(sender, instance, **kwargs):
+    cache.delete(Invite.chat_preview_key(instance.pk))
+
+
+@receiver(post_save, sender=GroupChatMembership)
+@receiver(post_delete, sender=GroupChatMembership)
+def invalidate_member_count_invite_preview(sender, instance, created=True, **kwargs):
+    # only joining and leaving change the member count
+    if created:
+        cache.delete(Invite.chat_preview_key(instance.chat_id))
+
+
+@receiver(post_save, sender=GroupChat)
+def invalidate_group_chat_member_list(sender, instance, **kwargs):
+    # the role order might have changed
+    invalidate_member_list(instance.pk)
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def invalidate_role_member_list(sender, instance, **kwargs):
+    invalidate_member_list(instance.chat_id)
+
+
+@receiver(post_save, sender=GroupChatMembership)
+@receiver(post_delete, sender=GroupChatMembership)
+def invalidate_membership_member_list(sender, instance, **kwargs):
+    invalidate_member_list(instance.chat_id, [instance.pk])
+
+
+@receiver(m2m_changed, sender=Role.members.through)
+def invalidate_role_members_member_list(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if reverse:
+        # the roles of a membership
+        invalidate_member_list(instance.chat_id, [instance.pk])
+    else:
+        # the members of a role, which a clear doesn't list
+        invalidate_member_list(instance.chat_id, pk_set)
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_user_member_lists(sender, instance, created, update_fields=None, **kwargs):
+    # the member list and the mentionables show the username and the image
+    if created or (update_fields is not None and not {'username', 'username_id', 'image'} & set(update_fields)):
+        return
+
+    for membership_pk, chat_pk in instance.group_chat_memberships.values_list('pk', 'chat'):
+        invalidate_member_list(chat_pk, [membership_pk])
+
+    # the messages show them too
+    for chat_pk in instance.private_chat_memberships.values_list('chat', flat=True):
+        fragments.invalidate_private_chat(chat_pk)
+
+
+@receiver(post_save, sender=Emoji)
+@receiver(post_delete, sender=Emoji)
+def invalidate_emoji_catalog(sender, instance, **kwargs):
+    # bulk imports don't send signals, create_emojis compiles the catalog itself
+    transaction.on_commit(invalidate_catalog)
+
+
+@receiver(post_save, sender=Emoji)
+@receiver(post_delete, sender=Emoji)
+def invalidate_cached_emoji(sender, instance, **kwargs):
+    caching.invalidate(caching.EMOJI, instance.pk)
+
+
+@receiver(post_save, sender=Emote)
+@receiver(post_delete, sender=Emote)
+def invalidate_cached_emotes(sender, instance, **kwargs):
+    caching.invalidate(caching.EMOTES, instance.chat_id)
+
+
+@receiver(post_save, sender=GroupChat)
+@receiver(post_delete, sender=GroupChat)
+def invalidate_cached_group_chat(sender, instance, **kwargs):
+    # the name, the image, the base role or the role order might have changed,
+    # the rest only goes with the chat
+    for kind in (caching.CHAT, caching.ROLES, caching.CHANNELS, caching.EMOTES):
+        caching.invalidate(kind, instance.pk)
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def invalidate_cached_role_order(sender, instance, **kwargs):
+    caching.invalidate(caching.ROLES, instance.chat_id)
+
+
+@receiver(post_save, sender=GroupChannel)
+@receiver(post_delete, sender=GroupChannel)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_cached_channel_tree(sender, instance, **kwargs):
+    caching.invalidate(caching.CHANNELS, instance.chat_id)
+
+
+@receiver(post_save, sender=BacklogGroup)
+def invalidate_channel_tree_backlog_group(sender, instance, created, **kwargs):
+    # channels get their backlog group after they're saved
+    if created and instance.group_channel_id:
+        caching.invalidate(caching.CHANNELS, instance.group_channel.chat_id)
+        invalidate_channel_tree(instance.group_channel.chat_id)
+
+
+@receiver(post_save, sender=GroupChannel)
+@receiver(post_delete, sender=GroupChannel)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def invalidate_visible_channel_trees(sender, instance, **kwargs):
+    # roles can become admin roles
+    invalidate_channel_tree(instance.chat_id)
+
+
+@receiver(m2m_changed, sender=Role.can_see_channels.through)
+@receiver(m2m_changed, sender=Role.can_see_categories.through)
+def invalidate_role_visible_channel_trees(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        # instance is either the role or the channel or category, all belong to the chat
+        invalidate_channel_tree(instance.chat_id)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Reaction)
+def invalidate_message_fragment(sender, instance, **kwargs):
+    # toggling reactions invalidates it itself, see Reaction.toggle
+    fragments.invalidate_backlog(instance.backlog_id)
+
+
+@receiver(post_save, sender=GroupChat)
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def invalidate_chat_appearance(sender, instance, **kwargs):
+    # the role colors or their order might have changed
+    fragments.invalidate_appearance(instance.pk if sender is GroupChat else instance.chat_id)
+
+
+@receiver(post_save, sender=GroupChatMembership)
+@receiver(post_delete, sender=GroupChatMembership)
+def invalidate_membership_fragments(sender, instance, **kwargs):
+    # the nickname
+    fragments.invalidate_authors(instance.chat_id, [instance.user_id])
+
+
+@receiver(m2m_changed, sender=Role.members.through)
+def invalidate_role_members_fragments(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    # the color of the top role
+    if reverse:
+        fragments.invalidate_authors(instance.chat_id, [instance.user_id])
+    elif pk_set is None:
+        fragments.invalidate_appearance(instance.chat_id)
+    else:
+        fragments.invalidate_authors(instance.chat_id, GroupChatMembership.objects.filter(pk__in=pk_set).values_list('user', flat=True))
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_user_fragments(sender, instance, created, update_fields=None, **kwargs):
+    # the name and the image, see invalidate_user_member_lists
+    if created or (update_fields is not None and not {'username', 'username_id', 'image'} & set(update_fields)):
+        return
+
+    for chat_pk in instance.group_chat_memberships.values_list('chat', flat=True):
+        fragments.invalidate_authors(chat_pk, [instance.pk])
@@ -1,10 +1,62 @@
-from datetime import datetime
+import json
+import time
+import base64
+import tempfile
+from io import BytesIO, StringIO
+from datetime import datetime, timedelta
+from unittest.mock import patch, AsyncMock
 
-from django.test import TestCase
+import msgpack
+from PIL import Image
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
 
-from .models import GroupChat
-from users.models import CustomUser
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction, IntegrityError
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import GroupChat, GroupChannel, GroupChatMembership, PrivateChat, PrivateChatMembership, Backlog, BacklogGroupTracker, Message, Invite, Reaction, Emoji, Emote, Role, Upload
+from users.models import CustomUser, Friendship, Friend
 from .forms import GroupChatCreateForm
+from .rendering import render_shared_message, render_message_overlay, render_backlogs
+from .notifications import resolve_notifications, NotificationDispatcher
+from .workers import TrackerProvisioningConsumer, UploadProcessingConsumer
+from .consumers import GroupChatConsumer
+from .routing import urlpatterns as websocket_urlpatterns
+from .broadcast import group_send_many
+from . import protocol, permissions, versions, presence, members, emoji_catalog, reactions, caching, channel_tree
+from .management.commands.create_emojis import iter_json_array
+
+def create_user(username, **kwargs):
+    return CustomUser.objects.create(username=username, email=f"{username}@test.com", birthday=datetime.now(), **kwargs)
+
+
+def create_group_chat(owner):
+    group_chat = GroupChatCreateForm({'name': 'Test Group Chat'}).save(commit=False)
+    group_chat.owner = owner
+    group_chat.save()
+    return group_chat
+
+
+class GroupChatTestCase(TestCase):
+    """
+    Sets up a group chat owned by self.owner, created with owner_fields.
+    """
+    owner_fields = {}
+
+    def setUp(self):
+        self.owner = create_user("owner", **self.owner_fields)
+        self.group_chat = create_group_chat(self.owner)
+
 
 # Create your tests here.
 class GroupChatModelTests(TestCase):
@@ -26,4 +78,1102 @@ class GroupChatModelTests(TestCase):
 
         owner_membership = self.group_chat.get_member(user=self.owner)
         self.assertEqual(owner_membership.user, self.owner)
-        self.assertEqual(owner_membership.chat, self.group_chat)
\ No newline at end of file
+        self.assertEqual(owner_membership.chat, self.group_chat)
+
+
+class MessageFanOutTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = create_user("other", username_id=1)
+        self.other_membership = GroupChatMembership.objects.create(user=self.other, chat=self.group_chat)
+        
+        backlog_group = self.group_chat.channels.first().backlog_group
+        self.backlog = Backlog.objects.create(kind='message', group=backlog_group)
+        Message.objects.create(user=self.owner, content='hello >>other#01', backlog=self.backlog)
+
+    def test_shared_payload_is_viewer_independent(self):
+        payload = render_shared_message(self.backlog, self.group_chat)
+        self.assertEqual(payload['user_mentions'], [self.other.pk])
+        self.assertNotIn('backlog--mentioned', payload['html'])
+        self.assertNotIn('data-command="delete_backlog"', payload['html'])
+
+    def test_overlay(self):
+        payload = render_shared_message(self.backlog, self.group_chat)
+        
+        owner_overlay = render_message_overlay(payload, self.owner, self.group_chat.get_member(self.owner))
+        self.assertFalse(owner_overlay['is_mentioned'])
+        self.assertIn('data-command="edit_message"', owner_overlay['actions'])
+        
+        other_overlay = render_message_overlay(payload, self.other, self.other_membership)
+        self.assertTrue(other_overlay['is_mentioned'])
+        self.assertNotIn('data-command="edit_message"', other_overlay['actions'])
+        self.assertNotIn('data-command="delete_backlog"', other_overlay['actions'])
+
+    def test_structured_payload(self):
+        payload = render_shared_message(self.backlog, self.group_chat)
+        self.assertEqual(payload['fields']['display_name'], self.owner.username)
+        self.assertIn('class="mention"', payload['fields']['content'])
+        self.assertIsNone(payload['fields']['attachment'])
+
+        owner_overlay = render_message_overlay(payload, self.owner, self.group_chat.get_member(self.owner), structured=True)
+        self.assertEqual(owner_overlay['actions'], {'can_react': True, 'can_edit': True, 'can_delete': True})
+        other_overlay = render_message_overlay(payload, self.other, self.other_membership, structured=True)
+        self.assertEqual(other_overlay['actions'], {'can_react': True, 'can_edit': False, 'can_delete': False})
+        self.assertLess(len(protocol.encode({'action': 'create_message', 'message': payload['fields'], **other_overlay})), len(payload['html']) // 2)
+
+
+class BacklogHistoryTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.backlog_group = self.group_chat.channels.first().backlog_group
+        self.backlogs = [Backlog.objects.create(kind='message', group=self.backlog_group) for i in range(45)]
+
+    def test_walk_history(self):
+        pages = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                page, cursor = self.backlog_group.get_backlog_page(before=cursor)
+            pages.append(page)
+            if cursor is None:
+                break
+
+        self.assertEqual([len(page) for page in pages], [20, 20, 5])
+        walked = [backlog.pk for page in pages for backlog in page]
+        self.assertEqual(walked, [backlog.pk for backlog in reversed(self.backlogs)])
+
+
+
+class BacklogPageRenderTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backlog_group = self.group_chat.channels.first().backlog_group
+        self.emoji = Emoji.objects.create(name='smile', category='Smileys & Emotion', emoji_literal=':)')
+        self.invite = Invite.objects.create(kind='group_chat', group_chat=self.group_chat, user=self.owner)
+
+    def create_messages(self, count):
+        for i in range(count):
+            user = create_user(f"user{i}")
+            membership = GroupChatMembership.objects.create(user=user, chat=self.group_chat)
+            backlog = Backlog.objects.create(kind='message', group=self.backlog_group)
+            Message.objects.create(user=user, content=f'hi >>owner#None {self.invite.full_link()}', backlog=backlog)
+            Reaction.toggle(backlog.pk, 'emoji', self.emoji.pk, user.user_archive)
+
+    def count_page_queries(self, page_size):
+        backlogs, cursor = self.backlog_group.get_backlog_page(size=page_size)
+        member = self.group_chat.get_member(self.owner)
+        # measure both pages with cold caches
+        cache.clear()
+        caches['local'].clear()
+        with CaptureQueriesContext(connection) as queries:
+            html = render_backlogs(backlogs, self.owner, member, self.group_chat)
+
+        self.assertEqual(html.count('data-role="content"'), page_size)
+        return len(queries)
+
+    def test_queries_do_not_grow_with_page_size(self):
+        self.create_messages(20)
+        self.assertEqual(self.count_page_queries(2), self.count_page_queries(20))
+
+
+class PermissionCacheTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = create_user("other")
+        self.membership = GroupChatMembership.objects.create(user=self.other, chat=self.group_chat)
+
+    def test_owner_has_every_permission(self):
+        owner_membership = self.group_chat.get_member(self.owner)
+        self.assertTrue(owner_membership.has_perm('can_manage_roles'))
+
+    def test_permissions_are_cached(self):
+        self.assertTrue(self.membership.has_perm('can_react'))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.membership.has_perm('can_react'))
+            self.assertFalse(self.membership.has_perm('can_manage_roles'))
+
+    def test_version_is_read_once_per_ttl(self):
+        self.assertTrue(self.membership.has_perm('can_react'))
+        with patch('rooms.permissions.cache') as shared_cache, patch('rooms.versions.cache') as version_cache:
+            self.assertTrue(self.membership.has_perm('can_react'))
+            self.assertFalse(self.membership.has_perm('can_manage_roles'))
+        shared_cache.get.assert_not_called()
+        version_cache.get_many.assert_not_called()
+
+        # another process bumps the version
+        versions.bump(permissions.PERMISSIONS_VERSION, self.group_chat.pk)
+        self.assertTrue(self.membership.has_perm('can_react'))
+        with patch('rooms.permissions.time.monotonic', return_value=time.monotonic() + permissions.VERSION_TTL + 1), \
+                patch('rooms.permissions.compile_permissions', return_value=0):
+            self.assertFalse(self.membership.has_perm('can_react'))
+
+    def test_role_changes_invalidate(self):
+        self.assertFalse(self.membership.has_perm('can_manage_roles'))
+
+        moderator = Role.objects.create(name='moderator', chat=self.group_chat, can_manage_roles=1)
+        moderator.members.add(self.membership)
+        self.assertTrue(self.membership.has_perm('can_manage_roles'))
+
+        self.group_chat.role_order = [moderator.pk]
+        self.group_chat.save()
+        moderator.can_manage_roles = -1
+        moderator.save()
+        self.assertFalse(self.membership.has_perm('can_manage_roles'))
+
+        moderator.can_manage_roles = 1
+        moderator.save()
+        moderator.members.remove(self.membership)
+        self.assertFalse(self.membership.has_perm('can_manage_roles'))
+
+
+class NotificationDispatchTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = create_user("other")
+        self.reader = create_user("reader")
+        self.membership = GroupChatMembership.objects.create(user=self.other, chat=self.group_chat)
+        GroupChatMembership.objects.create(user=self.reader, chat=self.group_chat)
+        self.backlog_group = self.group_chat.channels.first().backlog_group
+
+    def test_resolves_every_user_at_once(self):
+        moderator = Role.objects.create(name='moderator', chat=self.group_chat)
+        moderator.members.add(self.membership)
+        date = timezone.now() + timedelta(seconds=1)
+        backlogs = [
+            {'date': date, 'sender': self.owner.pk, 'user_mentions': {self.other.pk}, 'role_mentions': set()},
+            {'date': date, 'sender': self.owner.pk, 'user_mentions': set(), 'role_mentions': {moderator.pk}},
+            {'date': date, 'sender': self.owner.pk, 'user_mentions': set(), 'role_mentions': set()},
+        ]
+        # the reader had the channel open and marked it as read
+        BacklogGroupTracker.objects.filter(user=self.reader, backlog_group=self.backlog_group).update(
+            last_updated=date + timedelta(seconds=1)
+        )
+
+        with self.assertNumQueries(2):
+            notifications = resolve_notifications(self.backlog_group.pk, backlogs)
+
+        self.assertEqual(notifications, {self.other.pk: {'unreads': 3, 'mentions': 2}})
+
+    def test_flush_sends_in_one_batch(self):
+        dispatcher = NotificationDispatcher()
+        dispatcher.window = 0
+        dispatcher.pending[self.backlog_group.pk] = {'target': {'private_chat': 1}, 'backlogs': []}
+        notifications = {self.other.pk: {'unreads': 1, 'mentions': 0}, self.reader.pk: {'unreads': 1, 'mentions': 1}}
+
+        with patch('rooms.notifications.resolve_notifications', return_value=notifications), \
+                patch('rooms.notifications.group_send_many') as send_many:
+            async_to_sync(dispatcher.flush)(self.backlog_group.pk)
+
+        send_many.assert_called_once()
+        sends = send_many.call_args.args[1]
+        self.assertEqual([group for group, event in sends], [f'user_{self.other.pk}', f'user_{self.reader.pk}'])
+        self.assertEqual(sends[1][1], {
+            'type': 'send_notifications',
+            'backlog_group': self.backlog_group.pk,
+            'private_chat': 1,
+            'unreads': 1,
+            'mentions': 1,
+        })
+
+
+class TrackerCounterTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = create_user("other", username_id=1)
+        self.membership = GroupChatMembership.objects.create(user=self.other, chat=self.group_chat)
+        self.backlog_group = self.group_chat.channels.first().backlog_group
+
+    def get_tracker(self):
+        return BacklogGroupTracker.objects.get(user=self.other, backlog_group=self.backlog_group)
+
+    def create_message(self, content):
+        backlog = Backlog.objects.create(kind='message', group=self.backlog_group)
+        Message.objects.create(user=self.owner, content=content, backlog=backlog)
+        return backlog
+
+    def test_counters_follow_backlogs(self):
+        self.create_message('hello')
+        mention = self.create_message(f'hello >>{self.other.full_name()}')
+        tracker = self.get_tracker()
+        self.assertEqual((tracker.unread_count, tracker.mention_count), (2, 1))
+
+        mention.delete()
+        tracker = self.get_tracker()
+        self.assertEqual((tracker.unread_count, tracker.mention_count), (1, 0))
+
+        tracker.mark_as_read()
+        tracker = self.get_tracker()
+        self.assertEqual((tracker.unread_count, tracker.mention_count), (0, 0))
+
+    def test_role_mentions_are_counted_once(self):
+        moderator = Role.objects.create(name='moderator', chat=self.group_chat)
+        moderator.members.add(self.membership)
+        self.create_message(f'>>moderator >>{self.other.full_name()}')
+        self.assertEqual(self.get_tracker().mention_count, 1)
+
+    def test_role_mentions_are_not_expanded(self):
+        def sql_length(member_count):
+            for i in range(member_count):
+                user = create_user(f"user{member_count}-{i}")
+                GroupChatMembership.objects.create(user=user, chat=self.group_chat)
+
+            with CaptureQueriesContext(connection) as queries:
+                self.create_message('>>all').delete()
+            return sum(len(query['sql']) for query in queries)
+
+        self.assertEqual(sql_length(2), sql_length(20))
+
+        backlog = self.create_message('>>all')
+        self.assertEqual(self.get_tracker().mention_count, 1)
+        message = backlog.message
+        message.content = f'>>{self.other.full_name()}'
+        message.save()
+        self.assertEqual(self.get_tracker().mention_count, 1)
+        message.content = 'hello'
+        message.save()
+        self.assertEqual(self.get_tracker().mention_count, 0)
+
+    def test_notifications_are_read_from_the_counters(self):
+        self.create_message(f'hello >>{self.other.full_name()}')
+        with self.assertNumQueries(1):
+            notifications = self.membership.generate_notifications()
+
+        self.assertEqual(notifications['initial'], {'unread_backlogs': 1, 'mentions': 1})
+
+
+class MessageTokenizerTests(GroupChatTestCase):
+    owner_fields = {'username_id': 1}
+
+    def setUp(self):
+        super().setUp()
+        self.backlog_group = self.group_chat.channels.first().backlog_group
+        self.users = [
+            create_user(f"user{i}", username_id=i)
+            for i in range(5)
+        ]
+        self.role = Role.objects.create(name='moderator', chat=self.group_chat)
+
+    def create_message(self, content):
+        backlog = Backlog.objects.create(kind='message', group=self.backlog_group)
+        return Message.objects.create(user=self.owner, content=content, backlog=backlog)
+
+    def test_mentions_and_invites(self):
+        directory = '123e4567-e89b-42d3-a456-426614174000'
+        message = self.create_message(f'<b> >>user1#01 >>moderator >>nobody#05 DjangoChatApp/{directory}')
+
+        self.assertEqual(list(message.backlog.user_mentions.all()), [self.users[1]])
+        self.assertEqual(list(message.backlog.role_mentions.all()), [self.role])
+        self.assertEqual(message.invites, [directory])
+        self.assertTrue(message.rendered_content.startswith('&lt;b&gt; <span class="mention"'))
+        self.assertIn('&gt;&gt;nobody#05', message.rendered_content)
+
+    def test_queries_do_not_grow_with_mentions(self):
+        def count_queries(mention_count):
+            content = ' '.join(f'>>{user.full_name()} >>moderator' for user in self.users[:mention_count])
+            with CaptureQueriesContext(connection) as queries:
+                self.create_message(content)
+            return len(queries)
+
+        self.assertEqual(count_queries(2), count_queries(5))
+
+
+class InvitePreviewCacheTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = create_user("other")
+        self.invite = Invite.objects.create(kind='group_chat', group_chat=self.group_chat, user=self.owner)
+        self.directory = str(self.invite.directory)
+
+    def get_preview(self):
+        return Invite.get_previews([self.directory])[self.directory]
+
+    def test_previews_are_cached(self):
+        self.get_preview()
+        with self.assertNumQueries(0):
+            preview = self.get_preview()
+
+        self.assertEqual(preview['chat']['name'], 'Test Group Chat')
+        self.assertFalse(preview['is_expired'])
+
+    def test_chat_changes_invalidate(self):
+        member_count = self.get_preview()['chat']['member_count']
+        GroupChatMembership.objects.create(user=self.other, chat=self.group_chat)
+        self.assertEqual(self.get_preview()['chat']['member_count'], member_count + 1)
+
+        self.group_chat.name = 'Renamed'
+        self.group_chat.save()
+        self.assertEqual(self.get_preview()['chat']['name'], 'Renamed')
+
+        self.invite.delete()
+        self.assertEqual(Invite.get_previews([self.directory]), {})
+
+
+class TrackerProvisioningTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            GroupChannel.objects.create(name=f'channel{i}', chat=self.group_chat)
+
+    def create_member(self, name):
+        user = create_user(name)
+        return GroupChatMembership.objects.create(user=user, chat=self.group_chat)
+
+    def test_joining_provisions_every_channel_at_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            membership = self.create_member('other')
+
+        tracker_inserts = [query for query in queries if 'INTO "rooms_backloggrouptracker"' in query['sql']]
+        self.assertEqual(len(tracker_inserts), 1)
+        self.assertEqual(BacklogGroupTracker.objects.filter(user=membership.user).count(), 4)
+
+    def test_large_chats_are_provisioned_by_the_worker(self):
+        members = [self.create_member(f'user{i}') for i in range(3)]
+
+        with patch.object(BacklogGroupTracker, 'inline_limit', 2), patch('rooms.models.channel_layer') as channel_layer:
+            channel_layer.send = AsyncMock()
+            channel = GroupChannel.objects.create(name='large', chat=self.group_chat)
+
+        channel_layer.send.assert_called_once_with('tracker-provisioning', {
+            'type': 'provision_backlog_group',
+            'backlog_group': channel.backlog_group.pk,
+        })
+        self.assertFalse(BacklogGroupTracker.objects.filter(backlog_group=channel.backlog_group).exists())
+
+        TrackerProvisioningConsumer().provision_backlog_group({'backlog_group': channel.backlog_group.pk})
+        self.assertEqual(BacklogGroupTracker.objects.filter(backlog_group=channel.backlog_group).count(), len(members) + 1)
+
+
+class GroupSendManyTests(TestCase):
+    def test_sends_keep_their_order_per_group(self):
+        channel_layer = InMemoryChannelLayer()
+
+        async def send_and_receive():
+            channel = await channel_layer.new_channel()
+            other_channel = await channel_layer.new_channel()
+            await channel_layer.group_add('group', channel)
+            await channel_layer.group_add('other_group', other_channel)
+            await group_send_many(channel_layer, [
+                ('group', {'type': 'test', 'order': 1}),
+                ('other_group', {'type': 'test', 'order': 1}),
+                ('group', {'type': 'test', 'order': 2}),
+            ])
+            received = [await channel_layer.receive(channel) for _ in range(2)]
+            return received, await channel_layer.receive(other_channel)
+
+        received, other_received = async_to_sync(send_and_receive)()
+        self.assertEqual([event['order'] for event in received], [1, 2])
+        self.assertEqual(other_received['order'], 1)
+
+
+class ProtocolTests(TestCase):
+    def test_events_round_trip_with_short_codes(self):
+        event = {'type': 'send_to_client', 'action': 'mark_as_read', 'pk': 1}
+        encoded = protocol.encode(event)
+
+        self.assertLess(len(encoded), len(json.dumps(event)))
+        self.assertEqual(protocol.decode(encoded), {'action': 'mark_as_read', 'pk': 1})
+
+    def test_unknown_actions_are_sent_by_name(self):
+        self.assertEqual(protocol.decode(protocol.encode({'action': 'response'})), {'action': 'response'})
+
+    def test_codes_outside_the_table_are_rejected(self):
+        for code in (0, -1, len(protocol.ACTIONS) + 1, True, 1.0):
+            with self.assertRaises(ValueError):
+                protocol.decode(msgpack.packb([code, {}]))
+
+        with self.assertRaises(ValueError):
+            protocol.decode(b'\xc1')
+        self.assertEqual(protocol.decode(msgpack.packb([len(protocol.ACTIONS), {}])), {'action': protocol.ACTIONS[-1]})
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = create_user("owner")
+        self.client.force_login(self.user)
+
+        image = BytesIO()
+        Image.new('RGB', (300, 200)).save(image, 'PNG')
+        self.image = image.getvalue()
+
+    def send_chunk(self, token, offset, chunk):
+        return self.client.post(
+            reverse('upload-chunk', kwargs={'token': token}), 
+            data=chunk, 
+            content_type='application/octet-stream', 
+            headers={'Upload-Offset': str(offset)}
+        ).json()
+
+    def test_upload_in_chunks(self):
+        response = self.client.post(reverse('create-upload'), {'name': 'image.png', 'size': len(self.image)}).json()
+        token = response['token']
+        middle = len(self.image) // 2
+
+        self.assertEqual(self.send_chunk(token, 0, self.image[:middle])['received'], middle)
+        # a chunk sent from the wrong offset is refused with where to resume from
+        self.assertEqual(self.send_chunk(token, 0, self.image[:middle]), {'status': 409, 'received': middle})
+        with patch('rooms.views.channel_layer') as channel_layer:
+            channel_layer.send = AsyncMock()
+            self.assertEqual(self.send_chunk(token, middle, self.image[middle:])['received'], len(self.image))
+
+        upload = Upload.objects.get(token=token)
+        with open(upload.path(), 'rb') as file:
+            self.assertEqual(file.read(), self.image)
+
+        channel_layer.send.assert_called_once_with('upload-processing', {'type': 'process_upload', 'upload': upload.pk})
+        UploadProcessingConsumer().process_upload({'upload': upload.pk})
+        upload.refresh_from_db()
+        self.assertEqual((upload.width, upload.height), (300, 200))
+        # the image is narrower than the smallest thumbnail width, so it isn't upscaled
+        self.assertEqual([thumbnail['width'] for thumbnail in upload.thumbnails], [300])
+
+    def test_attachment_processed_after_sending(self):
+        upload = Upload.objects.create(user=self.user, name='attachments/image.png', size=len(self.image), received=len(self.image))
+        default_storage.save(upload.name, ContentFile(self.image))
+        group_chat = create_group_chat(self.user)
+        backlog = Backlog.objects.create(kind='message', group=group_chat.channels.first().backlog_group)
+        message = Message.objects.create(user=self.user, content='', backlog=backlog, attachment=upload.name)
+        upload.message = message
+        upload.save()
+
+        upload.process()
+        message.refresh_from_db()
+        self.assertEqual((message.attachment_width, message.attachment_height), (300, 200))
+        self.assertTrue(message.attachment_src().endswith('.jpg'))
+        self.assertIn('.webp 300w', message.attachment_webp_srcset())
+
+        # rendering only uses what was stored
+        default_storage.delete(upload.name)
+        html = render_shared_message(backlog, group_chat)['html']
+        self.assertIn('width="300" height="200"', html)
+        self.assertIn(message.attachment_jpeg_srcset(), html)
+
+    def test_only_images_can_be_uploaded(self):
+        response = self.client.post(reverse('create-upload'), {'name': 'script.js', 'size': 10}).json()
+        self.assertEqual(response['status'], 400)
+
+
+class PresenceTests(GroupChatTestCase):
+    def setUp(self):
+        caches['presence'].clear()
+        super().setUp()
+        self.other = create_user("other")
+        GroupChatMembership.objects.create(user=self.other, chat=self.group_chat)
+
+    def test_online_until_the_last_connection_closes(self):
+        generation, first = presence.connect(self.owner.pk)
+        self.assertTrue(first)
+        self.assertEqual(presence.connect(self.owner.pk), (generation, False))
+        self.assertEqual(presence.get_statuses([self.owner.pk, self.other.pk]), {self.owner.pk: 'online', self.other.pk: 'offline'})
+
+        self.assertFalse(presence.disconnect(self.owner.pk, generation))
+        self.assertEqual(presence.get_status(self.owner.pk), 'online')
+        self.assertTrue(presence.disconnect(self.owner.pk, generation))
+        self.assertEqual(presence.get_status(self.owner.pk), 'offline')
+
+    def test_open_sockets_are_counted_again_after_expiring(self):
+        sockets = [presence.connect(self.owner.pk)[0] for _ in range(3)]
+        caches['presence'].delete(presence.presence_key(self.owner.pk))
+
+        # the two sockets that heartbeat first count themselves again
+        sockets[0], back_online = presence.heartbeat(self.owner.pk, sockets[0])
+        self.assertTrue(back_online)
+        sockets[1], back_online = presence.heartbeat(self.owner.pk, sockets[1])
+        self.assertFalse(back_online)
+
+        # the third closes before its heartbeat, it isn't in the new count
+        self.assertFalse(presence.disconnect(self.owner.pk, sockets[2]))
+        self.assertFalse(presence.disconnect(self.owner.pk, sockets[0]))
+        self.assertEqual(presence.get_status(self.owner.pk), 'online')
+        self.assertTrue(presence.disconnect(self.owner.pk, sockets[1]))
+        self.assertEqual(presence.get_status(self.owner.pk), 'offline')
+
+    def test_changes_are_sent_per_chat(self):
+        sends = presence.resolve_presence_sends({self.owner.pk: 'online', self.other.pk: 'offline'})
+        self.assertEqual(sends, [(f'group_chat_{self.group_chat.pk}', {
+            'type': 'send_to_client',
+            'action': 'update_presence',
+            'statuses': [[self.owner.pk, 'online'], [self.other.pk, 'offline']],
+        })])
+
+    def test_changes_are_sent_to_friends_and_private_chat_partners(self):
+        friend = create_user("friend")
+        partner = create_user("partner")
+        friendship = Friendship.objects.create(status='accepted', sender=self.owner, receiver=friend)
+        Friend.objects.create(friendship=friendship, user=self.owner)
+        Friend.objects.create(friendship=friendship, user=friend)
+        private_chat = PrivateChat.objects.create()
+        PrivateChatMembership.objects.create(chat=private_chat, user=self.owner)
+        PrivateChatMembership.objects.create(chat=private_chat, user=partner)
+
+        sends = dict(presence.resolve_presence_sends({self.owner.pk: 'online'}))
+        self.assertEqual(set(sends), {f'group_chat_{self.group_chat.pk}', f'user_{friend.pk}', f'user_{partner.pk}'})
+        self.assertEqual(sends[f'user_{friend.pk}']['statuses'], [[self.owner.pk, 'online']])
+        self.assertEqual(sends[f'user_{partner.pk}']['statuses'], [[self.owner.pk, 'online']])
+
+    def test_quick_reconnects_are_not_sent(self):
+        dispatcher = presence.PresenceDispatcher()
+        dispatcher.window = 0
+
+        async def schedule_and_flush():
+            dispatcher.schedule(self.owner.pk, 'offline')
+            dispatcher.schedule(self.owner.pk, 'online')
+            dispatcher.schedule(self.other.pk, 'online')
+            await dispatcher.flush()
+
+        with patch('rooms.presence.resolve_presence_sends', return_value=[]) as resolve_presence_sends, patch('rooms.presence.group_send_many'):
+            async_to_sync(schedule_and_flush)()
+
+        resolve_presence_sends.assert_called_once_with({self.other.pk: 'online'})
+
+
+class MemberListTests(GroupChatTestCase):
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+        self.moderator = Role.objects.create(name='moderator', chat=self.group_chat)
+        self.group_chat.role_order = [self.moderator.pk]
+        self.group_chat.save()
+
+        self.memberships = {}
+        for username_id, username in enumerate(('carol', 'alice', 'bob'), start=1):
+            user = create_user(username, username_id=username_id)
+            self.memberships[username] = GroupChatMembership.objects.create(user=user, chat=self.group_chat)
+
+        self.moderator.members.add(self.memberships['carol'])
+
+    def get_rows(self):
+        return members.get_index(self.group_chat)['rows']
+
+    def test_members_are_grouped_by_top_role(self):
+        owner_membership = self.group_chat.get_member(self.owner)
+        self.assertEqual(self.get_rows(), [
+            ('role', self.moderator.pk),
+            ('member', self.memberships['carol'].pk),
+            ('role', self.group_chat.base_role_id),
+            ('member', self.memberships['alice'].pk),
+            ('member', self.memberships['bob'].pk),
+            ('member', owner_membership.pk),
+        ])
+
+    def test_index_follows_nickname_and_role_changes(self):
+        self.get_rows()
+        membership = self.memberships['bob']
+        membership.nickname = 'aaron'
+        membership.save()
+        self.moderator.members.remove(self.memberships['carol'])
+
+        rows = self.get_rows()
+        self.assertEqual(rows[0], ('role', self.group_chat.base_role_id))
+        self.assertEqual(rows[1:3], [('member', membership.pk), ('member', self.memberships['alice'].pk)])
+
+    def test_membership_changes_are_applied_in_place(self):
+        self.get_rows()
+        with patch('rooms.members.build_index', wraps=members.build_index) as build_index:
+            dave = create_user("dave")
+            GroupChatMembership.objects.create(user=dave, chat=self.group_chat)
+            self.moderator.members.add(self.memberships['bob'])
+            self.memberships['carol'].roles.remove(self.moderator)
+            alice = self.memberships['alice']
+            alice.nickname = 'zed'
+            alice.save()
+            alice.user.username = 'alicia'
+            alice.user.save()
+            self.memberships['carol'].delete()
+            index = members.get_index(self.group_chat)
+
+        build_index.assert_not_called()
+        rebuilt = members.build_index(self.group_chat)
+        for key in ('rows', 'roles', 'members', 'member_names'):
+            self.assertEqual(index[key], rebuilt[key])
+
+        self.moderator.name = 'mod'
+        self.moderator.save()
+        self.assertEqual(members.get_index(self.group_chat)['role_details'][self.moderator.pk]['name'], 'mod')
+
+    def test_renders_windows(self):
+        self.get_rows()
+        with self.assertNumQueries(1):
+            member_list = members.render_member_list(self.group_chat, 2, 4)
+
+        self.assertEqual((member_list['start'], member_list['stop'], member_list['total']), (2, 4, 6))
+        self.assertIn('alice', member_list['html'])
+        self.assertNotIn('carol', member_list['html'])
+
+    def test_completes_mentions_from_the_index(self):
+        membership = self.memberships['bob']
+        membership.nickname = 'ace'
+        membership.save()
+        self.get_rows()
+
+        def search(alphanumeric, numeric=None):
+            found_members, found_roles = members.search_mentionables(self.group_chat, alphanumeric, numeric)
+            return [member['user']['full_name'] for member in found_members], [role['name'] for role in found_roles]
+
+        with self.assertNumQueries(0):
+            self.assertEqual(search('A'), (['bob#03', 'alice#02'], ['all']))
+            self.assertEqual(search('bo'), (['bob#03'], []))
+            self.assertEqual(search('carol', '1'), (['carol#01'], []))
+            self.assertEqual(search('carol', '2'), ([], []))
+            self.assertEqual(search('mod'), ([], ['moderator']))
+
+    def test_detail_view_renders_first_window(self):
+        self.client.force_login(self.owner)
+        with patch('rooms.members.WINDOW', 2):
+            response = self.client.get(reverse('group-chat', kwargs={'pk': self.group_chat.pk}))
+
+        self.assertContains(response, 'data-loaded="2" data-total="6"')
+        self.assertContains(response, 'carol')
+        self.assertNotContains(response, 'alice')
+
+
+class EmojiImportTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        image = BytesIO()
+        Image.new('RGB', (8, 8)).save(image, 'PNG')
+        image = 'data:image/png;base64,' + base64.b64encode(image.getvalue()).decode()
+        self.emojis = [
+            {'name': 'grinning face', 'category': 'Smileys', 'emoji': '\U0001f600', 'support': {'apple': True}, 'images': {'apple': image}},
+            {'name': 'thumbs up', 'category': 'People', 'emoji': '\U0001f44d', 'support': {'apple': True}, 'images': {'apple': image}},
+            {'name': 'unsupported', 'category': 'People', 'emoji': '?', 'support': {'apple': False}, 'images': {}},
+        ]
+
+    def import_emojis(self):
+        path = f'{self.media_root.name}/emoji.json'
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'version': 1, 'emojis': self.emojis}, file)
+
+        call_command('create_emojis', 'apple', file=path, stdout=StringIO())
+
+    def test_parses_the_array_incrementally(self):
+        file = StringIO(json.dumps({'emojis': self.emojis, 'after': [1]}))
+        self.assertEqual(list(iter_json_array(file, 'emojis', chunk_size=7)), self.emojis)
+
+    def test_updates_existing_emojis_in_place(self):
+        self.import_emojis()
+        emoji = Emoji.objects.get(name='thumbs up')
+        self.assertEqual(Emoji.objects.count(), 2)
+        self.assertTrue(default_storage.exists(emoji.image.name))
+
+        self.emojis[1]['category'] = 'Gestures'
+        self.import_emojis()
+        self.assertEqual(Emoji.objects.get(pk=emoji.pk).category, 'Gestures')
+        self.assertEqual(Emoji.objects.count(), 2)
+
+
+class EmojiCatalogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.emoji = Emoji.objects.create(name='grinning face', category='Smileys & Emotion', image='emojis/grinning.png', emoji_literal='x')
+        self.user = create_user("owner")
+        self.group_chat = create_group_chat(self.user)
+
+    def test_catalog_is_served_by_content_hash(self):
+        version = emoji_catalog.get_catalog_version()
+        with self.assertNumQueries(0):
+            self.assertEqual(emoji_catalog.get_catalog_version(), version)
+
+        response = self.client.get(reverse('emoji-catalog', kwargs={'version': version}))
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response.json()['categories'][0]['emojis'], [[self.emoji.pk, 'grinning face', '/media/emojis/grinning.png']])
+        self.assertEqual(self.client.get(reverse('emoji-catalog', kwargs={'version': 'unknown'})).status_code, 404)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.emoji.name = 'grinning'
+            self.emoji.save()
+
+        self.assertNotEqual(emoji_catalog.get_catalog_version(), version)
+
+class ReactionTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backlog = Backlog.objects.create(kind='message', group=self.group_chat.channels.first().backlog_group)
+        self.emoji = Emoji.objects.create(name='smile', category='Smileys & Emotion', emoji_literal=':)')
+
+    def count_toggle_queries(self, user):
+        with CaptureQueriesContext(connection) as queries:
+            Reaction.toggle(self.backlog.pk, 'emoji', self.emoji.pk, user.user_archive)
+
+        return len(queries)
+
+    def test_toggle_counts_in_place(self):
+        first = create_user("first")
+        reaction, selected = Reaction.toggle(self.backlog.pk, 'emoji', self.emoji.pk, first.user_archive)
+        self.assertTrue(selected)
+        first_queries = self.count_toggle_queries(self.owner)
+        Reaction.toggle(self.backlog.pk, 'emoji', self.emoji.pk, self.owner.user_archive)
+
+        for i in range(30):
+            user = create_user(f"user{i}")
+            Reaction.toggle(self.backlog.pk, 'emoji', self.emoji.pk, user.user_archive)
+
+        reaction.refresh_from_db()
+        self.assertEqual(reaction.count, 31)
+        self.assertEqual(self.count_toggle_queries(self.owner), first_queries)
+        reaction.refresh_from_db()
+        self.assertEqual(reaction.count, 32)
+
+        _, selected = Reaction.toggle(self.backlog.pk, 'emoji', self.emoji.pk, self.owner.user_archive)
+        self.assertFalse(selected)
+        reaction.refresh_from_db()
+        self.assertEqual(reaction.count, reaction.user_archives.count())
+
+    def test_one_reaction_per_emoticon(self):
+        Reaction.objects.create(kind='emoji', backlog=self.backlog, emoji=self.emoji)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Reaction.objects.create(kind='emoji', backlog=self.backlog, emoji=self.emoji)
+
+    def test_concurrent_toggle_leaves_it_selected(self):
+        reaction, _ = Reaction.toggle(self.backlog.pk, 'emoji', self.emoji.pk, self.owner.user_archive)
+        # the other toggle added it between the check and the insert
+        with patch('django.db.models.query.QuerySet.delete', return_value=(0, {})):
+            _, selected = Reaction.toggle(self.backlog.pk, 'emoji', self.emoji.pk, self.owner.user_archive)
+
+        self.assertTrue(selected)
+        reaction.refresh_from_db()
+        self.assertEqual(reaction.count, 1)
+
+    def test_toggles_in_a_window_are_sent_once(self):
+        other = create_user("other")
+        dispatcher = reactions.ReactionDispatcher()
+        dispatcher.window = 0
+        group = f'group_channel_{self.group_chat.channels.first().pk}'
+
+        async def schedule_and_flush():
+            dispatcher.schedule(group, 1, self.owner.pk, True)
+            dispatcher.schedule(group, 1, other.pk, True)
+            dispatcher.schedule(group, 1, self.owner.pk, False)
+            await dispatcher.flush()
+
+        with patch('rooms.reactions.resolve_reaction_sends', return_value=[]) as resolve_reaction_sends, patch('rooms.reactions.group_send_many'):
+            async_to_sync(schedule_and_flush)()
+
+        resolve_reaction_sends.assert_called_once_with({group: {1: {self.owner.pk: False, other.pk: True}}})
+
+    def test_sends_carry_the_final_counts(self):
+        kept, _ = Reaction.toggle(self.backlog.pk, 'emoji', self.emoji.pk, self.owner.user_archive)
+        frown = Emoji.objects.create(name='frown', category='Smileys & Emotion', emoji_literal=':(')
+        removed, _ = Reaction.toggle(self.backlog.pk, 'emoji', frown.pk, self.owner.user_archive)
+        Reaction.toggle(self.backlog.pk, 'emoji', frown.pk, self.owner.user_archive)
+
+        [(group, event)] = reactions.resolve_reaction_sends({'group': {
+            kept.pk: {self.owner.pk: True},
+            removed.pk: {self.owner.pk: False},
+        }})
+        updates = {update['reaction_pk']: update for update in event['reactions']}
+        self.assertEqual(updates[kept.pk]['count'], 1)
+        self.assertIn(f'reaction-{kept.pk}', updates[kept.pk]['html'])
+        self.assertEqual(updates[removed.pk]['count'], 0)
+        self.assertIsNone(updates[removed.pk]['html'])
+        self.assertEqual(updates[removed.pk]['selected'], [(self.owner.pk, False)])
+
+
+class CachingTests(GroupChatTestCase):
+    def setUp(self):
+        caches['local'].clear()
+        caching.reset_stats()
+        super().setUp()
+
+    def test_chat_summary_is_cached_until_saved(self):
+        self.assertEqual(caching.get_chat_summary(self.group_chat.pk)['name'], 'Test Group Chat')
+        with self.assertNumQueries(0):
+            caching.get_chat_summary(self.group_chat.pk)
+
+        self.group_chat.name = 'Renamed'
+        self.group_chat.save()
+        self.assertEqual(caching.get_chat_summary(self.group_chat.pk)['name'], 'Renamed')
+        self.assertEqual(caching.get_stats()[caching.CHAT], {'hits': 1, 'misses': 2, 'hit_rate': 1 / 3})
+
+    def test_channel_tree_and_role_order_follow_edits(self):
+        [category] = caching.get_channel_tree(self.group_chat.pk)
+        self.assertEqual([channel['name'] for channel in category['channels']], ['General'])
+
+        channel = GroupChannel.objects.create(name='loose', chat=self.group_chat)
+        tree = caching.get_channel_tree(self.group_chat.pk)
+        self.assertEqual(tree[-1], {'kind': 'channel', 'pk': channel.pk, 'name': 'loose', 'backlog_group_pk': channel.backlog_group.pk})
+
+        self.assertEqual([role['name'] for role in caching.get_role_order(self.group_chat.pk)], ['all'])
+        role = Role.objects.create(name='mod', chat=self.group_chat)
+        self.group_chat.role_order = [role.pk]
+        self.group_chat.save()
+        self.assertEqual([role['name'] for role in caching.get_role_order(self.group_chat.pk)], ['mod', 'all'])
+
+    def test_shared_tier_fills_the_local_one(self):
+        shared = LocMemCache('shared', {})
+        self.addCleanup(shared.clear)
+        with patch('rooms.caching.get_tiers', return_value=(caches['local'], shared)):
+            caching.get_chat_summary(self.group_chat.pk)
+            caches['local'].clear()
+            with self.assertNumQueries(0):
+                self.assertEqual(caching.get_chat_summary(self.group_chat.pk)['name'], 'Test Group Chat')
+
+            self.assertIsNotNone(caches['local'].get(caching.make_key(caching.CHAT, self.group_chat.pk)))
+
+    def test_versioned_values_skip_the_local_tier(self):
+        shared = LocMemCache('shared', {})
+        self.addCleanup(shared.clear)
+        with patch('rooms.caching.get_tiers', return_value=(caches['local'], shared)):
+            caching.get_role_order(self.group_chat.pk)
+            # what another process changed, while this one still has the old copy
+            stale = caching.get_role_order(self.group_chat.pk)
+            shared.delete(caching.make_key(caching.ROLES, self.group_chat.pk))
+            base_role = self.group_chat.base_role
+            Role.objects.filter(pk=base_role.pk).update(color='#123456')
+            caches['local'].set(caching.make_key(caching.ROLES, self.group_chat.pk), stale)
+
+            self.assertEqual(caching.get_role_order(self.group_chat.pk), stale)
+            self.assertEqual(caching.get_role_order(self.group_chat.pk, local=False)[0]['color'], '#123456')
+
+
+class ChannelTreeTests(GroupChatTestCase):
+    def setUp(self):
+        cache.clear()
+        caches['local'].clear()
+        super().setUp()
+        self.hidden = GroupChannel.objects.create(name='hidden', chat=self.group_chat)
+        self.group_chat.base_role.can_see_channels.remove(self.hidden)
+        self.group_chat.base_role.can_see_categories.add(*self.group_chat.categories.all())
+
+    def create_member(self, username):
+        user = create_user(username)
+        GroupChatMembership.objects.create(user=user, chat=self.group_chat)
+        return GroupChatMembership.objects.select_related('chat').get(user=user)
+
+    def channel_names(self, sidebar):
+        names = []
+        for item in sidebar:
+            if item['kind'] == 'category':
+                names.extend(channel['name'] for channel in item['channels'])
+            else:
+                names.append(item['name'])
+
+        return names
+
+    def test_members_see_what_their_roles_can_see(self):
+        member = self.create_member('member')
+        owner_membership = GroupChatMembership.objects.select_related('chat').get(user=self.owner)
+        self.assertEqual(self.channel_names(channel_tree.build_sidebar(member)), ['General'])
+        self.assertEqual(self.channel_names(channel_tree.build_sidebar(owner_membership)), ['General', 'hidden'])
+
+        self.group_chat.base_role.can_see_channels.add(self.hidden)
+        self.assertEqual(self.channel_names(channel_tree.build_sidebar(member)), ['General', 'hidden'])
+
+    def test_tree_is_shared_by_members_with_the_same_roles(self):
+        channel_tree.build_sidebar(self.create_member('first'))
+        second = self.create_member('second')
+        # the roles of the member and their trackers
+        with self.assertNumQueries(2):
+            channel_tree.build_sidebar(second)
+
+    def test_unread_counts_are_put_in(self):
+        member = self.create_member('member')
+        general = self.group_chat.channels.get(name='General')
+        BacklogGroupTracker.objects.filter(user=member.user, backlog_group=general.backlog_group).update(unread_count=3, mention_count=1)
+
+        [category] = channel_tree.build_sidebar(member)
+        self.assertEqual(category['channels'][0]['notifications']['initial'], {'unread_backlogs': 3, 'mentions': 1})
+
+
+class MessageFragmentTests(GroupChatTestCase):
+    def setUp(self):
+        cache.clear()
+        caches['local'].clear()
+        super().setUp()
+        self.other = create_user("other")
+        self.other_membership = GroupChatMembership.objects.create(user=self.other, chat=self.group_chat)
+        self.backlog_group = self.group_chat.channels.first().backlog_group
+        self.emoji = Emoji.objects.create(name='smile', category='Smileys & Emotion', emoji_literal=':)')
+
+        self.backlog = Backlog.objects.create(kind='message', group=self.backlog_group)
+        self.message = Message.objects.create(user=self.other, content='hello', backlog=self.backlog)
+        for i in range(10):
+            backlog = Backlog.objects.create(kind='message', group=self.backlog_group)
+            Message.objects.create(user=self.other, content=f'message {i}', backlog=backlog)
+
+    def render_page(self, user):
+        backlogs, cursor = self.backlog_group.get_backlog_page(size=20)
+        with CaptureQueriesContext(connection) as queries:
+            html = render_backlogs(backlogs, user, self.group_chat.get_member(user), self.group_chat)
+
+        return html, len(queries)
+
+    def test_other_viewers_hit_the_cache(self):
+        _, cold_queries = self.render_page(self.owner)
+        hits = caching.get_stats()['message']['hits']
+        html, warm_queries = self.render_page(self.other)
+
+        self.assertEqual(caching.get_stats()['message']['hits'] - hits, 11)
+        self.assertLess(warm_queries, cold_queries)
+        self.assertEqual(html.count('data-command="edit_message"'), 11)
+
+    def test_edits_reactions_and_colors_change_the_version(self):
+        self.render_page(self.owner)
+
+        self.message.content = 'edited'
+        self.message.save()
+        self.assertIn('edited', self.render_page(self.owner)[0])
+
+        Reaction.toggle(self.backlog.pk, 'emoji', self.emoji.pk, self.other.user_archive)
+        html, _ = self.render_page(self.owner)
+        self.assertRegex(html, r'data-role="counter">\s*1\s*<')
+        self.assertNotIn('backlog__reaction--selected', html)
+        self.assertIn('backlog__reaction--selected', self.render_page(self.other)[0])
+
+        base_role = self.group_chat.base_role
+        base_role.color = '#123456'
+        base_role.save()
+        self.assertIn('color: #123456', self.render_page(self.owner)[0])
+
+    def test_only_the_authors_changes_miss_the_cache(self):
+        self.render_page(self.owner)
+        newcomer = create_user("newcomer")
+        GroupChatMembership.objects.create(user=newcomer, chat=self.group_chat)
+        self.group_chat.get_member(self.owner).save()
+
+        misses = caching.get_stats()['message']['misses']
+        self.render_page(self.owner)
+        self.assertEqual(caching.get_stats()['message']['misses'], misses)
+
+        self.other_membership.nickname = 'renamed'
+        self.other_membership.save()
+        self.assertIn('renamed', self.render_page(self.owner)[0])
+
+
+class ConsumerTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = create_user("other", username_id=1)
+        self.membership = GroupChatMembership.objects.create(user=self.other, chat=self.group_chat)
+        self.backlog_group = self.group_chat.channels.first().backlog_group
+
+        self.consumer = GroupChatConsumer()
+        self.consumer.user = self.other
+        self.consumer.user_archive = self.other.user_archive
+        self.consumer.group_chat = self.group_chat
+        self.consumer.backlog_group = self.backlog_group
+        self.consumer.context_member = self.membership
+        self.consumer.tracker = BacklogGroupTracker.objects.get(user=self.other, backlog_group=self.backlog_group)
+
+    def create_message(self, content):
+        backlog = Backlog.objects.create(kind='message', group=self.backlog_group)
+        Message.objects.create(user=self.owner, content=content, backlog=backlog)
+        return backlog
+
+    def test_mark_as_read(self):
+        self.create_message('hello')
+        last = self.create_message(f'hello >>{self.other.full_name()}')
+        async_to_sync(self.consumer.tracker.amark_as_read)()
+
+        tracker = BacklogGroupTracker.objects.get(pk=self.consumer.tracker.pk)
+        self.assertEqual((tracker.unread_count, tracker.mention_count, tracker.last_backlog_seen), (0, 0, last))
+
+    def test_malformed_cursors_are_ignored(self):
+        with patch.object(self.consumer, 'send_event', new_callable=AsyncMock) as send_event:
+            async_to_sync(self.consumer.generate_backlogs)(before='latest')
+            async_to_sync(self.consumer.generate_backlogs)(before=['1'])
+
+        send_event.assert_not_called()
+
+    def test_an_upload_is_attached_once(self):
+        upload = Upload.objects.create(user=self.other, name='attachments/image.png', size=1, received=1)
+        self.assertIsNotNone(async_to_sync(super(GroupChatConsumer, self.consumer).create_message)(attachment=str(upload.token)))
+        self.assertIsNone(async_to_sync(super(GroupChatConsumer, self.consumer).create_message)(attachment=str(upload.token)))
+
+        # a send of the same token that got past the lock
+        upload = Upload.objects.create(user=self.other, name='attachments/other.png', size=1, received=1)
+        messages = Message.objects.count()
+        with patch.object(Upload, 'save', side_effect=IntegrityError):
+            self.assertIsNone(async_to_sync(super(GroupChatConsumer, self.consumer).create_message)(content='hi', attachment=str(upload.token)))
+        self.assertEqual(Message.objects.count(), messages)
+
+    def test_is_mentioned(self):
+        moderator = Role.objects.create(name='moderator', chat=self.group_chat)
+        moderator.members.add(self.membership)
+
+        self.assertTrue(async_to_sync(self.consumer.is_mentioned)(self.create_message(f'>>{self.other.full_name()}').pk))
+        self.assertTrue(async_to_sync(self.consumer.is_mentioned)(self.create_message('>>moderator').pk))
+        self.assertFalse(async_to_sync(self.consumer.is_mentioned)(self.create_message('hello').pk))
+
+    def test_reactions_are_validated_and_toggled_at_once(self):
+        emoji = Emoji.objects.create(name='smile', category='Smileys & Emotion', emoji_literal=':)')
+        backlog = self.create_message('hello')
+        other_backlog = GroupChannel.objects.create(name='other', chat=self.group_chat).backlog_group.backlogs.create(kind='message')
+
+        self.assertIsNone(async_to_sync(self.consumer.toggle_reaction)('emoji', emoji.pk, other_backlog.pk))
+        self.assertIsNone(async_to_sync(self.consumer.toggle_reaction)('emote', emoji.pk, backlog.pk))
+
+        reaction_pk, selected = async_to_sync(self.consumer.toggle_reaction)('emoji', emoji.pk, backlog.pk)
+        self.assertTrue(selected)
+        self.assertEqual(Reaction.objects.get(pk=reaction_pk).count, 1)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ConsumerAccessTests(GroupChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = create_user("other", username_id=1)
+        self.stranger = create_user("stranger", username_id=2)
+        self.membership = GroupChatMembership.objects.create(user=self.other, chat=self.group_chat)
+        self.group_channel = self.group_chat.channels.first()
+
+        self.private_chat = PrivateChat.objects.create()
+        PrivateChatMembership.objects.create(chat=self.private_chat, user=self.owner)
+        PrivateChatMembership.objects.create(chat=self.private_chat, user=self.other)
+        backlog = Backlog.objects.create(kind='message', group=self.private_chat.backlog_group)
+        Message.objects.create(user=self.owner, content='secret', backlog=backlog)
+
+    def connect(self, user, path):
+        """
+        Returns whether the socket was accepted, and the first event sent.
+        """
+        async def connect():
+            async def application(scope, receive, send):
+                return await URLRouter(websocket_urlpatterns)({**scope, 'user': user, 'cookies': {'csrftoken': 'test'}}, receive, send)
+
+            communicator = WebsocketCommunicator(application, path)
+            connected, _ = await communicator.connect()
+            event = await communicator.receive_json_from() if connected else None
+            await communicator.disconnect()
+            return connected, event
+
+        return async_to_sync(connect)()
+
+    def test_members_get_the_backlogs(self):
+        connected, event = self.connect(self.other, f'/ws/app/private-chat/{self.private_chat.pk}/')
+        self.assertTrue(connected)
+        self.assertIn('secret', event['html'])
+
+        connected, event = self.connect(self.other, f'/ws/app/group-chat/{self.group_chat.pk}/{self.group_channel.pk}/')
+        self.assertTrue(connected)
+        self.assertEqual(event['action'], 'generate_backlogs')
+
+    def test_strangers_are_rejected(self):
+        self.assertFalse(self.connect(self.stranger, f'/ws/app/private-chat/{self.private_chat.pk}/')[0])
+        self.assertFalse(self.connect(self.stranger, f'/ws/app/group-chat/{self.group_chat.pk}/')[0])
+        self.assertFalse(self.connect(self.stranger, f'/ws/app/group-chat/{self.group_chat.pk}/{self.group_channel.pk}/')[0])
+        self.assertFalse(BacklogGroupTracker.objects.filter(user=self.stranger).exists())
+
+    def test_hidden_channels_are_rejected(self):
+        hidden = GroupChannel.objects.create(name='hidden', chat=self.group_chat)
+        self.group_chat.base_role.can_see_channels.remove(hidden)
+
+        self.assertFalse(self.connect(self.other, f'/ws/app/group-chat/{self.group_chat.pk}/{hidden.pk}/')[0])
+        self.assertTrue(self.connect(self.owner, f'/ws/app/group-chat/{self.group_chat.pk}/{hidden.pk}/')[0])
@@ -0,0 +1,53 @@
+"""
+Attachment thumbnails.
+
+Attachments get their dimensions read and their thumbnails generated once,
+when the upload is processed, so that rendering a backlog only ever works
+with the stored values and never has to open the original file.
+
+The thumbnails are a list of {'width': int, 'webp': url, 'jpeg': url}
+ordered by width, to be served as a srcset with the jpeg as the fallback.
+"""
+from PIL import Image
+from sorl.thumbnail import get_thumbnail
+
+from django.core.files.storage import default_storage
+
+
+WIDTHS = (320, 640, 1280)
+FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+QUALITY = 85
+
+
+def get_widths(width):
+    # never upscale, an image narrower than the largest width gets its own
+    # width as the last size instead
+    return [size for size in WIDTHS if size < width] + [min(width, WIDTHS[-1])]
+
+
+def process_image(name):
+    """
+    Takes the name of an image in the default storage and returns
+    (width, height, thumbnails).
+    """
+    with Image.open(default_storage.path(name)) as image:
+        width, height = image.size
+        animated = getattr(image, 'is_animated', False)
+
+    # thumbnails would only keep the first frame
+    if animated:
+        return width, height, []
+
+    thumbnails = []
+    for size in get_widths(width):
+        thumbnail = {'width': size}
+        for key, format in FORMATS.items():
+            thumbnail[key] = get_thumbnail(name, str(size), format=format, quality=QUALITY).url
+
+        thumbnails.append(thumbnail)
+
+    return width, height, thumbnails
+
+
+def build_srcset(thumbnails, key):
+    return ', '.join(f'{thumbnail[key]} {thumbnail["width"]}w' for thumbnail in thumbnails)
@@ -0,0 +1,48 @@
+"""
+Splits message content into a stream of tokens in a single pass:
+
+    ('text', None, text)
+    ('user_mention', (username, username_id), text)
+    ('role_mention', role_name, text)
+    ('invite', directory, text)
+
+where text is the part of the content the token was made from, so that
+joining the texts gives back the content.
+"""
+import re
+
+
+UUID4 = r'[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}'
+
+TOKEN_PATTERN = re.compile(
+    r'(?<!\w)(?:'
+    rf'>>(?P<username>\w+)#(?P<username_id>\d{{2}})(?!\w)'
+    rf'|>>(?P<role_name>\w+)(?!\w)'
+    rf'|DjangoChatApp/(?P<directory>{UUID4})(?!\w)'
+    r')'
+)
+
+
+def tokenize(content):
+    tokens = []
+    position = 0
+
+    for match in TOKEN_PATTERN.finditer(content):
+        start, end = match.span()
+        if start > position:
+            tokens.append(('text', None, content[position:start]))
+
+        text = match.group()
+        if match.group('username') is not None:
+            tokens.append(('user_mention', (match.group('username'), int(match.group('username_id'))), text))
+        elif match.group('role_name') is not None:
+            tokens.append(('role_mention', match.group('role_name'), text))
+        else:
+            tokens.append(('invite', match.group('directory'), text))
+
+        position = end
+
+    if position < len(content):
+        tokens.append(('text', None, content[position:]))
+
+    return tokens
@@ -39,4 +39,9 @@ urlpatterns = [
     
     path('emote-menu/<int:group_chat_pk>/', views.EmoteMenuView.as_view(), name='emote-menu'),
     path('emote-menu/', views.EmoteMenuView.as_view(), name='emote-menu', kwargs={'group_chat_pk': None}),
+    path('emoji-catalog/<str:version>.json', views.EmojiCatalogView.as_view(), name='emoji-catalog'),
+    path('cache-stats/', views.CacheStatsView.as_view(), name='cache-stats'),
+
+    path('upload/', views.UploadCreateView.as_view(), name='create-upload'),
+    path('upload/<uuid:token>/', views.UploadChunkView.as_view(), name='upload-chunk'),
 ]
\ No newline at end of file
@@ -0,0 +1,51 @@
+"""
+Versions of cached values.
+
+What's cached per chat or per backlog is keyed on a version kept in the
+shared cache, so that bumping it there is enough for every process to stop
+using what it has, see the signals in rooms/signals.py.
+
+Versions start from the clock rather than 1, so that a version evicted from
+the cache can't come back and match values that are still cached under it.
+"""
+import time
+
+from django.core.cache import cache
+
+
+def version_key(namespace, pk):
+    return f'{namespace}:{pk}:version'
+
+
+def get_versions(namespace, pks):
+    """
+    Returns {pk: version}, starting the versions that aren't in the cache.
+    """
+    keys = {version_key(namespace, pk): pk for pk in pks}
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        version = int(time.time() * 1000)
+        for key in missing:
+            cache.add(key, version, timeout=None)
+        versions.update(cache.get_many(missing))
+        # evicted again in between
+        for key in missing:
+            versions.setdefault(key, version)
+
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def get_version(namespace, pk):
+    return get_versions(namespace, [pk])[pk]
+
+
+def bump(namespace, pk):
+    """
+    Returns the new version, or None if there was none to bump, in which
+    case nothing was cached under it either.
+    """
+    try:
+        return cache.incr(version_key(namespace, pk))
+    except ValueError:
+        return None
@@ -6,7 +6,7 @@ from django.forms.models import BaseModelForm
 
 from django.views.generic import TemplateView, DetailView, CreateView, UpdateView, FormView, DeleteView, View, ListView
 from django.urls import reverse, reverse_lazy
-from django.http import HttpResponse, JsonResponse 
+from django.http import HttpResponse, JsonResponse, Http404
 from django.template.loader import render_to_string
 from django.db.models import Q
 from channels.layers import get_channel_layer
@@ -14,6 +14,9 @@ from asgiref.sync import async_to_sync
 from django.views.decorators.csrf import requires_csrf_token
 from django.utils.decorators import method_decorator
 from django.shortcuts import render
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.utils.text import get_valid_filename
+from django.db import transaction
 
 from users.models import CustomUser, Friend, Friendship
 from core.models import Archive
@@ -27,11 +30,15 @@ from .models import (
     PrivateChatMembership,
     BacklogGroupTracker,
     Emote,
-    Emoji,
     BacklogGroup,
     Role,
+    Upload,
 )
 from . import forms
+from .members import render_member_list
+from .channel_tree import build_sidebar
+from .emoji_catalog import get_catalog_version, read_catalog
+from .caching import get_emotes, get_stats
 from utils import get_object_or_none, process_mention
 
 channel_layer = get_channel_layer()
@@ -86,10 +93,10 @@ class GroupChatDetailView(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        memberships = self.object.memberships.all().select_related('user')
-        context['memberships'] = memberships
-        user_membership = memberships.get(user=self.request.user)
+        context['member_list'] = render_member_list(self.object)
+        user_membership = self.object.memberships.get(user=self.request.user)
         context['context_member'] = user_membership
+        context['channel_tree'] = build_sidebar(user_membership)
         return context
 
 
@@ -126,7 +133,7 @@ class GroupChannelCreateView(CreateView):
         async_to_sync(channel_layer.group_send)(f'group_chat_{group_chat.pk}', {
             'type': 'send_to_client',
             'action': 'create_group_channel',
-            'html': render_to_string(request=self.request, template_name='rooms/elements/channel.html', context={'channel': channel, 'created': True}),
+            'html': render_to_string(request=self.request, template_name='rooms/elements/channel.html', context={'channel': channel, 'group_chat': group_chat}),
             'category': getattr(channel, 'category', None) and channel.category.pk,
         })
 
@@ -142,10 +149,10 @@ class GroupChannelDetailView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['group_chat'] = self.object.chat
-        memberships = self.object.chat.memberships.all().select_related('user')
-        context['memberships'] = memberships
-        user_membership = memberships.get(user=self.request.user)
+        context['member_list'] = render_member_list(self.object.chat)
+        user_membership = self.object.chat.memberships.get(user=self.request.user)
         context['context_member'] = user_membership
+        context['channel_tree'] = build_sidebar(user_membership)
         return context
 
 
@@ -457,32 +464,44 @@ class EmoteDeleteView(DeleteView):
 
 
 class EmoteMenuView(TemplateView):
-    template_name = 'rooms/tooltips/emotes-menu.html'
+    template_name = 'rooms/tooltips/emotes-menu/emotes-menu.html'
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         group_chat_pk = self.kwargs.get('group_chat_pk')
-        context['group_chat'] = get_object_or_none(GroupChat, pk=group_chat_pk)
-        categories = [
-            'Smileys & Emotion',
-            'People & Body',
-            'Symbols',
-            'Objects',
-            'Flags',
-            'Travel & Places',
-            'Food & Drink',
-            'Activities',
-            'Component',
-            'Animals & Nature',
-        ]
-
-        context['emojis'] = {
-            category: Emoji.objects.filter(category=category) 
-            for category in categories
-        }
+        context['chat'] = get_object_or_none(GroupChat, pk=group_chat_pk)
+        context['emotes'] = get_emotes(context['chat'].pk) if context['chat'] else []
+        context['catalog'] = reverse('emoji-catalog', kwargs={'version': get_catalog_version()})
         return context
 
 
+class EmojiCatalogView(View):
+    """
+    Serves the compiled emoji catalog, see rooms/emoji_catalog.py. The name 
+    changes with the content, so it can be cached forever.
+    """
+    def get(self, request, *args, **kwargs):
+        content = read_catalog(kwargs.get('version'))
+        if content is None:
+            raise Http404
+
+        return HttpResponse(content, content_type='application/json', headers={
+            'Cache-Control': 'public, max-age=31536000, immutable',
+        })
+
+
+class CacheStatsView(View):
+    """
+    The hits and misses of rooms/caching.py in the process serving the 
+    request, for staff tuning the timeouts.
+    """
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            raise Http404
+
+        return JsonResponse(get_stats())
+
+
 class UserProfileCardView(View):
     def get(self, request, *args, **kwargs):
         user = get_object_or_none(CustomUser, pk=kwargs.get('user_pk'))
@@ -757,4 +776,67 @@ class RoleOrderUpdateView(UpdateView):
 
     def form_invalid(self, form):
         return JsonResponse({'status': 400, 'errors': form.errors.get_json_data()})
-    
\ No newline at end of file
+    
+
+class UploadCreateView(LoginRequiredMixin, View):
+    """
+    Starts a chunked upload, the file is then sent to UploadChunkView and 
+    attached to a message through the returned token.
+    """
+    extensions = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+    def post(self, request, *args, **kwargs):
+        name = Path(request.POST.get('name', '')).name
+        size = request.POST.get('size', '')
+
+        if Path(name).suffix.lower() not in self.extensions:
+            return JsonResponse({'status': 400, 'errors': {'file': [{'message': 'Only images can be attached.'}]}})
+        if not size.isdigit() or not 0 < int(size) <= Upload.max_size:
+            return JsonResponse({'status': 400, 'errors': {'file': [{'message': 'The file is too large.'}]}})
+
+        upload = Upload(user=request.user, size=int(size))
+        upload.name = f'attachments/{upload.token}/{get_valid_filename(name)}'
+        upload.save()
+
+        return JsonResponse({'status': 200, 'token': str(upload.token), 'received': 0})
+
+
+class UploadChunkView(LoginRequiredMixin, View):
+    """
+    Receives the file of an upload in order, one chunk per request, with the
+    Upload-Offset header set to where the chunk starts. An upload that got 
+    interrupted resumes from the `received` returned by GET.
+    """
+    def get(self, request, *args, **kwargs):
+        upload = get_object_or_none(Upload, token=kwargs['token'], user=request.user)
+        if not upload:
+            return JsonResponse({'status': 404})
+
+        return JsonResponse({'status': 200, 'received': upload.received})
+
+    def post(self, request, *args, **kwargs):
+        if int(request.META.get('CONTENT_LENGTH') or 0) > Upload.max_chunk_size:
+            return JsonResponse({'status': 413})
+        
+        with transaction.atomic():
+            upload = Upload.objects.select_for_update().filter(token=kwargs['token'], user=request.user).first()
+            if not upload:
+                return JsonResponse({'status': 404})
+            if request.headers.get('Upload-Offset') != str(upload.received):
+                return JsonResponse({'status': 409, 'received': upload.received})
+
+            try:
+                # the chunk is streamed to the file rather than read whole
+                upload.received += upload.write_chunk(iter(lambda: request.read(64 * 1024), b''))
+            except ValueError:
+                return JsonResponse({'status': 400, 'received': upload.received})
+            
+            upload.save(update_fields=['received'])
+
+        if upload.is_complete():
+            async_to_sync(channel_layer.send)('upload-processing', {
+                'type': 'process_upload',
+                'upload': upload.pk,
+            })
+
+        return JsonResponse({'status': 200, 'received': upload.received})
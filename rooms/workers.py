@@ -0,0 +1,33 @@
+from channels.consumer import SyncConsumer
+
+from .models import BacklogGroup, BacklogGroupTracker, GroupChatMembership, Upload
+
+
+class TrackerProvisioningConsumer(SyncConsumer):
+    """
+    Backfills the trackers of new channels in large chats, run it with:
+    python manage.py runworker tracker-provisioning
+    """
+    def provision_backlog_group(self, event):
+        backlog_group = BacklogGroup.objects.filter(pk=event['backlog_group']).select_related('group_channel').first()
+        if not backlog_group:
+            # the channel was deleted in the meantime
+            return
+
+        user_pks = GroupChatMembership.objects.filter(
+            chat=backlog_group.group_channel.chat_id
+        ).values_list('user', flat=True).iterator(chunk_size=BacklogGroupTracker.batch_size)
+        BacklogGroupTracker.provision(user_pks, [backlog_group.pk])
+
+
+class UploadProcessingConsumer(SyncConsumer):
+    """
+    Reads what's needed from finished uploads away from the requests, run it with:
+    python manage.py runworker upload-processing
+    """
+    def process_upload(self, event):
+        upload = Upload.objects.filter(pk=event['upload']).first()
+        if not upload:
+            return
+
+        upload.process()
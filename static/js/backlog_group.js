@@ -1,13 +1,18 @@
 const backlogs = document.getElementById('backlogs');
+// pk of the oldest loaded backlog, set by the generate_backlogs handler,
+// null once there's no older history left or while a page is on its way
+let backlogsCursor = null;
 window.onload = (event) => {
     backlogs.addEventListener('scroll', () => {
-        if (!(backlogs.scrollTop === 0)) {
+        if (!(backlogs.scrollTop === 0) || backlogsCursor === null) {
             return;
         };
  
         chatSocket.send(JSON.stringify({
             'action': 'generate_backlogs',
+            'before': backlogsCursor,
         }));
+        backlogsCursor = null;
     });
 };
 const chatbar = document.getElementById('chatbar');
@@ -40,23 +45,45 @@ chatbar.addEventListener('keydown', async (event) => {
             'content': content
         };
 
-        const fileReader = new FileReader();
-        fileReader.onload = (event) => {
-            const dataUrl = event.target.result;
+        if (file) {
+            sendData.attachment = await uploadAttachment(file);
+            if (!sendData.attachment) {
+                return;
+            };
+        };
 
-            sendData.file = {
-                'data': dataUrl,
-                'name': file.name,
-            }
+        sendMessage(sendData);
+    };
+});
 
-            sendMessage(sendData);
-        };
-        
-        if (file) {
-            fileReader.readAsDataURL(file);
-        }
-        else {
-            sendMessage(sendData);
+async function uploadAttachment(file) {
+    // the file is uploaded in chunks, the message then refers to it by its token
+    const chunkSize = 1024 * 1024;
+    const headers = {'X-CSRFToken': getCookie('csrftoken')};
+
+    let formData = new FormData();
+    formData.append('name', file.name);
+    formData.append('size', file.size);
+    let response = await (await fetch('/rooms/upload/', {method: 'POST', headers: headers, body: formData})).json();
+    if (response.status != 200) {
+        return null;
+    };
+
+    let token = response.token;
+    let received = response.received;
+    while (received < file.size) {
+        response = await (await fetch(`/rooms/upload/${token}/`, {
+            method: 'POST',
+            headers: {...headers, 'Upload-Offset': received},
+            body: file.slice(received, received + chunkSize),
+        })).json();
+
+        // on a conflict the server says where to carry on from
+        if (response.status != 200 && response.status != 409) {
+            return null;
         };
+        received = response.received;
     };
-});
\ No newline at end of file
+
+    return token;
+};
\ No newline at end of file
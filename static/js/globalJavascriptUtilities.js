@@ -92,6 +92,87 @@ function parseHTML(string) {
     return new DOMParser().parseFromString(string, "text/html").querySelector('body > *');
 };
 
+function buildMessageAction(command, icon, attributes = {}) {
+    let action = document.createElement('div');
+    action.className = 'backlog__action';
+    command && (action.dataset.command = command);
+    Object.entries(attributes).forEach(([name, value]) => action.setAttribute(name, value));
+    action.innerHTML = `<div class="icon icon--small"><i class="material-symbols-outlined">${icon}</i></div>`;
+    return action;
+};
+
+// the action buttons of message-actions.html, from the flags of the overlay
+function buildMessageActions(pk, {can_react, can_edit, can_delete}) {
+    let actions = [];
+    can_react && actions.push(buildMessageAction('get_emote_menu', 'add_reaction', {
+        'data-positioning': '{"top": "0px", "right": "100%"}',
+        'data-kwargs': JSON.stringify({pk: String(pk)}),
+        'data-handler': 'reactBacklog',
+    }));
+    can_edit && actions.push(buildMessageAction('edit_message', 'edit'));
+    can_delete && actions.push(buildMessageAction('delete_backlog', 'delete'));
+    actions.push(buildMessageAction(null, 'more_vert'));
+    return actions;
+};
+
+// a message like message.html renders it, from the fields sent on the compact protocol (see rooms/protocol.py)
+function buildMessage(pk, fields) {
+    let message = parseHTML(`
+        <div class="backlog backlog--message" data-pk="">
+            <div class="backlog__avatar">
+                <div class="avatar avatar--small"><img src="" alt=""></div>
+            </div>
+            <div class="backlog__username" data-command="get_tooltip" data-name="user-profile-card" data-positioning='{"top": "0px", "left": "100%"}'></div>
+            <div class="backlog__timestamp"></div>
+            <div class="backlog__content" data-role="content"></div>
+            <div class="backlog__invites" data-role="invites"></div>
+            <div class="backlog__reactions" data-role="reactions"></div>
+            <div class="backlog__actions has-shadow"></div>
+        </div>
+    `);
+    message.id = `backlog-${pk}`;
+    message.dataset.pk = pk;
+    message.querySelector('.backlog__avatar img').src = fields.image;
+
+    let username = message.querySelector('.backlog__username');
+    username.textContent = fields.display_name;
+    username.style.color = fields.display_color;
+    username.dataset.kwargs = fields.profile_kwargs;
+
+    message.querySelector('.backlog__timestamp').textContent = fields.timestamp;
+    // rendered and escaped by Message.render_tokens
+    message.querySelector('[data-role="content"]').innerHTML = fields.content;
+
+    let attachment = fields.attachment;
+    if (attachment) {
+        let wrapper = document.createElement('div');
+        wrapper.className = 'backlog__attachment';
+        let picture = document.createElement('picture');
+        let image = document.createElement('img');
+        if (attachment.webp_srcset) {
+            let source = document.createElement('source');
+            source.type = 'image/webp';
+            source.srcset = attachment.webp_srcset;
+            source.sizes = '(max-width: 640px) 100vw, 640px';
+            picture.appendChild(source);
+            image.srcset = attachment.jpeg_srcset;
+            image.sizes = '(max-width: 640px) 100vw, 640px';
+        };
+        image.src = attachment.src;
+        if (attachment.width) {
+            image.width = attachment.width;
+            image.height = attachment.height;
+        };
+        image.loading = 'lazy';
+        image.alt = '';
+        picture.appendChild(image);
+        wrapper.appendChild(picture);
+        message.querySelector('[data-role="invites"]').insertAdjacentElement('afterend', wrapper);
+    };
+
+    return message;
+};
+
 function objectSelector(data) {
     return `[data-model="${data.model}"][data-app="${data.app}"][data-pk="${data.pk}"]`
 }
@@ -125,6 +206,11 @@ async function getView({name, kwargs, query, format}) {
     return response;
 }
 
+function getCookie(name) {
+    let cookie = document.cookie.split('; ').find((cookie) => cookie.startsWith(`${name}=`));
+    return cookie ? decodeURIComponent(cookie.split('=')[1]) : null;
+};
+
 async function submitForm(form) {
     let request = await fetch(form.action, {
         method: form.method,
@@ -191,9 +277,10 @@ async function getTemplate({templateName, context}) {
     return template;
 }
 
-function increaseCounter(element) {
+function increaseCounter(element, times) {
+    let increaseBy = times ? times : 1;
     let counter = element.querySelector('[data-role="counter"]');
-    let newCount = parseInt(counter.innerText) + 1;
+    let newCount = parseInt(counter.innerText) + increaseBy;
     counter.innerText = newCount;
     counter.dataset.count = newCount;
     return newCount;
@@ -214,12 +301,13 @@ function setCounter(element, newCount) {
     counter.dataset.count = newCount;
 }
 
-function addNotification(element, notification_id, kind) {
+function addNotification(element, notification_id, kind, times) {
+    let increaseBy = times ? times : 1;
     let notification = element.querySelector(`.notification[data-notification-kind="${kind}"]`);
     let elementNotifications = JSON.parse(element.dataset.notifications);
-    elementNotifications[notification_id] = elementNotifications[notification_id] ? elementNotifications[notification_id] + 1 : 1;
+    elementNotifications[notification_id] = elementNotifications[notification_id] ? elementNotifications[notification_id] + increaseBy : increaseBy;
     element.setAttribute('data-notifications', JSON.stringify(elementNotifications));
-    increaseCounter(notification);
+    increaseCounter(notification, increaseBy);
 }
 
 function removeNotification(element, notification_id, kind) {
@@ -41,8 +41,19 @@ const chatSocketReceiveHandlers = {
         console.log('response exists') 
     },
 
-    'create_message': ({html, is_sender}) => {
-        let newMessage = parseHTML(html);
+    'create_message': ({html, pk, message, is_sender, is_mentioned, actions, invites}) => {
+        // the html or the fields are shared by every viewer, apply this viewer's overlay
+        let newMessage;
+        if (html) {
+            newMessage = parseHTML(html);
+            newMessage.querySelector('.backlog__actions').innerHTML = actions;
+        }
+        else {
+            newMessage = buildMessage(pk, message);
+            newMessage.querySelector('.backlog__actions').append(...buildMessageActions(pk, actions));
+        };
+        is_mentioned && newMessage.classList.add('backlog--mentioned');
+        newMessage.querySelector('[data-role="invites"]').innerHTML = invites;
         let scrollbarWasAtBottom = scrollbarAtBottom(backlogs);
         backlogs.appendChild(newMessage);
         
@@ -110,6 +121,19 @@ const chatSocketReceiveHandlers = {
         let element = document.getElementById(id);
         addNotification(element, notification_id, kind);
     },
+    'create_notifications': ({notifications}) => {
+        notifications.forEach(({id, notification_id, kind, count}) => {
+            let element = document.getElementById(id);
+            element && addNotification(element, notification_id, kind, count);
+        });
+    },
+    'update_presence': ({statuses}) => {
+        statuses.forEach(([user_pk, status]) => {
+            document.querySelectorAll(`[data-presence="${user_pk}"]`).forEach((element) => {
+                element.textContent = status;
+            });
+        });
+    },
     'remove_notification': ({id, notification_id, kind}) => {
         let element = document.getElementById(id);
         removeNotification(element, notification_id, kind);
@@ -147,37 +171,55 @@ const chatSocketReceiveHandlers = {
         let backlogInvites = backlog.querySelector('[data-role="invites"]');
         backlogInvites.innerHTML = invites;
     },
-    'generate_backlogs': ({html, page}) => {
+    'generate_backlogs': ({html, initial, cursor}) => {
+        backlogsCursor = cursor;
         backlogs.scrollTo(0, 1);
         let backlogList = parseHTML(html);
         backlogs.prepend(...[...backlogList.childNodes].reverse());
-        if (page === 1) {
+        if (initial) {
             backlogs.scroll(0, backlogs.scrollHeight);
         };
     },
+    'get_member_list': ({html, start, stop, total, version}) => {
+        memberListLoading = false;
+        if (String(version) !== memberList.dataset.version) {
+            // the rows moved since the list was loaded, start over from the top
+            memberList.innerHTML = '';
+            memberList.dataset.version = version;
+            if (start !== 0) {
+                memberList.dataset.loaded = 0;
+                memberListLoading = true;
+                chatSocket.send(JSON.stringify({'action': 'get_member_list', 'start': 0}));
+                return;
+            };
+        };
+        memberList.insertAdjacentHTML('beforeend', html);
+        memberList.dataset.loaded = stop;
+        memberList.dataset.total = total;
+    },
     'get_mentionables': ({html}) => {
         mentionableObserver.buildMentionablesList(html);
     },
-    'create_reaction': ({html, backlog_pk, is_sender}) => {
-        let backlog = document.getElementById(`backlog-${backlog_pk}`);
-        let reactions = backlog.querySelector('[data-role="reactions"]');
-        let reaction = parseHTML(html);
-        is_sender && reaction.classList.add('backlog__reaction--selected');
-        reactions.appendChild(reaction);
-    },
-    'delete_reaction': ({reaction_pk}) => {
-        let reaction = document.getElementById(`reaction-${reaction_pk}`);
-        reaction.remove();
-    },
-    'add_reaction': ({reaction_pk, is_sender}) => {
-        let reaction = document.getElementById(`reaction-${reaction_pk}`);
-        is_sender && reaction.classList.add('backlog__reaction--selected');
-        increaseCounter(reaction);
-    },
-    'remove_reaction': ({reaction_pk, is_sender}) => {
-        let reaction = document.getElementById(`reaction-${reaction_pk}`);
-        is_sender && reaction.classList.remove('backlog__reaction--selected');
-        decreaseCounter(reaction);
+    'update_reactions': ({reactions}) => {
+        reactions.forEach(({reaction_pk, backlog_pk, count, html, selected}) => {
+            let reaction = document.getElementById(`reaction-${reaction_pk}`);
+            if (!count) {
+                reaction && reaction.remove();
+                return;
+            };
+            if (!reaction) {
+                let backlog = document.getElementById(`backlog-${backlog_pk}`);
+                if (!backlog) {
+                    return;
+                };
+                reaction = parseHTML(html);
+                backlog.querySelector('[data-role="reactions"]').appendChild(reaction);
+            };
+            setCounter(reaction, count);
+            if (selected !== null) {
+                reaction.classList.toggle('backlog__reaction--selected', selected);
+            };
+        });
     },
     'create_log': ({html, is_sender}) => {
         let newLog = parseHTML(html);
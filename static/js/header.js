@@ -23,7 +23,29 @@ if (extraPath) {
     websocketURL += JSON.parse(extraPath.innerText) + '/';
 };
 
-chatSocket = new WebSocket(websocketURL);
+// the compact protocol (see rooms/protocol.py) needs the decoder from
+// static/js/msgpack.js, the socket falls back to JSON without it
+const binaryProtocol = Boolean(window.msgpack);
+let actionNames = [];
+
+chatSocket = binaryProtocol ? new WebSocket(websocketURL, ['msgpack']) : new WebSocket(websocketURL);
+chatSocket.binaryType = 'arraybuffer';
+
+function decodeFrame(frame) {
+    if (typeof frame === 'string') {
+        return JSON.parse(frame);
+    };
+
+    let [code, data] = window.msgpack.decode(new Uint8Array(frame));
+    if (code === 0) {
+        // handshake, the action codes are the positions in the table starting from 1
+        actionNames = data.actions;
+        return null;
+    };
+
+    data.action = (typeof code === 'number') ? actionNames[code - 1] : code;
+    return data;
+};
 
 window.onbeforeunload = function() {
     chatSocket.onclose = function () {};
@@ -31,7 +53,10 @@ window.onbeforeunload = function() {
 };
 
 chatSocket.onmessage = function(event) {
-	let data = JSON.parse(event.data);
+	let data = decodeFrame(event.data);
+    if (!data) {
+        return;
+    };
 	let action = data.action;
 
     if (debug) {
@@ -401,7 +426,35 @@ class EmoteMenuManager extends TooltipUtils {
         }));
     };
 
-    buildEmoteMenu = ({tooltip, emoji_categories}) => {
+    getEmojiCatalog = async (url) => {
+        // the url changes with the catalog, so the browser can cache it for good
+        if (this.emojiCatalog?.url !== url) {
+            let response = await fetch(url);
+            this.emojiCatalog = {url: url, categories: (await response.json()).categories};
+        };
+        return this.emojiCatalog.categories;
+    };
+
+    buildEmojiCategory = ({name, emojis}) => {
+        let category = quickCreateElement('div', {classList: ['emote-menu__category'], attributes: {'data-category': name}});
+        let label = quickCreateElement('div', {classList: ['emote-menu__label'], parent: category});
+        label.textContent = name;
+        let list = quickCreateElement('div', {classList: ['emote-menu__list'], parent: category});
+        emojis.forEach(([pk, emojiName, url]) => {
+            let emote = quickCreateElement('span', {
+                classList: ['emote-menu__emote'], 
+                attributes: {'data-kind': 'emoji', 'data-name': emojiName, 'data-pk': pk, 'data-role': 'emoticon'},
+                parent: list,
+            });
+            let avatar = quickCreateElement('div', {classList: ['avatar', 'avatar--medium'], parent: emote});
+            quickCreateElement('img', {attributes: {'src': url, 'alt': '', 'loading': 'lazy'}, parent: avatar});
+        });
+        return category;
+    };
+
+    buildEmoteMenu = async ({tooltip, catalog}) => {
+        let emojiCategories = await this.getEmojiCatalog(catalog);
+
         this.activeTrigger = this.waitingTrigger;
         this.waitingTrigger = undefined;
 
@@ -422,9 +475,8 @@ class EmoteMenuManager extends TooltipUtils {
         window.setTimeout(() => {
             /* avoids the lag of using a single big html element */
             let content = this.activeEmoteMenu.querySelector('[data-role="content"]');
-            emoji_categories.forEach((category) => {
-                let html = parseHTML(category);
-                content.appendChild(html);
+            emojiCategories.forEach((category) => {
+                content.appendChild(this.buildEmojiCategory(category));
             });
         }, 50);
     };
@@ -0,0 +1,19 @@
+const memberList = document.getElementById('member-list');
+const memberListScroller = memberList.closest('.sidebar__body');
+// whether a window of the member list is on its way, see GroupChatConsumer.get_member_list
+let memberListLoading = false;
+
+memberListScroller.addEventListener('scroll', () => {
+    let loaded = parseInt(memberList.dataset.loaded);
+    let total = parseInt(memberList.dataset.total);
+    let nearBottom = memberListScroller.scrollTop + memberListScroller.clientHeight >= memberListScroller.scrollHeight - 200;
+    if (memberListLoading || loaded >= total || !nearBottom) {
+        return;
+    };
+
+    memberListLoading = true;
+    chatSocket.send(JSON.stringify({
+        'action': 'get_member_list',
+        'start': loaded,
+    }));
+});
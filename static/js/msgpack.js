@@ -0,0 +1,85 @@
+// A msgpack decoder for the compact websocket protocol (see rooms/protocol.py).
+// The server only sends maps, arrays, strings, binaries, numbers, booleans and
+// nil, so extension types aren't supported. Frames from the client stay JSON,
+// so there's no encoder.
+(function () {
+    const textDecoder = new TextDecoder();
+
+    function decode(bytes) {
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+
+        function readString(length) {
+            const value = textDecoder.decode(bytes.subarray(offset, offset + length));
+            offset += length;
+            return value;
+        };
+
+        function readBinary(length) {
+            const value = bytes.slice(offset, offset + length);
+            offset += length;
+            return value;
+        };
+
+        function readArray(length) {
+            const value = [];
+            for (let i = 0; i < length; i++) {
+                value.push(read());
+            };
+            return value;
+        };
+
+        function readMap(length) {
+            const value = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                value[key] = read();
+            };
+            return value;
+        };
+
+        function read() {
+            const type = view.getUint8(offset);
+            offset += 1;
+
+            if (type <= 0x7f) return type;
+            if (type <= 0x8f) return readMap(type & 0x0f);
+            if (type <= 0x9f) return readArray(type & 0x0f);
+            if (type <= 0xbf) return readString(type & 0x1f);
+            if (type >= 0xe0) return type - 0x100;
+
+            let value;
+            switch (type) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: value = view.getUint8(offset); offset += 1; return readBinary(value);
+                case 0xc5: value = view.getUint16(offset); offset += 2; return readBinary(value);
+                case 0xc6: value = view.getUint32(offset); offset += 4; return readBinary(value);
+                case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+                case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+                case 0xcc: value = view.getUint8(offset); offset += 1; return value;
+                case 0xcd: value = view.getUint16(offset); offset += 2; return value;
+                case 0xce: value = view.getUint32(offset); offset += 4; return value;
+                case 0xcf: value = Number(view.getBigUint64(offset)); offset += 8; return value;
+                case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+                case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+                case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+                case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+                case 0xd9: value = view.getUint8(offset); offset += 1; return readString(value);
+                case 0xda: value = view.getUint16(offset); offset += 2; return readString(value);
+                case 0xdb: value = view.getUint32(offset); offset += 4; return readString(value);
+                case 0xdc: value = view.getUint16(offset); offset += 2; return readArray(value);
+                case 0xdd: value = view.getUint32(offset); offset += 4; return readArray(value);
+                case 0xde: value = view.getUint16(offset); offset += 2; return readMap(value);
+                case 0xdf: value = view.getUint32(offset); offset += 4; return readMap(value);
+            };
+
+            throw new Error(`msgpack type 0x${type.toString(16)} is not supported`);
+        };
+
+        return read();
+    };
+
+    window.msgpack = { decode };
+})();
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:11
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0023_alter_userarchive_user'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='customuser',
+            name='last_ping',
+        ),
+        migrations.RemoveField(
+            model_name='customuser',
+            name='status',
+        ),
+    ]
@@ -1,8 +1,8 @@
 from datetime import datetime, timezone
 
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, F, Min, Exists, OuterRef
 from django.contrib.auth.base_user import BaseUserManager
 from django.utils.translation import gettext_lazy as _
 from django.apps import apps
@@ -11,6 +11,51 @@ from core.models import Archive
 
 
 class CustomUserManager(BaseUserManager):
+    max_username_id = 99
+
+    def get_free_username_id(self, username):
+        """
+        Returns the lowest username_id not taken for the username in a single
+        query, or None if they're all taken. That's 0 if it's free, otherwise
+        the lowest id that comes right after a taken one.
+        """
+        taken_after = self.model.objects.filter(username=username, username_id=OuterRef('username_id') + 1)
+        ids = self.model.objects.filter(username=username).aggregate(
+            lowest=Min('username_id'),
+            lowest_gap=Min(
+                F('username_id') + 1,
+                filter=Q(username_id__lt=self.max_username_id) & ~Exists(taken_after)
+            ),
+        )
+        if ids['lowest'] is None or ids['lowest'] > 0:
+            return 0
+
+        return ids['lowest_gap']
+
+    def save_with_username_id(self, user):
+        """
+        Saves the new user with the lowest free username_id, looking for
+        another one if a concurrent signup takes it first. Every conflict 
+        means an id got taken, so it takes at most as many attempts as 
+        there are ids.
+        """
+        for attempt in range(self.max_username_id + 1):
+            user.username_id = self.get_free_username_id(user.username)
+            if user.username_id is None:
+                raise ValueError(_("All ID's for this username are already taken"))
+
+            try:
+                with transaction.atomic():
+                    user.save()
+                return user
+            except IntegrityError:
+                # anything other than the 'Verify unique username ID' 
+                # constraint, like a taken email, isn't ours to retry
+                if not self.model.objects.filter(username=user.username, username_id=user.username_id).exists():
+                    raise
+
+        raise ValueError(_("Could not find a free ID for this username, please try again"))
+
     def create_user(self, email, password, **extra_fields):
         if not email:
             raise ValueError(_("Email Required"))
@@ -18,16 +63,7 @@ class CustomUserManager(BaseUserManager):
         email = self.normalize_email(email)
         user = self.model(email=email, **extra_fields)
         user.set_password(password)
-
-        existing_username_ids = CustomUser.objects.filter(
-            username=user.username
-        ).values_list('username_id', flat=True)
-        free_ids = [value for value in range(0, 100) if value not in existing_username_ids]
-        if not free_ids:
-            raise ValueError(_("All ID's for this username are already taken"))
-        user.username_id = free_ids.pop(0)
-        user.save()
-        return user
+        return self.save_with_username_id(user)
 
     def create_superuser(self, email, password, **extra_fields):
         extra_fields.setdefault("is_staff", True)
@@ -54,7 +90,6 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     
     bio = models.TextField(max_length=50, blank=True)
     birthday = models.DateField(blank=False, null=True)
-    last_ping = models.DateTimeField(auto_now_add=True)
     
     twitter = models.CharField(max_length=500, blank=True)
     steam = models.CharField(max_length=500, blank=True)
@@ -63,13 +98,7 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     
     premium = models.BooleanField(default=False, blank=True)
 
-    ONLINE = 'online'
-    OFFLINE = 'offline'
-    STATUS = (
-        (ONLINE, 'Online'),
-        (OFFLINE, 'Offline'),
-    )
-    status = models.CharField(max_length=10, choices=STATUS, default=OFFLINE)
+    # whether the user is online is kept by rooms/presence.py
 
 
     USERNAME_FIELD = "email"
@@ -117,11 +146,12 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     
     def generate_notifications(self):
         notifications_by_id = {'initial': {'unread_backlogs': 0}}
-        private_chat_trackers = self.backlog_trackers.filter(backlog_group__kind='private_chat')
+        private_chat_trackers = self.backlog_trackers.filter(
+            backlog_group__kind='private_chat'
+        ).values_list('backlog_group', 'unread_count')
 
-        for tracker in private_chat_trackers:
-            unread_backlog_count = tracker.get_unread_backlogs().count()
-            notifications_by_id[f'backlog-group-{tracker.backlog_group.pk}-unreads'] = unread_backlog_count
+        for backlog_group, unread_backlog_count in private_chat_trackers:
+            notifications_by_id[f'backlog-group-{backlog_group}-unreads'] = unread_backlog_count
             notifications_by_id['initial']['unread_backlogs'] += unread_backlog_count
        
         for friendship in self.get_friendships().pending():
@@ -1,3 +1,45 @@
+from datetime import datetime
+from unittest.mock import patch
+
 from django.test import TestCase
 
-# Create your tests here.
+from .models import CustomUser
+
+
+class UsernameIdTests(TestCase):
+    def create_user(self, email, username='user', username_id=None):
+        return CustomUser.objects.create(username=username, username_id=username_id, email=email, birthday=datetime.now())
+
+    def test_lowest_free_id_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(CustomUser.objects.get_free_username_id('user'), 0)
+
+        for username_id in (0, 1, 3):
+            self.create_user(f'{username_id}@test.com', username_id=username_id)
+
+        self.create_user('other@test.com', username='other', username_id=2)
+        with self.assertNumQueries(1):
+            self.assertEqual(CustomUser.objects.get_free_username_id('user'), 2)
+
+    def test_all_ids_taken(self):
+        CustomUser.objects.bulk_create([
+            CustomUser(username='user', username_id=username_id, email=f'{username_id}@test.com')
+            for username_id in range(100)
+        ])
+        self.assertIsNone(CustomUser.objects.get_free_username_id('user'))
+        with self.assertRaises(ValueError):
+            CustomUser.objects.create_user('new@test.com', 'password', username='user', birthday=datetime.now())
+
+    def test_retries_when_the_id_is_taken_first(self):
+        # a concurrent signup takes 0 between looking it up and saving
+        get_free_username_id = CustomUser.objects.get_free_username_id
+        def take_first(username):
+            username_id = get_free_username_id(username)
+            if not CustomUser.objects.filter(email='concurrent@test.com').exists():
+                self.create_user('concurrent@test.com', username_id=username_id)
+            return username_id
+
+        with patch.object(CustomUser.objects, 'get_free_username_id', side_effect=take_first):
+            user = CustomUser.objects.create_user('new@test.com', 'password', username='user', birthday=datetime.now())
+
+        self.assertEqual(user.username_id, 1)
@@ -27,18 +27,14 @@ class SignupView(CreateView):
         return self.render_to_response(context)
     
     def form_valid(self, form):
-        # Check whether there are free ids ('username#[username_id]')
+        # the username gets the lowest free id ('username#[username_id]')
         user = form.save(commit=False)
-        existing_username_ids = CustomUser.objects.filter(
-            username=user.username
-        ).values_list('username_id', flat=True)
-        free_ids = [value for value in range(0, 100) if value not in existing_username_ids]
-        if not free_ids:
-            form.add_error('username', f'All IDs for username {form} are taken, please choose a different username.')
+        try:
+            CustomUser.objects.save_with_username_id(user)
+        except ValueError:
+            form.add_error('username', f'All IDs for username {user.username} are taken, please choose a different username.')
             return self.form_invalid(form)
         
-        user.username_id = free_ids.pop(0)
-        user.save()
         login(self.request, user)
         return JsonResponse({'status': 200, 'redirect': reverse('frontpage')})
 